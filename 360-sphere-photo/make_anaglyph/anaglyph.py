@@ -19,7 +19,12 @@
 # AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
 # WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import os
+import re
+import glob
 import optparse
+import multiprocessing
+import numpy as np
 from PIL import Image, ImageSequence
 from images2gif import writeGif
 
@@ -31,42 +36,115 @@ matrices = {
     'optimized': [ [ 0, 0.7, 0.3, 0, 0, 0, 0, 0, 0 ], [ 0, 0, 0, 0, 1, 0, 0, 0, 1 ] ],
 }
 
+def image_array(image):
+    # RGB pixels of a PIL image or an array, as an array of shape (height, width, 3)
+    if isinstance(image, np.ndarray):
+        return image[:, :, :3]
+    return np.asarray(image.convert('RGB'))
+
+def anaglyph_array(left, right, color):
+    # Each output channel is a weighted sum of the left and right channels,
+    # given by the rows of the matrices above
+    m = np.array(matrices[color], dtype = 'f8').reshape(2, 3, 3)
+    left = image_array(left)
+    right = image_array(right)
+    out = np.empty(left.shape, dtype = 'u1')
+    for k in range(3):
+        channel = np.zeros(left.shape[:2], dtype = 'f8')
+        for img, weights in ((left, m[0, k]), (right, m[1, k])):
+            for j in range(3):
+                if weights[j] != 0:
+                    channel += weights[j] * img[:, :, j]
+        np.clip(channel, 0, 255, out = channel)
+        out[:, :, k] = channel
+    return out
+
+def stereopair_array(left, right, color):
+    pair = np.hstack([ image_array(left), image_array(right) ])
+    if color == 'mono':
+        pair = mono_array(pair)
+    return pair
+
+def mono_array(img):
+    return np.asarray(Image.fromarray(img).convert('L'))
+
 def make_anaglyph(left, right, color, path):
-    width, height = left.size
-    leftMap = left.load()
-    rightMap = right.load()
-    m = matrices[color]
-
-    for y in range(0, height):
-        for x in range(0, width):
-            r1, g1, b1 = leftMap[x, y]
-            r2, g2, b2 = rightMap[x, y]
-            leftMap[x, y] = (
-                int(r1*m[0][0] + g1*m[0][1] + b1*m[0][2] + r2*m[1][0] + g2*m[1][1] + b2*m[1][2]),
-                int(r1*m[0][3] + g1*m[0][4] + b1*m[0][5] + r2*m[1][3] + g2*m[1][4] + b2*m[1][5]),
-                int(r1*m[0][6] + g1*m[0][7] + b1*m[0][8] + r2*m[1][6] + g2*m[1][7] + b2*m[1][8])
-            )
-    left.save(path)
-    
+    Image.fromarray(anaglyph_array(left, right, color)).save(path)
+
 def make_stereopair(left, right, color, path):
-    width, height = left.size
-    leftMap = left.load()
-    rightMap = right.load()
-    pair = Image.new('RGB', (width * 2, height))
-    pairMap = pair.load()
-    for y in range(0, height):
-        for x in range(0, width):
-            pairMap[x, y] = leftMap[x, y]
-            pairMap[x + width, y] = rightMap[x, y]
-    if color == 'mono':
-        pair = pair.convert('L')
-    pair.save(path)
+    Image.fromarray(stereopair_array(left, right, color)).save(path)
 
 def make_wiggle3d(left, right, color, path):
+    frames = [ Image.fromarray(image_array(left)), Image.fromarray(image_array(right)) ]
     if color == 'mono':
-        left = left.convert('L')
-        right = right.convert('L')
-    writeGif(path, [left, right], 0.1, True, False, 0, False, 2)
+        frames = [ img.convert('L') for img in frames ]
+    if 'GIF' in getattr(Image, 'SAVE_ALL', {}):
+        # Pillow writes animated GIFs itself (images2gif fails with its palettes)
+        frames[0].save(path, save_all = True, append_images = frames[1:], duration = 100, loop = 0, disposal = 2)
+    else:
+        writeGif(path, frames, 0.1, True, False, 0, False, 2)
+
+def open_image(fname):
+    # Frames written by render3d can be PNGs or raw RGB arrays (.npy)
+    if fname.endswith('.npy'):
+        return Image.fromarray(np.load(fname)[:, :, :3].astype('u1'))
+    return Image.open(fname)
+
+def resize_image(image, size):
+    width, height = image.size
+    return image.resize((size, size * height / width), Image.ANTIALIAS)
+
+def make_stereo(stereo_type, left, right, color, path):
+    if stereo_type == 'anaglyph':
+        make_anaglyph(left, right, color, path)
+    elif stereo_type == 'parallel':
+        make_stereopair(left, right, color, path)
+    elif stereo_type == 'crossed':
+        make_stereopair(right, left, color, path)
+    elif stereo_type == 'wiggle':
+        make_wiggle3d(left, right, color, path)
+
+def find_frames(base):
+    # Pairs of frames <base>-left.NNNNN.png and <base>-right.NNNNN.png (or .npy),
+    # as written by render3d for side-by-side renders
+    pattern = re.compile(re.escape(base) + r'-left\.(\d+)\.(png|npy)$')
+    frames = []
+    for left in sorted(glob.glob(base + '-left.*')):
+        match = pattern.match(left)
+        if match is None:
+            continue
+        right = base + '-right.' + match.group(1) + '.' + match.group(2)
+        if os.path.exists(right):
+            frames.append((int(match.group(1)), left, right))
+    return frames
+
+def process_frame(task):
+    stereo_type, color, size, left_fname, right_fname, path = task
+    left = open_image(left_fname)
+    right = open_image(right_fname)
+    if left.size != right.size:
+        print('%s and %s have different sizes. Skipping.' % (left_fname, right_fname))
+        return None
+    if size > 0:
+        left = resize_image(left, size)
+        right = resize_image(right, size)
+    make_stereo(stereo_type, left, right, color, path)
+    return path
+
+def make_batch(options, frame_base, out_base):
+    ext = 'gif' if options.type == 'wiggle' else 'png'
+    tasks = [ (options.type, options.color, options.size, left, right, '%s.%05d.%s' % (out_base, k, ext))
+              for k, left, right in find_frames(frame_base) ]
+    if len(tasks) == 0:
+        print('No frames %s-left.*.png with matching right frames found.' % frame_base)
+        return
+    pool = multiprocessing.Pool(options.jobs)
+    try:
+        done = [ path for path in pool.map(process_frame, tasks, 1) if path is not None ]
+    finally:
+        pool.close()
+        pool.join()
+    print('Wrote %d stereo frames to %s.*.%s' % (len(done), out_base, ext))
 
 def parse_arguments():
     parser = optparse.OptionParser(usage = 'usage: %prog [options] left_image right_image stereo_image')
@@ -108,34 +186,40 @@ def parse_arguments():
     group.add_option('-r', '--resize',
         action = 'store', type = 'int', dest = 'size', default = 0,
         help = 'resize image to the given width (height is automatically calculated to preserve aspect ratio)')
+    group.add_option('-b', '--batch',
+        action = 'store_true', dest = 'batch', default = False,
+        help = 'process the frames frame_base-left.NNNNN.png and frame_base-right.NNNNN.png written by render3d, '
+               'writing stereo_base.NNNNN.png (usage: %prog -b [options] frame_base stereo_base)')
+    group.add_option('-j', '--jobs',
+        action = 'store', type = 'int', dest = 'jobs', default = None,
+        help = 'number of processes used in batch mode (default: number of CPUs)')
     parser.add_option_group(group)
 
     options, args = parser.parse_args()
+    if options.batch:
+        if len(args) != 2:
+            parser.error('wrong number of arguments')
+        return options, args
+
     if len(args) != 3:
         parser.error('wrong number of arguments')
 
-    leftImage = Image.open(args[0])
-    pixelMap = leftImage.load()
-    rightImage = Image.open(args[1])
+    leftImage = open_image(args[0])
+    rightImage = open_image(args[1])
     if leftImage.size != rightImage.size:
         parser.error('left and right images must have the same size')
     if options.size > 0:
-        width, height = leftImage.size
-        leftImage = leftImage.resize((options.size, options.size * height / width), Image.ANTIALIAS)
-        rightImage = rightImage.resize((options.size, options.size * height / width), Image.ANTIALIAS)
-    return options, leftImage, rightImage, args[2]
+        leftImage = resize_image(leftImage, options.size)
+        rightImage = resize_image(rightImage, options.size)
+    return options, (leftImage, rightImage, args[2])
 
 def main():
-    options, leftImage, rightImage, stereoPath = parse_arguments()
-
-    if options.type == 'anaglyph':
-        make_anaglyph(leftImage, rightImage, options.color, stereoPath)
-    elif options.type == 'parallel':
-        make_stereopair(leftImage, rightImage, options.color, stereoPath)
-    elif options.type == 'crossed':
-        make_stereopair(rightImage, leftImage, options.color, stereoPath)
-    elif options.type == 'wiggle':
-        make_wiggle3d(leftImage, rightImage, options.color, stereoPath)
+    options, args = parse_arguments()
+
+    if options.batch:
+        make_batch(options, args[0], args[1])
+    else:
+        make_stereo(options.type, args[0], args[1], options.color, args[2])
 
 if __name__ == '__main__':
     main()
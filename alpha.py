@@ -76,3 +76,61 @@ def blend_images(img_under, img_over, limit_alpha=False):
     img[idx] = 1.
     
     return img
+
+
+def block_view(img, oversample):
+    '''
+    View of an image of shape (oversample*n_y, oversample*n_x, ...), with
+    shape (n_y, oversample, n_x, oversample, ...), in which each block
+    of pixels that comes from one pixel of an image <oversample> times
+    smaller has its own axes. Arrays indexed (x, y) at the lower
+    resolution, like the input to alpha2img, are broadcast over the
+    blocks as
+    
+        view *= lowres.T[:,None,:,None]
+    
+    The view shares the memory of <img> (an error is raised otherwise).
+    '''
+    
+    s = img.shape
+    view = img.view()
+    view.shape = (s[0]/oversample, oversample, s[1]/oversample, oversample) + s[2:]
+    
+    return view
+
+
+def unpremultiply(img):
+    '''
+    Convert an RGBA image from premultiplied to straight alpha, in place.
+    '''
+    
+    a = img[:,:,3]
+    idx = (a > 0.)
+    
+    norm = np.zeros(a.shape, dtype=img.dtype)
+    norm[idx] = 1. / a[idx]
+    
+    img[:,:,:3] *= norm[:,:,None]
+    
+    np.minimum(img, 1., out=img)
+
+
+def sprite_overlap(shape, sprite_shape, offset):
+    '''
+    Returns the slices of an image of the given <shape>, and of a
+    smaller image ("sprite") placed on it with its first pixel at
+    <offset>, that overlap. Returns None if they do not overlap.
+    '''
+    
+    img_idx, sprite_idx = [], []
+    
+    for n, n_sprite, k_0 in zip(shape, sprite_shape, offset):
+        k_min, k_max = max(k_0, 0), min(k_0 + n_sprite, n)
+        
+        if k_max <= k_min:
+            return None
+        
+        img_idx.append(slice(k_min, k_max))
+        sprite_idx.append(slice(k_min - k_0, k_max - k_0))
+    
+    return tuple(img_idx), tuple(sprite_idx)
@@ -26,15 +26,11 @@ import numpy as np
 import matplotlib
 import matplotlib.pyplot as plt
 
-from font_rendering import rasterize_text
-from point_rendering import rasterize_point
+from font_rendering import text_sprite
+from point_rendering import point_sprite
 from alpha import *
 
 
-def upsample_image(img, nx, ny):
-    return np.kron(img, np.ones((nx, ny)))
-
-
 class AlphaStacker:
     def __init__(self, alpha_stack, alpha_dist):
         self.alpha_stack = np.array(alpha_stack)
@@ -44,7 +40,7 @@ class AlphaStacker:
 
     def insert_text(self, txt, pos, dist, **kwargs):
         args = (txt, pos)
-        self.obj.append((rasterize_text, self._transform_text,
+        self.obj.append((text_sprite, self._transform_text,
                          args, kwargs.copy()))
         self.obj_dist.append(dist)
 
@@ -73,7 +69,7 @@ class AlphaStacker:
 
     def insert_point(self, pos, dist, **kwargs):
         args = (pos,)
-        self.obj.append((rasterize_point, self._transform_point,
+        self.obj.append((point_sprite, self._transform_point,
                         args, kwargs.copy()))
         self.obj_dist.append(dist)
 
@@ -97,128 +93,106 @@ class AlphaStacker:
 
         return args, kwargs_cpy
 
-    def _alpha_blocks(self):
-        # Determine ordering of alpha and rendered layers in stack
-        n_a = self.alpha_dist.size
-       	n_o = len(self.obj_dist)
+    def render(self, oversample=1, fg=(0,0,0), bg=(255, 255, 255, 255)):
+        '''
+        Composite the dust stack and the inserted objects (text and
+        points), and return an RGBA image, <oversample> times larger
+        than the images in the stack.
+
+        The layers are composited front to back. Between two objects,
+        the dust is a single-coloured absorber, so it only changes the
+        cumulative transmittance (exp(-optical depth)) of each pixel
+        of the stack, which is tracked at the resolution of the stack.
+        The oversampled canvas is only updated at the depth of each
+        object (and, if the dust is not black, to add the light it
+        scatters since the previous object).
+        '''
 
-        a_idx = np.hstack([np.arange(n_a), -np.ones(n_o)]).astype('i8')
+        n_x, n_y = self.alpha_stack.shape[1:]
+        canvas = (oversample * n_y, oversample * n_x)
+
+        # Order all the layers from front to back
+        n_a = self.alpha_dist.size
         d = np.hstack([self.alpha_dist, np.array(self.obj_dist)])
-        idx = np.argsort(d, kind='mergesort')[::-1]
-        a_idx = a_idx[idx]
-        d = d[idx]
+        order = np.argsort(d, kind='mergesort')
 
-        #print 'a_idx:'
-        #print a_idx
-        #print ''
+        fg_color = [c/255. for c in fg[:3]]
+        dust_black = not any(fg_color)
 
-        # Split alpha stack into contiguous blocks
-        split_idx = np.nonzero(a_idx == -1)[0]
-        a_idx = np.split(a_idx, split_idx)
-        d_a = np.split(d, split_idx)
+        # Straight-alpha background
+        bg_color = [c/255. for c in bg[:3]]
+        bg_alpha = bg[3]/255. if len(bg) > 3 else 1.
 
-        #print 'split_idx:'
-        #print split_idx
-        #print ''
+        # Premultiplied colour, and transmittance through the objects
+        # in front, of each pixel of the canvas
+        stacked = np.zeros((canvas[0], canvas[1], 4), dtype='f4')
+        color = stacked[:,:,:3]
+        t_obj = np.ones(canvas, dtype='f4')
 
-        #print 'a_idx:'
-        #print a_idx
-        #print ''
+        color_view = block_view(color, oversample)
+        t_obj_view = block_view(t_obj, oversample)
 
-        #print 'd_a:'
-        #print d_a
-        #print ''
+        # Transmittance of the dust in front, in the (x, y) pixels of the
+        # stack, and at the depth at which the canvas was last updated
+        t_dust = np.ones((n_x, n_y), dtype='f8')
+        t_dust_drawn = t_dust.copy()
 
-        n_blocks = 0
-        dist_block = []
+        def add_dust_light():
+            # Light scattered by the dust since the last update
+            a = (t_dust_drawn - t_dust).T.astype('f4')[:,None,:,None]
+            w = t_obj_view * a
 
-        for i,(k_block,d_block) in enumerate(zip(a_idx, d_a)):
-            idx = (k_block != -1)
-            a_idx[i] = k_block[idx]
+            for k,c in enumerate(fg_color):
+                if c != 0:
+                    color_view[...,k] += c * w
 
-            if np.sum(idx) != 0:
-                n_blocks += 1
-                dist_block.append(d_block[idx][0])
+        for k in order:
+            if k < n_a:
+                t_dust *= 1. - self.alpha_stack[k]
+                continue
 
-        dist_block = np.array(dist_block)
+            if not dust_black:
+                add_dust_light()
+                t_dust_drawn[:] = t_dust
 
-        s = self.alpha_stack.shape[1:]
-        alpha_block = np.empty((n_blocks, s[0], s[1]), dtype=self.alpha_stack.dtype)
+            # Only the pixels covered by the object are touched
+            f_render, f_oversample, args, kwargs = self.obj[k-n_a]
+            args, kwargs = f_oversample(args, kwargs, oversample)
+            sprite, (x_0, y_0) = f_render(*args, **kwargs)
+            sprite = np.swapaxes(sprite, 0, 1)
 
-        counter = 0
+            overlap = sprite_overlap(canvas, sprite.shape[:2], (y_0, x_0))
 
-        for k_block in a_idx:
-            if k_block.size == 0:
+            if overlap == None:
                 continue
 
-            alpha_block[counter] = 1. - np.prod(1. - self.alpha_stack[k_block], axis=0)
-            counter += 1
+            idx, sprite_idx = overlap
+            img = sprite[sprite_idx]
 
-        #print dist_block
-        #print n_blocks
+            # Weight of the object in the final image
+            a = img[:,:,3].astype('f4')
+            w = a * t_obj[idx]
 
-        return dist_block, alpha_block
+            y = np.arange(idx[0].start, idx[0].stop) / oversample
+            x = np.arange(idx[1].start, idx[1].stop) / oversample
+            w *= t_dust[x[None,:], y[:,None]]
 
-    def render(self, oversample=1, fg=(0,0,0), bg=(255, 255, 255, 255)):
-        a_shape = self.alpha_stack.shape[1:]
-        canvas = (oversample * a_shape[1], oversample * a_shape[0])
-
-        # Split alpha stack into contiguous blocks
-        a_dist, a_block = self._alpha_blocks()
-
-        # Determine ordering of objects in stack
-        #n_a = self.alpha_dist.size
-        n_a = a_dist.size
-        n_o = len(self.obj_dist)
-
-        a_idx = np.hstack([np.arange(n_a), -np.ones(n_o)]).astype('i8')
-        o_idx = np.hstack([-np.ones(n_a), np.arange(n_o)]).astype('i8')
-        #d = np.hstack([self.alpha_dist, np.array(self.obj_dist)])
-        d = np.hstack([a_dist, np.array(self.obj_dist)])
-        idx = np.argsort(d, kind='mergesort')[::-1]
-        a_idx = a_idx[idx]
-        o_idx = o_idx[idx]
-
-        # Stack images and text
-        stacked = np.empty((canvas[0], canvas[1], 4), dtype='f8')
-        stacked[:,:,3] = 1.
-        for k in xrange(len(bg)):
-            stacked[:,:,k] = bg[k] / 255.
-
-        fg_color = [c/255. for c in fg]
-
-        import time
-        start = time.time()
-        for dd, ka, ko in zip(d[idx], a_idx, o_idx):
-            # print('stack loop, dd, ka, ko', dd, ka, ko)
-            img = None
-
-            #print 'Stacking d = %d ...' % dd
-            alpha2img_time = time.time()
-            if ka != -1:
-                img = alpha2img(upsample_image(a_block[ka], oversample, oversample), color=fg_color)
-                # alpha2img_end_time = time.time()
-                # print('aplha2img function time', alpha2img_end_time - alpha2img_time)
-                #img = alpha2img(upsample_image(self.alpha_stack[ka], oversample, oversample))
-            elif ko != -1:
-                f_render, f_oversample, args, kwargs = self.obj[ko]
-                sample_start = time.time()
-                args, kwargs = f_oversample(args, kwargs, oversample)
-                oversample_time = time.time()
-                # print('f_oversample time', oversample_time-sample_start)
-                
-                img = f_render(canvas[::-1], *args, **kwargs)
-                # print('f_render time', time.time()-oversample_time)
-                img = np.swapaxes(img, 0, 1)
-            else:
-                raise ValueError('Both ka and ko are -1')
-
-            stacked = blend_images(stacked, img)
-            # print('blend_images time', time.time() - alpha2img_end_time)
-
-        logfile = open('log.txt', 'a')
-        logfile.write('blend images %.2f' % (time.time()-start))
-        logfile.close()
+            color[idx] += img[:,:,:3] * w[:,:,None]
+            t_obj[idx] *= 1. - a
+
+        if not dust_black:
+            add_dust_light()
+
+        # Background, seen through everything
+        t_view = block_view(t_obj, oversample)
+        t_view *= t_dust.T.astype('f4')[:,None,:,None]
+
+        for k,c in enumerate(bg_color):
+            color[:,:,k] += (bg_alpha * c) * t_obj
+
+        stacked[:,:,3] = 1. - (1. - bg_alpha) * t_obj
+
+        unpremultiply(stacked)
 
         return stacked
 
@@ -0,0 +1,495 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#  
+#  benchmark.py
+#  
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#  
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#  
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#  
+#  
+
+'''
+Benchmarks of the stages of the render pipeline, on a synthetic dust
+map, so that they can be run without the real map (and offline).
+
+    python benchmark.py --save baseline.json
+    python benchmark.py --compare baseline.json
+
+The results (median and minimum times of each benchmark) are written
+as JSON, together with the settings and the git commit, so that runs
+on different commits can be compared.
+'''
+
+import numpy as np
+
+import matplotlib
+matplotlib.use('Agg')
+
+import os, sys, time
+import copy
+import json
+import socket
+import platform
+import subprocess
+import tempfile
+import shutil
+import argparse
+
+import h5py
+
+import maptools, hputils
+from alphastacker import AlphaStacker
+import font_rendering
+from font_rendering import rasterize_text, text_sprite
+
+
+repo_dir = os.path.dirname(os.path.abspath(__file__))
+font_fname = os.path.join(repo_dir, 'fonts', 'cmunss.ttf')
+
+
+def synthetic_los_data(nside=16, n_samples=4, n_dist=31,
+                       DM_min=4., DM_max=19., seed=1):
+    '''
+    Returns an LOSData object containing a random map with all pixels
+    at the same <nside>, with <n_samples> samples of the cumulative
+    E(B-V) in <n_dist> distance bins along each line of sight. Most of
+    the reddening is put in a few bins, so that the map is clumpy, like
+    the real one.
+    '''
+    
+    rs = np.random.RandomState(seed)
+    
+    n_pix = 12 * nside**2
+    
+    pix_idx = np.arange(n_pix, dtype='i8')
+    nside_arr = nside * np.ones(n_pix, dtype='i4')
+    cloud_mask = np.zeros(n_pix, dtype=np.bool)
+    los_mask = np.ones(n_pix, dtype=np.bool)
+    n_stars = 100 * np.ones(n_pix, dtype='i4')
+    
+    dEBV = 0.2 * rs.random_sample((n_pix, n_samples, n_dist))**8
+    los_EBV = np.cumsum(dEBV, axis=2).astype('f4')
+    los_lnp = np.zeros((n_pix, n_samples), dtype='f4')
+    los_GR = np.ones((n_pix, n_dist), dtype='f4')
+    
+    pix_info = (pix_idx, nside_arr, cloud_mask, los_mask, n_stars)
+    los_info = (los_EBV, los_lnp, los_GR)
+    DM_EBV_lim = (DM_min, DM_max, 0., 5.)
+    
+    data = maptools.LOSData()
+    data.append((pix_info, None, los_info, None, DM_EBV_lim))
+    data.concatenate()
+    
+    return data
+
+
+def save_compact(data, fname):
+    '''
+    Save an LOSData object in the compact file format (see
+    maptools.load_output_file_compact).
+    '''
+    
+    n_pix, n_samples, n_dist = data.los_EBV[0].shape
+    DM_min, DM_max = data.DM_EBV_lim[:2]
+    
+    f = h5py.File(fname, 'w')
+    
+    dtype = [('nside', 'i4'), ('healpix_index', 'i8'), ('n_stars', 'i4')]
+    pix_info = np.empty(n_pix, dtype=dtype)
+    pix_info['nside'] = data.nside[0]
+    pix_info['healpix_index'] = data.pix_idx[0]
+    pix_info['n_stars'] = data.n_stars[0]
+    
+    dset = f.create_dataset('pixel_info', data=pix_info)
+    dset.attrs['DM_bin_edges'] = np.linspace(DM_min, DM_max, n_dist)
+    
+    f.create_dataset('samples', data=data.los_EBV[0])
+    f.create_dataset('GRDiagnostic', data=data.los_GR[0])
+    
+    f.close()
+
+
+def time_call(f, repeat=3):
+    '''
+    Returns the times taken by <repeat> calls of <f>.
+    '''
+    
+    t = []
+    
+    for k in xrange(repeat):
+        np.random.seed(k)
+        
+        t_start = time.time()
+        f()
+        t.append(time.time() - t_start)
+    
+    return t
+
+
+def get_benchmarks(data, fnames, n_x=100, n_y=75, steps=200, n_stack=20,
+                         oversample=2):
+    '''
+    Returns a list of (name, setup, function) triples, one for each
+    benchmark. Calling setup builds the fixtures that the benchmark
+    needs (if no other benchmark has built them yet), so that they are
+    not timed, and only built for the benchmarks that are run.
+    '''
+    
+    nside = data.nside[0]
+    pix_idx = data.pix_idx[0]
+    los_EBV = data.los_EBV[0]
+    DM_min, DM_max = data.DM_EBV_lim[:2]
+    
+    # Camera a little outside the Sun, looking at the Galactic center
+    alpha, beta = 0., 0.
+    r_cam = np.array([-100., 20., 10.])
+    fov = 90.
+    dr = 5.
+    z_0 = 1.
+    
+    proj_args = (alpha, beta, n_x, n_y, fov, r_cam, dr, z_0)
+    ortho_args = (alpha, beta, n_x, n_y, steps, (2., 2., 2.))
+    r_right = r_cam + np.array([0., 1., 0.])
+    stereo_args = [proj_args, (alpha, beta, n_x, n_y, fov, r_right, dr, z_0)]
+    sphere_args = (alpha, beta, n_x, n_x/2, 360., r_cam, dr, z_0)
+    
+    def build_mapper3d():
+        return maptools.Mapper3D(nside, pix_idx, los_EBV, DM_min, DM_max)
+    
+    def build_stacker():
+        # Image stack with labels, as made by render3d.gen_frame
+        n_images = steps / n_stack + (1 if steps % n_stack else 0)
+        alpha_stack = fixture('mapper3d').proj_map_in_slices('stereo', steps, 'sample',
+                                                             *proj_args, stack=n_stack)
+        alpha_stack = 1. - np.exp(-0.3 * dr * alpha_stack)
+        alpha_stack = np.swapaxes(alpha_stack, 1, 2)[:,::-1,:]
+        d_images = z_0 + np.linspace(0., (steps-1.)*dr, n_images)
+        
+        stacker = AlphaStacker(alpha_stack, d_images)
+        
+        rs = np.random.RandomState(1)
+        
+        for k in xrange(10):
+            x = rs.uniform(0., 2.*n_x+1.)
+            y = rs.uniform(0., 2.*n_y+1.)
+            d = rs.uniform(d_images[0], d_images[-1])
+            stacker.insert_text(u'Label %d' % k, (x, y), d,
+                                font=font_fname, fontsize=8.,
+                                fontcolor=(0, 166, 255),
+                                stroke_width=0.3,
+                                stroke_color=(255, 148, 54))
+        
+        return stacker
+    
+    def build_grid_mappers():
+        # The same mapper, rendering from a Cartesian grid of the density
+        # (trilinear, and nearest voxel) around the Sun
+        mapper3d = fixture('mapper3d')
+        grid = mapper3d.resample_to_grid(500., dr)
+        grid_mapper = {}
+        
+        for order in (0, 1):
+            grid_mapper[order] = copy.copy(mapper3d)
+            grid_mapper[order].use_grid(maptools.DensityGrid(grid.density, grid.r_max,
+                                                             grid.spacing, grid.reduction,
+                                                             order=order))
+        
+        return grid_mapper
+    
+    def build_brick_mapper():
+        # ... and from sparse bricks of the density
+        mapper3d = fixture('mapper3d')
+        brick_mapper = copy.copy(mapper3d)
+        brick_mapper.use_grid(mapper3d.build_bricks(500., dr))
+        
+        return brick_mapper
+    
+    def build_sample_mapper():
+        # The same map, stored on disk by posterior sample
+        return maptools.SampleMajorMapper3D(nside, pix_idx, los_EBV, DM_min, DM_max,
+                                            fnames['samples'])
+    
+    builders = {
+        'mapper3d': build_mapper3d,
+        'stacker': build_stacker,
+        'grid_mapper': build_grid_mappers,
+        'brick_mapper': build_brick_mapper,
+        'sample_mapper': build_sample_mapper
+    }
+    
+    fixtures = {}
+    
+    def fixture(name):
+        if name not in fixtures:
+            fixtures[name] = builders[name]()
+        
+        return fixtures[name]
+    
+    def needs(*names):
+        return lambda: [fixture(name) for name in names]
+    
+    canvas = (oversample*(2*n_x+1), oversample*(2*n_y+1))
+    img_shape = (4*n_x, 2*n_x)
+    
+    def label_uncached():
+        font_rendering.clear_caches()
+        text_sprite(u'Orion A', (0.5*canvas[0], 0.5*canvas[1]),
+                    font=font_fname, fontsize=16*oversample,
+                    fontcolor=(0, 166, 255),
+                    stroke_width=0.6*oversample,
+                    stroke_color=(255, 148, 54))
+    
+    def proj(mapper, proj_name, args):
+        return lambda: fixture(mapper).proj_map_in_slices(proj_name, steps, 'sample',
+                                                          *args, stack=n_stack)
+    
+    benchmarks = [
+        ('load_unified', needs(), lambda: maptools.load_output_file(fnames['unified'])),
+        ('load_compact', needs(), lambda: maptools.load_output_file(fnames['compact'])),
+        ('los_mapper', needs(), lambda: maptools.LOSMapper([fnames['unified']])),
+        ('mapper3d_build', needs(), build_mapper3d),
+        ('reduce_median', needs('mapper3d'),
+            lambda: maptools.reduce_in_blocks(fixture('mapper3d').density, 'median')),
+        ('reduce_batched', needs('mapper3d'),
+            lambda: maptools.take_measures(fixture('mapper3d').density,
+                                           ['mean', 'median', 'sigma', 84.])),
+        ('reduce_sample', needs('mapper3d'), lambda: fixture('mapper3d').reduce_map('sample')),
+        ('sample_major_build', needs(),
+            lambda: maptools.SampleMajorMapper3D(nside, pix_idx, los_EBV, DM_min, DM_max,
+                                                 fnames['samples_build'])),
+        ('reduce_sample_major', needs('sample_mapper'),
+            lambda: fixture('sample_mapper').reduce_map('sample')),
+        ('proj_ortho', needs('mapper3d'), proj('mapper3d', 'ortho', ortho_args)),
+        ('proj_pinhole', needs('mapper3d'), proj('mapper3d', 'pinhole', proj_args)),
+        ('proj_stereo', needs('mapper3d'), proj('mapper3d', 'stereo', proj_args)),
+        ('grid_build', needs('mapper3d'), lambda: fixture('mapper3d').resample_to_grid(500., dr)),
+        ('proj_stereo_grid', needs('grid_mapper'),
+            lambda: fixture('grid_mapper')[1].proj_map_in_slices('stereo', steps, 'sample',
+                                                                 *proj_args, stack=n_stack)),
+        ('proj_stereo_grid_nearest', needs('grid_mapper'),
+            lambda: fixture('grid_mapper')[0].proj_map_in_slices('stereo', steps, 'sample',
+                                                                 *proj_args, stack=n_stack)),
+        ('bricks_build', needs('mapper3d'), lambda: fixture('mapper3d').build_bricks(500., dr)),
+        ('proj_stereo_bricks', needs('brick_mapper'), proj('brick_mapper', 'stereo', proj_args)),
+        ('proj_stereo_sample_major', needs('sample_mapper'),
+            proj('sample_mapper', 'stereo', proj_args)),
+        ('proj_equirect', needs('mapper3d'), proj('mapper3d', 'equirectangular', sphere_args)),
+        ('proj_ods', needs('mapper3d'), proj('mapper3d', 'ods', sphere_args)),
+        ('proj_stereo_pair', needs('mapper3d'),
+            lambda: fixture('mapper3d').proj_stereo_pair(steps, 'sample',
+                                                         stereo_args[0], stereo_args[1],
+                                                         stack=n_stack)),
+        ('alphastacker_render', needs('stacker'),
+            lambda: fixture('stacker').render(oversample=oversample)),
+        ('rasterize_text', needs(),
+            lambda: rasterize_text(canvas, u'Orion A', (0.5*canvas[0], 0.5*canvas[1]),
+                                   font=font_fname, fontsize=16*oversample,
+                                   fontcolor=(0, 166, 255),
+                                   stroke_width=0.6*oversample,
+                                   stroke_color=(255, 148, 54))),
+        ('text_sprite_uncached', needs(), label_uncached),
+        ('map_rasterizer', needs(), lambda: hputils.MapRasterizer(nside, pix_idx, img_shape))
+    ]
+    
+    return benchmarks
+
+
+def get_commit():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                         cwd=repo_dir, stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    
+    return commit.strip()
+
+
+def run_benchmarks(params, repeat=3, only=None):
+    '''
+    Build a synthetic map with the settings in <params>, and run the
+    benchmarks (those whose names contain one of the strings in <only>,
+    if given). Returns the results, ready to be saved as JSON.
+    '''
+    
+    data = synthetic_los_data(nside=params['nside'],
+                              n_samples=params['n_samples'],
+                              n_dist=params['n_dist'])
+    
+    tmp_dir = tempfile.mkdtemp(prefix='benchmark-')
+    
+    fnames = {
+        'unified': os.path.join(tmp_dir, 'unified.h5'),
+        'compact': os.path.join(tmp_dir, 'compact.h5'),
+        'samples': os.path.join(tmp_dir, 'samples.npy'),
+        'samples_build': os.path.join(tmp_dir, 'samples_build.npy')
+    }
+    
+    results = {}
+    
+    # The loaders and the ray marchers print their progress
+    stdout = sys.stdout
+    
+    try:
+        data.save_unified(fnames['unified'])
+        save_compact(data, fnames['compact'])
+        
+        np.seterr(all='ignore')
+        
+        benchmarks = get_benchmarks(data, fnames,
+                                    n_x=params['n_x'], n_y=params['n_y'],
+                                    steps=params['steps'],
+                                    n_stack=params['n_stack'],
+                                    oversample=params['oversample'])
+        
+        for name, setup, f in benchmarks:
+            if (only != None) and not any([s in name for s in only]):
+                continue
+            
+            stdout.write('%-22s' % name)
+            stdout.flush()
+            
+            sys.stdout = open(os.devnull, 'w')
+            
+            try:
+                setup()
+                t = time_call(f, repeat=repeat)
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+            
+            results[name] = {
+                'median': float(np.median(t)),
+                'min': float(np.min(t)),
+                'times': t
+            }
+            
+            print '%9.3f s (min %.3f s)' % (np.median(t), np.min(t))
+    finally:
+        sys.stdout = stdout
+        shutil.rmtree(tmp_dir)
+    
+    info = {
+        'commit': get_commit(),
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'host': socket.gethostname(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'repeat': repeat,
+        'params': params
+    }
+    
+    return {'info': info, 'results': results}
+
+
+def compare(baseline, current, tolerance=0.1):
+    '''
+    Print the change in the median time of each benchmark, relative to
+    a baseline. Returns the names of the benchmarks that got slower by
+    more than the fraction <tolerance>.
+    '''
+    
+    if baseline['info']['params'] != current['info']['params']:
+        print 'Warning: the baseline was run with different settings:'
+        print '  %s' % json.dumps(baseline['info']['params'], sort_keys=True)
+    
+    print ''
+    print 'Compared to commit %s (%s):' % (baseline['info']['commit'],
+                                          baseline['info']['time'])
+    print '%-22s %10s %10s %8s' % ('benchmark', 'base (s)', 'now (s)', 'ratio')
+    
+    slower = []
+    
+    for name in sorted(current['results']):
+        if name not in baseline['results']:
+            continue
+        
+        t_0 = baseline['results'][name]['median']
+        t_1 = current['results'][name]['median']
+        ratio = t_1 / t_0 if t_0 > 0. else np.inf
+        
+        flag = ''
+        
+        if ratio > 1. + tolerance:
+            flag = 'slower'
+            slower.append(name)
+        elif ratio < 1. - tolerance:
+            flag = 'faster'
+        
+        print '%-22s %10.3f %10.3f %8.2f %s' % (name, t_0, t_1, ratio, flag)
+    
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Time the stages of the render pipeline on a synthetic map.',
+        add_help=True)
+    parser.add_argument('--nside', type=int, default=16,
+                        help='HEALPix nside of the synthetic map.')
+    parser.add_argument('--samples', type=int, default=4,
+                        help='Samples per line of sight.')
+    parser.add_argument('--dist-bins', type=int, default=31,
+                        help='Distance bins per line of sight.')
+    parser.add_argument('--size', type=int, nargs=2, default=(100, 75),
+                        metavar=('N_X', 'N_Y'),
+                        help='Half-width and half-height of the images, in pixels.')
+    parser.add_argument('--steps', type=int, default=200,
+                        help='Ray-marching steps.')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of times each benchmark is run.')
+    parser.add_argument('--only', type=str, nargs='+', default=None,
+                        help='Only run the benchmarks whose names contain one of these strings.')
+    parser.add_argument('--save', type=str, default=None,
+                        help='Write the results to this JSON file.')
+    parser.add_argument('--compare', type=str, default=None,
+                        help='Compare the results to a baseline JSON file.')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Fractional slowdown reported as a regression.')
+    args = parser.parse_args()
+    
+    params = {
+        'nside': args.nside,
+        'n_samples': args.samples,
+        'n_dist': args.dist_bins,
+        'n_x': args.size[0],
+        'n_y': args.size[1],
+        'steps': args.steps,
+        'n_stack': 20,
+        'oversample': 2
+    }
+    
+    results = run_benchmarks(params, repeat=args.repeat, only=args.only)
+    
+    if args.save != None:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        
+        print 'Results written to %s.' % args.save
+    
+    if args.compare != None:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        
+        slower = compare(baseline, results, tolerance=args.tolerance)
+        
+        if len(slower) != 0:
+            print ''
+            print '%d benchmarks got slower.' % len(slower)
+            return 1
+    
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
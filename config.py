@@ -1,23 +1,28 @@
 from camera_route import *
 import os
-import datetime
 import math
+import json
+import inspect
 
-logfile = open('log.txt', 'a')
-logfile.truncate()
-logfile.write('\n')
-logfile.write('---------'+str(datetime.datetime.now())+'-------'+'\n')
+'''
+Render settings. A render ("job") is described by a dictionary with
+the keys
+
+    map_fname, plot_props, camera_props, label_props,
+    camera_pos, n_procs, axis_on, stop_f, stereo_pass, render_kwargs
 
-'''    
-Add environment path to ~/.bashrc (depent on which shell the user use):
+which can be built from a JSON (or YAML) job file with load_job(), or
+by answering questions on the terminal with prompt_job().
+
+If the job file does not give the output and dust map locations, they
+are read from the environment variables (set them in ~/.bashrc,
+depending on which shell the user uses):
 
 PAN1 is the output dir
 MAP_FNAME is the dust map dataset dir
 
 '''
-pan1 = os.environ['PAN1']
-map_fname = os.environ['MAP_FNAME']
-    
+
 # Camera path/orientation
 #camera_pos = local_dust_path(n_frames=400)
 #camera_pos = paper_renderings()
@@ -25,104 +30,236 @@ map_fname = os.environ['MAP_FNAME']
 #camera_pos = grand_tour_path(n_frames=20)#1600)
 # camera_pos = circle_local(n_frames=3, l_0=30., b_0=5.)
 
-axis_on = True
-fov = 110.
-figsize = (10, 7)
-
-stop_f = int(raw_input('Restart from frame number [0]') or 0)
-if stop_f == 0:
-    stop_f = None
-
-try:
-    f = int(raw_input('How many frames in total?'))
-    logfile.write('How many frames? '+ str(f)+ '\n')
-except ValueError:
-    print('Not a number, default frame num as 20')
-    f = 20
-
-'''Set camera render mode'''
-mode = str(raw_input('Which camera mode? [circle local(cl)|grand tour(gt)|local dust(ld)|nw-270(nw)]|equirectangular[eq]'))
-b = raw_input('Render side-by-side? [y/n] ')
-if str(b) == 'y':
-    side_by_side = True
-if str(b) == 'n':
-    side_by_side = False
-logfile.write('Which camera mode? ' + mode + '\n')
-if mode == 'cl':
-    fname = '/3d/allsky_2MASS/circle-local/dust-map-cl.png'    
-    camera_pos = circle_local(n_frames=f, side_by_side=side_by_side, stop_f=stop_f)
-        
-# TODO: add side-by-side render
-if mode == 'gt':
-    fname = '/3d/allsky_2MASS/grand-tour/dust-map-gt.png'
-    b = raw_input('Render side-by-side? [y/n] ')
-    camera_pos = grand_tour_path(n_frames=f, side_by_side=side_by_side, stop_f=stop_f)
-    
-if mode == 'ld':
-    fname = '/3d/allsky_2MASS/local-dust/dust-map-ld.png'
-    camera_pos = local_dust_path(n_frames=f)
-    
-if mode == 'nw':
-    fname = '/3d/allsky_2MASS/nw-270/nw-270.png'
-    camera_pos = nw_270(n_frames=f)
-    axis_on = False
-
-if mode == 'eq':
-    fname = '/3d/allsky_2MASS/equirectangular/equirectangular.png'    
-    camera_pos = equirectangular_route(n_frames=f, side_by_side = side_by_side, stop_f=stop_f)
-    axis_on = False
-    # fov is calculated depending on frames
-    fov = 180/(math.sqrt(f/2))
-    figsize=(10, 10)
-
-# Initiate processing core numbers
-n_procs = 10
-
-# Misc settings
-plot_props = {
-    'fname': pan1 + fname, #'3d/allsky_2MASS/grand-tour/simple-loop-att-v2-lq.png',
-    'figsize': figsize,  # figure aspect ratio
-    'dpi': 100,
-    'n_averaged': 1,
-    'gamma': 1.,
-    'R': 3.1,
-    'scale_opacity': 1.,
-    'sigma': 0,
-    'oversample': 2,
-    'n_stack': 10,
-    'randomize_dist': True,
-    'randomize_ang': True,
-    'foreground': (255, 255, 255),
-    'background': (0, 0, 0)
+# Camera modes: (route function, output filename relative to PAN1)
+camera_modes = {
+    'cl': ('circle_local', '/3d/allsky_2MASS/circle-local/dust-map-cl.png'),
+    'gt': ('grand_tour_path', '/3d/allsky_2MASS/grand-tour/dust-map-gt.png'),
+    'ld': ('local_dust_path', '/3d/allsky_2MASS/local-dust/dust-map-ld.png'),
+    'nw': ('nw_270', '/3d/allsky_2MASS/nw-270/nw-270.png'),
+    'eq': ('equirectangular_route', '/3d/allsky_2MASS/equirectangular/equirectangular.png'),
+    'of': ('Orion_flythrough', '/3d/allsky_2MASS/orion/dust-map-of.png'),
+    'pr': ('paper_renderings', '/3d/allsky_2MASS/paper/dust-map-pr.png')
 }
 
-#for key in camera_pos:
-#    camera_pos[key] = camera_pos[key][:20]
-try:
-    q = int(raw_input('How good the quality is? [1 the lowest, 10 the highest]'))
-    logfile.write('Rendering quality ' + str(q) + '\n')
-    
-except ValueError:
-    print('Not a number, default as 2')
-    q = 2
-    
-# Camera properties
-camera_props = {
-    'proj_name': 'stereo',
-    'fov': fov,  # degrees
-    'n_x': 20*figsize[0]*q, # num of pixels
-    'n_y': 20*figsize[1]*q,
-    'n_z': 500*q,
-    'dr': 10./q,  # 10pc per step
-    'z_0': 1., #(0., 0., 0.)
-}
+
+def get_camera_pos(mode, n_frames, side_by_side=False, **kwargs):
+    '''
+    Generate the camera path for the given mode, which can either be
+    one of the short names in <camera_modes>, or the name of a route
+    function in camera_route.py. Additional keyword arguments are
+    passed on to the route function.
+    '''
+    
+    route_name = camera_modes.get(mode, (mode, None))[0]
+    route = globals().get(route_name, None)
+    
+    if not callable(route):
+        raise ValueError('Unrecognized camera mode: "%s"' % mode)
+    
+    # Not every route supports side-by-side rendering
+    arg_names = inspect.getargspec(route).args
+    
+    if 'n_frames' in arg_names:
+        kwargs['n_frames'] = n_frames
+    
+    if 'side_by_side' in arg_names:
+        kwargs['side_by_side'] = side_by_side
+    elif side_by_side:
+        print('Camera mode "%s" cannot render side-by-side, rendering one camera' % mode)
+    
+    return route(**kwargs)
 
 
-# General label properties
-label_props = {
-    'text_color': (0, 166, 255),#(255, 255, 255),
-    'stroke_color': (9, 73, 92),#(0, 0, 0) #(192, 225, 235)
-}
-logfile.write('\n')
-logfile.write('Image Rendering Time(s) \n')
-logfile.close()
\ No newline at end of file
+def make_job(mode='cl', n_frames=20, side_by_side=False, stop_f=None,
+             quality=2, fname=None, pan1=None, map_fname=None,
+             n_procs=10, route_kwargs={}, stereo_pass=True):
+    '''
+    Set up the default render settings for a camera mode, frame count
+    and rendering quality (1 the lowest, 10 the highest). If
+    <stereo_pass> is True, both cameras of a side-by-side render are
+    rendered together, sharing the work on distant parts of the map
+    (with the stereographic projection; other projections render the
+    cameras one after the other).
+    '''
+    
+    if pan1 == None:
+        pan1 = os.environ['PAN1']
+    
+    if map_fname == None:
+        map_fname = os.environ['MAP_FNAME']
+    
+    if stop_f == 0:
+        stop_f = None
+    
+    axis_on = True
+    fov = 110.
+    figsize = (10, 7)
+    
+    # The whole route is kept when restarting, so that frames keep
+    # their numbers (frames before <stop_f> are skipped when rendering)
+    camera_pos = get_camera_pos(mode, n_frames,
+                                side_by_side=side_by_side,
+                                **route_kwargs)
+    
+    if fname == None:
+        fname = pan1 + camera_modes.get(mode, (None, '/3d/dust-map-%s.png' % mode))[1]
+    
+    if mode in ('nw', 'nw_270'):
+        axis_on = False
+    
+    if mode in ('eq', 'equirectangular_route'):
+        axis_on = False
+        # fov is calculated depending on frames
+        fov = 180/(math.sqrt(n_frames/2))
+        figsize=(10, 10)
+    
+    # Misc settings
+    plot_props = {
+        'fname': fname, #'3d/allsky_2MASS/grand-tour/simple-loop-att-v2-lq.png',
+        'figsize': figsize,  # figure aspect ratio
+        'dpi': 100,
+        'n_averaged': 1,
+        'gamma': 1.,
+        'R': 3.1,
+        'scale_opacity': 1.,
+        'sigma': 0,
+        'oversample': 2,
+        'n_stack': 10,
+        'randomize_dist': True,
+        'randomize_ang': True,
+        'foreground': (255, 255, 255),
+        'background': (0, 0, 0)
+    }
+    
+    q = quality
+    
+    # Camera properties
+    camera_props = {
+        'proj_name': 'stereo',
+        'fov': fov,  # degrees
+        'n_x': 20*figsize[0]*q, # num of pixels
+        'n_y': 20*figsize[1]*q,
+        'n_z': 500*q,
+        'dr': 10./q,  # 10pc per step
+        'z_0': 1., #(0., 0., 0.)
+    }
+    
+    # General label properties
+    label_props = {
+        'text_color': (0, 166, 255),#(255, 255, 255),
+        'stroke_color': (9, 73, 92),#(0, 0, 0) #(192, 225, 235)
+    }
+    
+    job = {
+        'map_fname': map_fname,
+        'plot_props': plot_props,
+        'camera_props': camera_props,
+        'label_props': label_props,
+        'camera_pos': camera_pos,
+        'n_procs': n_procs,
+        'axis_on': axis_on,
+        'stop_f': stop_f,
+        'stereo_pass': stereo_pass,
+        'render_kwargs': {}
+    }
+    
+    return job
+
+
+def load_job(fname):
+    '''
+    Load render settings from a job file. JSON files are always
+    supported; YAML files (.yaml or .yml) require PyYAML. For example:
+        
+        {
+            "mode": "gt",
+            "n_frames": 1600,
+            "quality": 5,
+            "side_by_side": true,
+            "stereo_pass": true,
+            "route_kwargs": {"close_path": true},
+            "plot_props": {"n_stack": 20},
+            "camera_props": {"proj_name": "stereo"},
+            "n_procs": 16,
+            "render_kwargs": {"max_samples": 10}
+        }
+    
+    "mode" is a short camera mode name (see <camera_modes>) or the name
+    of a route function in camera_route.py. "plot_props", "camera_props"
+    and "label_props" override the defaults set by make_job(), and
+    "render_kwargs" are passed on to gen_movie_frames(). The optional
+    keys "pan1", "map_fname" and "fname" set the output directory,
+    dust map and output filename.
+    '''
+    
+    f = open(fname, 'r')
+    
+    if fname.endswith('.yaml') or fname.endswith('.yml'):
+        try:
+            import yaml
+        except ImportError:
+            raise ImportError('Reading YAML job files requires PyYAML. '
+                              'Use a JSON job file instead.')
+        
+        settings = yaml.safe_load(f)
+    else:
+        settings = json.load(f)
+    
+    f.close()
+    
+    job = make_job(mode=settings.get('mode', 'cl'),
+                   n_frames=settings.get('n_frames', 20),
+                   side_by_side=settings.get('side_by_side', False),
+                   stop_f=settings.get('restart', None),
+                   quality=settings.get('quality', 2),
+                   fname=settings.get('fname', None),
+                   pan1=settings.get('pan1', None),
+                   map_fname=settings.get('map_fname', None),
+                   n_procs=settings.get('n_procs', 10),
+                   route_kwargs=settings.get('route_kwargs', {}),
+                   stereo_pass=settings.get('stereo_pass', True))
+    
+    for key in ('plot_props', 'camera_props', 'label_props', 'render_kwargs'):
+        job[key].update(settings.get(key, {}))
+    
+    # Cameras that cover the whole sphere
+    camera_props = job['camera_props']
+    
+    if ( (camera_props['proj_name'] in ('equirectangular', 'equirect', 'ods'))
+         and ('fov' not in settings.get('camera_props', {})) ):
+        camera_props['fov'] = 360.
+    
+    if 'axis_on' in settings:
+        job['axis_on'] = settings['axis_on']
+    
+    return job
+
+
+def prompt_job():
+    '''
+    Ask for the render settings on the terminal.
+    '''
+    
+    stop_f = int(raw_input('Restart from frame number [0]') or 0)
+    if stop_f == 0:
+        stop_f = None
+    
+    try:
+        f = int(raw_input('How many frames in total?'))
+    except ValueError:
+        print('Not a number, default frame num as 20')
+        f = 20
+    
+    '''Set camera render mode'''
+    mode = str(raw_input('Which camera mode? [circle local(cl)|grand tour(gt)|local dust(ld)|nw-270(nw)]|equirectangular[eq]'))
+    b = raw_input('Render side-by-side? [y/n] ')
+    side_by_side = (str(b) == 'y')
+    
+    try:
+        q = int(raw_input('How good the quality is? [1 the lowest, 10 the highest]'))
+    except ValueError:
+        print('Not a number, default as 2')
+        q = 2
+    
+    return make_job(mode=mode, n_frames=f, side_by_side=side_by_side,
+                    stop_f=stop_f, quality=q)
@@ -24,38 +24,163 @@
 
 from PIL import Image, ImageFont, ImageDraw
 import numpy as np
-import scipy, scipy.misc
+import scipy, scipy.misc, scipy.ndimage
 
-from alpha import blend_images
+from collections import OrderedDict
 
+from alpha import blend_images, sprite_overlap
 
-def rasterize_text(canvas, txt, pos, font='fonts/cmunbx.ttf',
-                                     fontsize=24, fontcolor=(0,0,0),
-                                     stroke_width=0, stroke_color=(255,255,255),
-                                     stroke_angles=16, oversample=1,
-                                     ha='center', va='center'):
+
+# Fonts, by (filename, size), and rendered labels, by everything that
+# determines their appearance (see _label_sprite). Labels repeat from
+# frame to frame, so each worker process keeps the most recent ones.
+_font_cache = {}
+_sprite_cache = OrderedDict()
+sprite_cache_size = 1024
+
+
+def get_font(font, fontsize):
+    '''
+    Returns the PIL font of the given TrueType file and size, loading it
+    only the first time it is used.
+    '''
     
-    #fontcolor = [int(np.round(255.*f)) for f in fontcolor]
-    fontsize = int(round(oversample * fontsize))
-    stroke_width = oversample * stroke_width
+    key = (font, fontsize)
     
-    #tmp =  '\n --> Text: ' + txt.encode('utf-8').strip()
-    #tmp += '\n     stroke_width: %.3f' % stroke_width
-    #tmp += '\n'
-    #print tmp
+    if key not in _font_cache:
+        _font_cache[key] = ImageFont.truetype(font, fontsize)
     
-    # Determine oversampled image size
-    canvas_large = [oversample*c for c in canvas]
-    pos_large = np.array([oversample*p for p in pos]).astype('f8')
+    return _font_cache[key]
+
+
+def clear_caches():
+    _font_cache.clear()
+    _sprite_cache.clear()
+
+
+def stroke_footprint(stroke_width, n_angles=16):
+    '''
+    Returns a boolean array marking the offsets (dy, dx) of a stroke of
+    the given width, relative to the central pixel: the offsets to
+    <n_angles> points spaced evenly around a circle of radius
+    <stroke_width>, rounded to whole pixels.
+    '''
+    
+    theta = np.linspace(0., 2.*np.pi, n_angles)[::-1]
+    dy = np.round(np.cos(theta) * stroke_width).astype('i4')
+    dx = np.round(np.sin(theta) * stroke_width).astype('i4')
+    
+    r_max = max(np.max(np.abs(dy)), np.max(np.abs(dx)))
+    
+    footprint = np.zeros((2*r_max+1, 2*r_max+1), dtype=np.bool)
+    footprint[r_max+dy, r_max+dx] = True
+    footprint[r_max, r_max] = False
+    
+    return footprint
+
+
+def stroke_alpha(alpha, stroke_width):
+    '''
+    Opacity of a stroke of the given width around a glyph image, with
+    opacity <alpha>: the maximum of the glyph opacity at the offsets of
+    stroke_footprint, as a grey dilation. This is the outline that was
+    built by blending one shifted copy of the glyph per offset.
+    '''
+    
+    footprint = stroke_footprint(stroke_width)
+    
+    if not np.any(footprint):
+        return np.zeros(alpha.shape, dtype=alpha.dtype)
+    
+    # grey_dilation reflects the footprint, so the glyph at -offset
+    # lands on each pixel, as with np.roll(alpha, offset)
+    return scipy.ndimage.grey_dilation(alpha, footprint=footprint,
+                                       mode='constant', cval=0.)
+
+
+def _label_sprite(txt, font, fontsize, fontcolor, stroke_width, stroke_color):
+    '''
+    Returns an RGBA image (with straight alpha, indexed (y, x)) of a
+    stroked label, just large enough to hold it, and the offset of the
+    point at which the text is drawn within it.
+    '''
     
-    # Set up canvas and image renderer
-    image = Image.new('RGBA', canvas_large, (1,1,1,0))
-    img_font = ImageFont.truetype(font, fontsize)
+    key = (txt, font, fontsize, tuple(fontcolor),
+           stroke_width, tuple(stroke_color))
+    
+    if key in _sprite_cache:
+        sprite = _sprite_cache.pop(key)
+        _sprite_cache[key] = sprite
+        return sprite
+    
+    img_font = get_font(font, fontsize)
+    w, h = img_font.getsize(txt)
+    
+    # Margin for the stroke, and for glyphs that overhang their box
+    margin = 2 + int(np.ceil(stroke_width))
+    
+    image = Image.new('RGBA', (w+2*margin, h+2*margin), (1,1,1,0))
     d = ImageDraw.Draw(image)
     d.fontmode = 'L'
+    d.text((margin, margin), txt, (0,0,0), font=img_font)
+    
+    image = np.array(image).astype('f8') / 255.
+    
+    # Stroke text
+    bg = None
+    
+    if stroke_width > 0.:
+        bg = np.zeros(image.shape, dtype='f8')
+        bg[:,:,3] = stroke_alpha(image[:,:,3], stroke_width)
+        
+        for k in xrange(3):
+            bg[:,:,k] = stroke_color[k] / 255.
+        
+        idx = image[:,:,3] < 1. - 1.e-10
+        
+        if len(stroke_color) == 4:
+            bg[:,:,3] *= stroke_color[3] / 255.
+        
+        bg[:,:,3] *= idx.astype('f8')
+    
+    for k in xrange(3):
+        image[:,:,k] = fontcolor[k] / 255.
+    
+    if len(fontcolor) == 4:
+        image[:,:,3] *= fontcolor[3] / 255.
+    
+    if bg is not None:
+        image = blend_images(bg, image)
+    
+    sprite = (image, margin)
+    
+    _sprite_cache[key] = sprite
+    
+    while len(_sprite_cache) > sprite_cache_size:
+        _sprite_cache.popitem(last=False)
+    
+    return sprite
+
+
+def text_sprite(txt, pos, font='fonts/cmunbx.ttf',
+                          fontsize=24, fontcolor=(0,0,0),
+                          stroke_width=0, stroke_color=(255,255,255),
+                          ha='center', va='center'):
+    '''
+    Render a label, aligned to <pos>, into an RGBA image (with straight
+    alpha, indexed (x, y)) just large enough to hold it. Returns the
+    image, and the (x, y) position of its first pixel in the canvas.
+    
+    The stroke is a dilation of the text by <stroke_width> (see
+    stroke_alpha).
+    '''
+    
+    fontsize = int(round(fontsize))
+    pos = np.array(pos).astype('f8')
     
     # Handle alignment
-    w, h = d.textsize(txt, font=img_font)
+    img_font = get_font(font, fontsize)
+    w, h = img_font.getsize(txt)
     w_off, h_off = img_font.getoffset(txt)
     w -= w_off
     h -= h_off
@@ -82,58 +207,61 @@ def rasterize_text(canvas, txt, pos, font='fonts/cmunbx.ttf',
     offset[0] -= w_off
     offset[1] -= h_off
     
-    pos_large += offset
+    pos += offset
     
-    # Render text
-    x, y = pos_large
-    d.text((x, y), txt, (0,0,0), font=img_font)
+    # The stroke width is rounded to 1/8 of a pixel, so that labels
+    # at similar distances can be taken from the cache
+    stroke_width = np.round(8. * stroke_width) / 8.
     
-    image = np.array(image).astype('f8') / 255.
+    # Render the label (or take it from the cache). PIL draws the glyphs
+    # at whole pixels, truncating their position (the text position
+    # plus the offset).
+    sprite, margin = _label_sprite(txt, font, fontsize, fontcolor,
+                                   stroke_width, stroke_color)
     
-    # Stroke text
-    bg = None
+    x_0 = int(pos[0] + w_off) - w_off - margin
+    y_0 = int(pos[1] + h_off) - h_off - margin
     
-    if stroke_width > 1.e-5:
-        theta = np.linspace(0., 2.*np.pi, stroke_angles)[::-1]
-        dx = np.round(np.cos(theta) * stroke_width).astype('i4')
-        dy = np.round(np.sin(theta) * stroke_width).astype('i4')
-        
-        bg = np.zeros(image.shape, dtype='f8')
-        
-        for x,y in zip(dx, dy):
-            if (x == 0) and (y == 0):
-                continue
-            shift = np.roll(np.roll(image, x, axis=0), y, axis=1)
-            bg = blend_images(bg, shift, limit_alpha=True)
-        
-        for k in xrange(3):
-            bg[:,:,k] = stroke_color[k] / 255.
-        
-        idx = image[:,:,3] < 1. - 1.e-10
-        
-        if len(stroke_color) == 4:
-            bg[:,:,3] *= stroke_color[3] / 255.
-        
-        bg[:,:,3] *= idx.astype('f8')
-        #image[:,:,3] *= (~idx).astype('f8')
+    return np.swapaxes(sprite, 0, 1), (x_0, y_0)
+
+
+def rasterize_text(canvas, txt, pos, font='fonts/cmunbx.ttf',
+                                     fontsize=24, fontcolor=(0,0,0),
+                                     stroke_width=0, stroke_color=(255,255,255),
+                                     oversample=1,
+                                     ha='center', va='center'):
+    '''
+    Render a label onto an empty RGBA canvas of size <canvas> = (width,
+    height). Returns an image indexed (x, y). See text_sprite for a
+    version that only returns the pixels covered by the label.
+    '''
     
-    for k in xrange(3):
-        image[:,:,k] = fontcolor[k] / 255.
+    # Determine oversampled image size
+    canvas_large = [oversample*c for c in canvas]
+    pos_large = [oversample*p for p in pos]
     
-    if len(fontcolor) == 4:
-        image[:,:,3] *= fontcolor[3] / 255.
+    sprite, offset = text_sprite(txt, pos_large, font=font,
+                                 fontsize=oversample*fontsize,
+                                 fontcolor=fontcolor,
+                                 stroke_width=oversample*stroke_width,
+                                 stroke_color=stroke_color,
+                                 ha=ha, va=va)
     
-    if bg != None:
-        image = blend_images(bg, image)
+    image = np.zeros((canvas_large[0], canvas_large[1], 4), dtype='f8')
+    
+    overlap = sprite_overlap(image.shape[:2], sprite.shape[:2], offset)
+    
+    if overlap != None:
+        image[overlap[0]] = sprite[overlap[1]]
     
     # Downsample image
     if oversample != 1:
+        image = np.swapaxes(image, 0, 1)
         image = (255. * image).astype('i4')
         image = scipy.misc.imresize(image, canvas[::-1])
         #image = image.resize(canvas, Image.ANTIALIAS)
         image = image.astype('f8') / 255.
-    
-    image = np.swapaxes(image, 0, 1)
+        image = np.swapaxes(image, 0, 1)
     
     return image
 
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#  
+#  frame_writer.py
+#  
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#  
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#  
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#  
+#  
+
+'''
+Write rendered frames straight to disk, without going through a
+matplotlib figure, and draw simple overlays (dots and lines) on them
+with NumPy.
+'''
+
+import numpy as np
+
+from PIL import Image
+
+
+def to_rgb8(img):
+    '''
+    Convert a floating-point RGB(A) image, with values between 0 and 1,
+    to an 8-bit RGB image.
+    '''
+    
+    rgb = np.clip(img[:,:,:3], 0., 1.)
+    rgb *= 255.
+    rgb += 0.5
+    
+    return rgb.astype('u1')
+
+
+def resize_frame(rgb, size):
+    '''
+    Resize an 8-bit RGB image to <size> = (width, height) pixels.
+    '''
+    
+    size = (int(round(size[0])), int(round(size[1])))
+    
+    if size == (rgb.shape[1], rgb.shape[0]):
+        return rgb
+    
+    pimg = Image.fromarray(rgb, mode='RGB')
+    pimg = pimg.resize(size, Image.ANTIALIAS)
+    
+    return np.array(pimg)
+
+
+def write_frame(rgb, fname, fmt='png'):
+    '''
+    Write an 8-bit RGB image, either as a PNG ('png'), or as a raw
+    NumPy array of shape (height, width, 3) ('npy').
+    '''
+    
+    if fmt == 'png':
+        Image.fromarray(rgb, mode='RGB').save(fname, 'PNG')
+    elif fmt == 'npy':
+        np.save(fname, rgb)
+    else:
+        raise ValueError('Unrecognized frame format: "%s"' % fmt)
+
+
+def _blend_mask(rgb, mask, color, alpha):
+    a = alpha * mask[:,:,None]
+    
+    out = rgb.astype('f4')
+    out *= 1. - a
+    out += a * np.array(color, dtype='f4')[None,None,:]
+    out += 0.5
+    
+    rgb[:] = out.astype('u1')
+
+
+def _disc_mask(shape, x, y, radius):
+    '''
+    Coverage of the pixels in an image of the given shape by discs
+    of the given radius, centered on (x, y), supersampled 4x4 per
+    pixel so that the edges are smooth.
+    '''
+    
+    mask = np.zeros(shape, dtype='f4')
+    
+    x = np.atleast_1d(x)
+    y = np.atleast_1d(y)
+    
+    idx = np.isfinite(x) & np.isfinite(y)
+    x, y = x[idx], y[idx]
+    
+    r_pix = int(np.ceil(radius)) + 1
+    dy, dx = np.mgrid[-r_pix:r_pix+1, -r_pix:r_pix+1]
+    
+    # Sub-pixel offsets
+    sub = (np.arange(4) + 0.5) / 4. - 0.5
+    
+    # Footprint of each disc
+    i = np.floor(y).astype('i8')[:,None,None] + dy[None]
+    j = np.floor(x).astype('i8')[:,None,None] + dx[None]
+    
+    # Pixel centers are at half-integer coordinates
+    ry = (i + 0.5 - y[:,None,None])[...,None,None] + sub[:,None]
+    rx = (j + 0.5 - x[:,None,None])[...,None,None] + sub[None,:]
+    cover = np.mean((rx**2 + ry**2) <= radius**2, axis=(3,4))
+    
+    idx = (i >= 0) & (i < shape[0]) & (j >= 0) & (j < shape[1]) & (cover > 0.)
+    
+    np.maximum.at(mask, (i[idx], j[idx]), cover[idx].astype('f4'))
+    
+    return mask
+
+
+def draw_dots(rgb, x, y, radius, color, alpha=1.):
+    '''
+    Draw filled dots onto an 8-bit RGB image (in place). <x> and <y>
+    are in pixels, measured from the top left corner.
+    '''
+    
+    mask = _disc_mask(rgb.shape[:2], x, y, radius)
+    _blend_mask(rgb, mask, color, alpha)
+
+
+def draw_line(rgb, x, y, width, color, alpha=1.):
+    '''
+    Draw a line through the points (x, y) onto an 8-bit RGB image (in
+    place), with the given width in pixels.
+    '''
+    
+    x = np.asarray(x, dtype='f8')
+    y = np.asarray(y, dtype='f8')
+    
+    idx = np.isfinite(x) & np.isfinite(y)
+    x, y = x[idx], y[idx]
+    
+    if x.size == 0:
+        return
+    
+    # Resample the line, so that the dots are less than a quarter
+    # of a pixel apart (up to a limit, for lines running far off
+    # the image)
+    if x.size > 1:
+        ds = np.sqrt(np.diff(x)**2 + np.diff(y)**2)
+        s = np.hstack([0., np.cumsum(ds)])
+        n_s = min(max(int(4.*s[-1]), 2), 4*(rgb.shape[0]+rgb.shape[1]))
+        s_new = np.linspace(0., s[-1], n_s)
+        x = np.interp(s_new, s, x)
+        y = np.interp(s_new, s, y)
+    
+    mask = _disc_mask(rgb.shape[:2], x, y, 0.5*width)
+    _blend_mask(rgb, mask, color, alpha)
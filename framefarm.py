@@ -0,0 +1,406 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#  
+#  framefarm.py
+#  
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#  
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#  
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#  
+#  
+
+'''
+Render the frames of a job on several hosts at once.
+
+The frames are kept in an SQLite queue on storage shared by all the
+hosts. Every host loads the 3D map once, and then forks worker
+processes that pull frame numbers from the queue until it is empty:
+
+    python framefarm.py init farm.sqlite job.json
+    python framefarm.py work farm.sqlite --n-procs 8    (on each host)
+    python framefarm.py status farm.sqlite
+
+To test on a single machine, "local" sets up the queue and starts
+several hosts as local processes:
+
+    python framefarm.py local farm.sqlite job.json --n-hosts 2 --n-procs 2
+'''
+
+import os, sys, time
+import socket
+import sqlite3
+import json
+import argparse
+
+import multiprocessing
+
+import config, render3d
+import timing
+
+
+class FrameFarm:
+    '''
+    Queue of frames, stored in an SQLite database.
+    
+    Each frame is identified by its pass (the camera: 0 for a single
+    camera, 0 and 1 for the left and right cameras of a side-by-side
+    render) and its frame number. A frame is "pending" until a worker
+    claims it, and "done" once the job ledger shows that it has been
+    rendered. Frames that have been claimed for longer than
+    <stale_time> seconds, without being finished, are handed out again,
+    so that frames are not lost if a host dies.
+    
+    Every process opens its own connection to the database, and claims
+    are made inside an exclusive transaction. The shared filesystem
+    must support POSIX file locks.
+    '''
+    
+    def __init__(self, fname, stale_time=3600.):
+        self.fname = fname
+        self.stale_time = stale_time
+        
+        self._conn = None
+        self._pid = None
+    
+    def __getstate__(self):
+        # Connections cannot be shared between processes
+        return {'fname': self.fname, 'stale_time': self.stale_time}
+    
+    def __setstate__(self, state):
+        self.__init__(state['fname'], stale_time=state['stale_time'])
+    
+    def _connect(self):
+        if (self._conn == None) or (self._pid != os.getpid()):
+            self._conn = sqlite3.connect(self.fname, timeout=600.,
+                                         isolation_level=None)
+            self._pid = os.getpid()
+        
+        return self._conn
+    
+    def init(self, job_fname, frames, costs=None):
+        '''
+        Set up the queue for the given job file. <frames> contains a
+        list of the frames to render for each pass, and <costs> an
+        optional dictionary of estimated frame costs for each pass.
+        The most expensive frames are handed out first.
+        '''
+        
+        conn = self._connect()
+        
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute('DROP TABLE IF EXISTS job')
+        conn.execute('DROP TABLE IF EXISTS frames')
+        conn.execute('CREATE TABLE job (key TEXT PRIMARY KEY, value TEXT)')
+        conn.execute('CREATE TABLE frames ('
+                     'pass INTEGER, frame INTEGER, status TEXT, '
+                     'host TEXT, pid INTEGER, t_claim REAL, cost REAL, '
+                     'PRIMARY KEY (pass, frame))')
+        
+        job_info = {
+            'job_fname': os.path.abspath(job_fname),
+            't_init': time.time()
+        }
+        
+        for key, value in job_info.iteritems():
+            conn.execute('INSERT INTO job VALUES (?, ?)', (key, json.dumps(value)))
+        
+        for pass_idx, pass_frames in enumerate(frames):
+            cost = {} if costs == None else costs[pass_idx]
+            conn.executemany(
+                "INSERT INTO frames VALUES (?, ?, 'pending', NULL, NULL, NULL, ?)",
+                [(pass_idx, int(k), float(cost.get(k, 0.))) for k in pass_frames])
+        
+        conn.execute('COMMIT')
+    
+    def get_info(self, key):
+        row = self._connect().execute('SELECT value FROM job WHERE key = ?',
+                                      (key,)).fetchone()
+        
+        if row == None:
+            raise KeyError(key)
+        
+        return json.loads(row[0])
+    
+    def claim(self, pass_idx):
+        '''
+        Claim the next frame of a pass. Returns the frame number and
+        whether it was a stale claim, or (None, False) if there are
+        no frames left to hand out.
+        '''
+        
+        conn = self._connect()
+        t = time.time()
+        
+        conn.execute('BEGIN IMMEDIATE')
+        
+        try:
+            stale = False
+            row = conn.execute('SELECT frame FROM frames '
+                               "WHERE pass = ? AND status = 'pending' "
+                               'ORDER BY cost DESC, frame LIMIT 1',
+                               (pass_idx,)).fetchone()
+            
+            if row == None:
+                stale = True
+                row = conn.execute('SELECT frame FROM frames '
+                                   "WHERE pass = ? AND status = 'claimed' "
+                                   'AND t_claim < ? '
+                                   'ORDER BY t_claim LIMIT 1',
+                                   (pass_idx, t - self.stale_time)).fetchone()
+            
+            if row == None:
+                conn.execute('COMMIT')
+                return None, False
+            
+            k = row[0]
+            conn.execute("UPDATE frames SET status = 'claimed', "
+                         'host = ?, pid = ?, t_claim = ? '
+                         'WHERE pass = ? AND frame = ?',
+                         (socket.gethostname(), os.getpid(), t, pass_idx, k))
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        
+        return k, stale
+    
+    def set_status(self, pass_idx, k, status):
+        self._connect().execute('UPDATE frames SET status = ? '
+                                'WHERE pass = ? AND frame = ?',
+                                (status, pass_idx, int(k)))
+    
+    def count(self):
+        '''
+        Returns the number of frames in each pass with each status.
+        '''
+        
+        rows = self._connect().execute('SELECT pass, status, COUNT(*) '
+                                       'FROM frames GROUP BY pass, status')
+        
+        counts = {}
+        
+        for pass_idx, status, n in rows:
+            counts.setdefault(pass_idx, {})[status] = n
+        
+        return counts
+
+
+class FarmQueue:
+    '''
+    Hands out the frames of one pass of a FrameFarm to
+    render3d.gen_frame_worker(), in place of its multiprocessing.Queue:
+    get() returns the next frame, or None once all have been claimed.
+    The job ledger is used to find out which of the claimed frames have
+    been finished.
+    '''
+    
+    def __init__(self, farm, pass_idx, ledger, poses):
+        self.farm = farm
+        self.pass_idx = pass_idx
+        self.ledger = ledger
+        self.poses = poses
+        
+        self.current = None
+    
+    def _is_done(self, k):
+        latest, n_failed = self.ledger.load()
+        return self.ledger.is_done(latest.get(k), self.poses[k])
+    
+    def get(self):
+        # The previous frame has either been finished, or has failed
+        # too often to be retried
+        if self.current != None:
+            if self._is_done(self.current):
+                self.farm.set_status(self.pass_idx, self.current, 'done')
+            else:
+                self.farm.set_status(self.pass_idx, self.current, 'failed')
+        
+        self.current = None
+        
+        while True:
+            k, stale = self.farm.claim(self.pass_idx)
+            
+            if k == None:
+                return None
+            
+            # Stale claims may have been finished by a worker that was
+            # too slow, rather than by one that died
+            if stale and self._is_done(k):
+                self.farm.set_status(self.pass_idx, k, 'done')
+                continue
+            
+            self.current = k
+            return k
+
+
+def get_pending_frames(job):
+    '''
+    Returns the frames of each pass of a job that still have to be
+    rendered, according to the job ledgers, and their estimated costs.
+    '''
+    
+    frames, costs = [], []
+    labels = render3d.get_labels()
+    
+    # When restarting, the frames before "restart" are skipped
+    first_frame = job['stop_f'] or 0
+    
+    for plot_props, camera_pos in render3d.get_job_passes(job):
+        ledger, poses = render3d.get_frame_ledger(plot_props, camera_pos,
+                                                  job['camera_props'],
+                                                  ledger_fname=job['render_kwargs'].get('ledger_fname', None))
+        pass_frames = [k for k in ledger.pending_frames(poses) if k >= first_frame]
+        frames.append(pass_frames)
+        costs.append(render3d.estimate_frame_costs(pass_frames, camera_pos,
+                                                   job['camera_props'],
+                                                   plot_props, labels,
+                                                   ledger=ledger, poses=poses))
+    
+    return frames, costs
+
+
+def init_farm(farm, job_fname):
+    job = config.load_job(job_fname)
+    
+    frames, costs = get_pending_frames(job)
+    farm.init(job_fname, frames, costs=costs)
+    
+    for pass_idx, pass_frames in enumerate(frames):
+        print 'Pass %d: %d frames queued.' % (pass_idx, len(pass_frames))
+
+
+def work(farm, n_procs=None):
+    '''
+    Load the 3D map once, and render frames from the farm with
+    <n_procs> worker processes until there are none left.
+    '''
+    
+    job = config.load_job(farm.get_info('job_fname'))
+    t_init = farm.get_info('t_init')
+    
+    if n_procs == None:
+        n_procs = job['n_procs']
+    
+    kwargs = job['render_kwargs'].copy()
+    max_samples = kwargs.pop('max_samples', 5)
+    density_fname = kwargs.pop('density_fname', None)
+    sample_fname = kwargs.pop('sample_fname', None)
+    density_grid = render3d.density_grid_opts(kwargs.pop('density_grid', None),
+                                              job['plot_props'], n_procs=n_procs)
+    ledger_fname = kwargs.pop('ledger_fname', None)
+    kwargs['max_retries'] = kwargs.pop('max_retries', 2)
+    kwargs.pop('cost_probe', None)
+    
+    if kwargs.pop('video', False):
+        print 'Streaming to a video is not supported by the frame farm. Writing frames instead.'
+    
+    kwargs.pop('video_fps', None)
+    kwargs.pop('video_opts', None)
+    kwargs['verbose'] = True
+    
+    # Failures are counted since the farm was set up, by all hosts
+    kwargs['t_run'] = t_init
+    
+    mapper3d = render3d.load_mapper3d(job['map_fname'],
+                                      max_samples=max_samples,
+                                      density_fname=density_fname,
+                                      density_grid=density_grid,
+                                      reduction=job['plot_props'].get('reduction', 'sample'),
+                                      n_procs=n_procs,
+                                      sample_fname=sample_fname)
+    
+    labels = render3d.get_labels()
+    
+    for pass_idx, (plot_props, camera_pos) in enumerate(render3d.get_job_passes(job)):
+        ledger, poses = render3d.get_frame_ledger(plot_props, camera_pos,
+                                                  job['camera_props'],
+                                                  ledger_fname=ledger_fname)
+        frame_q = FarmQueue(farm, pass_idx, ledger, poses)
+        
+        kwargs['ledger'] = ledger
+        kwargs['poses'] = poses
+        
+        timing.set_context(render=render3d.get_fname_base(plot_props))
+        
+        render3d.run_frame_workers(mapper3d, frame_q, n_procs,
+                                   job['map_fname'], plot_props,
+                                   camera_pos, job['camera_props'],
+                                   job['label_props'], labels, job['axis_on'],
+                                   **kwargs)
+    
+    print 'Host %s finished.' % socket.gethostname()
+
+
+def print_status(farm):
+    for pass_idx, counts in sorted(farm.count().iteritems()):
+        txt = ', '.join(['%s: %d' % (s, n) for s, n in sorted(counts.iteritems())])
+        print 'Pass %d: %s' % (pass_idx, txt)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Render the frames of a job on several hosts.',
+        add_help=True)
+    parser.add_argument('command', type=str,
+                        choices=('init', 'work', 'local', 'status'),
+                        help='"init" sets up the queue for a job, "work" renders '
+                             'frames from the queue on this host, "local" does both, '
+                             'with several local hosts, and "status" shows the progress.')
+    parser.add_argument('farm', type=str,
+                        help='Queue database, on storage shared by all hosts.')
+    parser.add_argument('job', type=str, nargs='?', default=None,
+                        help='Job file (for "init" and "local").')
+    parser.add_argument('--n-procs', type=int, default=None,
+                        help='Worker processes per host (default: from the job file).')
+    parser.add_argument('--n-hosts', type=int, default=2,
+                        help='Number of local hosts to start (for "local").')
+    parser.add_argument('--stale-time', type=float, default=3600.,
+                        help='Seconds after which a claimed, unfinished frame is handed out again.')
+    args = parser.parse_args()
+    
+    farm = FrameFarm(args.farm, stale_time=args.stale_time)
+    
+    # Timing trace, shared by all hosts (see timing.py)
+    trace_fname = args.farm + '.trace.jsonl'
+    
+    if args.command in ('init', 'local'):
+        if args.job == None:
+            print 'A job file is required.'
+            return 1
+        
+        init_farm(farm, args.job)
+        timing.start_trace(trace_fname)
+    
+    if args.command == 'work':
+        timing.start_trace(trace_fname, append=True)
+        work(farm, n_procs=args.n_procs)
+    elif args.command == 'local':
+        # Each local "host" loads its own copy of the map
+        hosts = [multiprocessing.Process(target=work, args=(farm,),
+                                         kwargs={'n_procs': args.n_procs})
+                 for i in xrange(args.n_hosts)]
+        
+        for h in hosts:
+            h.start()
+        
+        for h in hosts:
+            h.join()
+    
+    if args.command in ('local', 'status'):
+        print_status(farm)
+    
+    return 0
+
+if __name__ == '__main__':
+    main()
@@ -492,6 +492,160 @@ class Stereographic_projection:
         return phi, lam, out_of_bounds
 
 
+def tangent_frame(phi_0, lam_0):
+    '''
+    Cartesian unit vectors pointing east, north and outwards at
+    latitude <phi_0> and longitude <lam_0> (in radians).
+    '''
+    
+    cp, sp = np.cos(phi_0), np.sin(phi_0)
+    cl, sl = np.cos(lam_0), np.sin(lam_0)
+    
+    east = np.array([-sl, cl, 0.])
+    north = np.array([-sp*cl, -sp*sl, cp])
+    centre = np.array([cp*cl, cp*sl, sp])
+    
+    return east, north, centre
+
+
+class Equirectangular_projection:
+    '''
+    Equirectangular projection of the whole sphere, centred on
+    (phi_0, lam_0). The projected coordinates are the longitude (x,
+    increasing to the east) and latitude (y) in radians, in a frame
+    rotated so that the centre lies on its equator, at zero longitude.
+    '''
+    
+    def __init__(self, phi_0=0., lam_0=180., fov=360.):
+        self.phi_0 = np.radians(phi_0)
+        self.lam_0 = np.radians(lam_0)
+        self.fov = np.radians(fov)
+        
+        self.frame = tangent_frame(self.phi_0, self.lam_0)
+    
+    def proj(self, phi, lam, ret_bounds=False):
+        p = np.array([np.cos(phi)*np.cos(lam), np.cos(phi)*np.sin(lam), np.sin(phi)])
+        east, north, centre = [np.tensordot(v, p, axes=1) for v in self.frame]
+        
+        x = np.arctan2(east, centre)
+        y = np.arcsin(np.clip(north, -1., 1.))
+        
+        if ret_bounds:
+            out_of_bounds = (np.abs(x) > 0.5*self.fov)
+            return x, y, out_of_bounds
+        
+        return x, y
+    
+    def cartesian(self, x, y):
+        '''
+        Cartesian unit vectors (shape (3, ...)) of the directions
+        projected to (x, y).
+        '''
+        
+        east, north, centre = self.frame
+        cy = np.cos(y)
+        
+        d = np.sin(x) * cy
+        p = np.einsum('d,...->d...', east, d)
+        p += np.einsum('d,...->d...', north, np.sin(y))
+        p += np.einsum('d,...->d...', centre, np.cos(x) * cy)
+        
+        return p
+    
+    def inv(self, x, y):
+        p = self.cartesian(x, y)
+        
+        phi = np.arcsin(np.clip(p[2], -1., 1.))
+        lam = np.arctan2(p[1], p[0])
+        
+        out_of_bounds = (np.abs(x) > 0.5*self.fov) | (np.abs(y) > 0.5*np.pi)
+        
+        return phi, lam, out_of_bounds
+
+
+class Cubemap_projection:
+    '''
+    Projection of the whole sphere onto the six faces of a cube, centred
+    on (phi_0, lam_0). The faces are laid out in two rows of three:
+        
+        right  left   up
+        down   front  back
+    
+    where "front" faces (phi_0, lam_0), "up" is north of it and "right"
+    is to the west, as seen from inside the sphere. The top and bottom
+    faces are oriented as seen when tilting the head up or down from
+    the front face. Each face is two units wide, so that the projected
+    coordinates cover -3 < x < 3 (increasing to the east, i.e., from
+    right to left in the layout) and -2 < y < 2.
+    '''
+    
+    # Forward, rightward and upward directions of each face, in terms
+    # of the (east, north, centre) directions of the front face
+    faces = np.array([
+        [[-1, 0, 0], [0, 0, -1], [0, 1, 0]],    # right
+        [[ 1, 0, 0], [0, 0,  1], [0, 1, 0]],    # left
+        [[ 0, 1, 0], [-1, 0, 0], [0, 0, -1]],   # up
+        [[ 0,-1, 0], [-1, 0, 0], [0, 0, 1]],    # down
+        [[ 0, 0, 1], [-1, 0, 0], [0, 1, 0]],    # front
+        [[ 0, 0,-1], [ 1, 0, 0], [0, 1, 0]]     # back
+    ], dtype='f8')
+    
+    def __init__(self, phi_0=0., lam_0=180.):
+        self.phi_0 = np.radians(phi_0)
+        self.lam_0 = np.radians(lam_0)
+        
+        self.frame = np.array(tangent_frame(self.phi_0, self.lam_0))
+    
+    def proj(self, phi, lam, ret_bounds=False):
+        p = np.array([np.cos(phi)*np.cos(lam), np.cos(phi)*np.sin(lam), np.sin(phi)])
+        d = np.tensordot(self.frame, p, axes=1)
+        
+        # The face a direction falls on is the one it is most aligned with
+        dot = np.tensordot(self.faces[:,0], d, axes=1)
+        face = np.argmax(dot, axis=0)
+        
+        fwd, right, up = [np.sum(np.moveaxis(self.faces[face,k], -1, 0) * d, axis=0)
+                          for k in xrange(3)]
+        s = right / fwd
+        t = up / fwd
+        
+        x = -(2*(face % 3) - 2 + s)
+        y = 1 - 2*(face // 3) + t
+        
+        if ret_bounds:
+            return x, y, np.zeros(x.shape, dtype=np.bool)
+        
+        return x, y
+    
+    def cartesian(self, x, y):
+        '''
+        Cartesian unit vectors (shape (3, ...)) of the directions
+        projected to (x, y).
+        '''
+        
+        col = np.clip(np.floor((3. - x) / 2.), 0, 2).astype('i4')
+        row = np.clip(np.floor((2. - y) / 2.), 0, 1).astype('i4')
+        
+        s = 2 - 2*col - x
+        t = y - 1 + 2*row
+        
+        f = self.faces[3*row + col]
+        d = f[...,0,:] + s[...,None] * f[...,1,:] + t[...,None] * f[...,2,:]
+        d /= np.sqrt(np.sum(d**2, axis=-1))[...,None]
+        
+        return np.einsum('...d,dn->n...', d, self.frame)
+    
+    def inv(self, x, y):
+        p = self.cartesian(x, y)
+        
+        phi = np.arcsin(np.clip(p[2], -1., 1.))
+        lam = np.arctan2(p[1], p[0])
+        
+        out_of_bounds = (np.abs(x) > 3.) | (np.abs(y) > 2.)
+        
+        return phi, lam, out_of_bounds
+
+
 def Euler_rotation_vec(x, y, z, alpha, beta, gamma, inverse=False):
     if inverse:
         alpha *= -1.
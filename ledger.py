@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#  
+#  ledger.py
+#  
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#  
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#  
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#  
+#  
+
+import numpy as np
+
+import os, sys, time
+import json
+import hashlib
+import socket
+import fcntl
+
+
+def pose_hash(xyz, alpha, beta, camera_props=None):
+    '''
+    Hash of a camera position/orientation (and, optionally, of the
+    camera properties), used to check that a finished frame was
+    rendered from the same viewpoint as the one requested.
+    '''
+    
+    pose = [float(x) for x in np.ravel(xyz)] + [float(alpha), float(beta)]
+    txt = ' '.join(['%.6g' % p for p in pose])
+    
+    if camera_props != None:
+        txt += ' ' + repr(sorted(camera_props.items()))
+    
+    return hashlib.sha1(txt).hexdigest()
+
+
+def file_checksum(fname, block_size=2**20):
+    '''
+    MD5 checksum of a file.
+    '''
+    
+    md5 = hashlib.md5()
+    
+    with open(fname, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            
+            if not block:
+                break
+            
+            md5.update(block)
+    
+    return md5.hexdigest()
+
+
+class FrameLedger:
+    '''
+    Persistent record of the status of every frame in a render,
+    stored as a JSON-lines file (usually next to the output frames).
+    
+    Each line records one event for one frame:
+        
+        {"frame": k, "status": "started"|"done"|"failed",
+         "pose": <pose hash>, "fname": <output file(s)>,
+         "checksum": <MD5 of output(s)>, "t": <seconds>, ...}
+    
+    Lines are only ever appended, under an exclusive lock, so several
+    worker processes (or hosts sharing a filesystem) can write to the
+    same ledger. The latest line for a frame determines its status.
+    '''
+    
+    def __init__(self, fname):
+        self.fname = fname
+    
+    def record(self, k, status, **info):
+        '''
+        Append a status line for frame <k>.
+        '''
+        
+        entry = {
+            'frame': int(k),
+            'status': status,
+            'time': time.time(),
+            'host': socket.gethostname(),
+            'pid': os.getpid()
+        }
+        entry.update(info)
+        
+        line = json.dumps(entry) + '\n'
+        
+        with open(self.fname, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write(line)
+            f.flush()
+            fcntl.flock(f, fcntl.LOCK_UN)
+    
+    def load(self, since=None):
+        '''
+        Returns a dictionary containing the latest entry for each
+        frame, and a dictionary containing the number of times each
+        frame has failed (counting only failures after the time
+        <since>, if given).
+        '''
+        
+        latest = {}
+        n_failed = {}
+        
+        if not os.path.isfile(self.fname):
+            return latest, n_failed
+        
+        with open(self.fname, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Partially written line from a crashed process
+                    continue
+                
+                k = entry['frame']
+                latest[k] = entry
+                
+                if entry['status'] != 'failed':
+                    continue
+                
+                if (since == None) or (entry['time'] >= since):
+                    n_failed[k] = n_failed.get(k, 0) + 1
+        
+        return latest, n_failed
+    
+    def is_done(self, entry, pose, verify=True):
+        '''
+        Check whether a ledger entry describes a finished frame with
+        the given pose hash. If <verify> is True, the output file must
+        also exist and match the recorded checksum.
+        '''
+        
+        if (entry == None) or (entry['status'] != 'done'):
+            return False
+        
+        if entry.get('pose') != pose:
+            return False
+        
+        if verify:
+            fname = entry.get('fname')
+            checksum = entry.get('checksum')
+            
+            if fname == None:
+                return False
+            
+            # Frames can consist of several files (e.g., stereo pairs)
+            if type(fname) is not list:
+                fname, checksum = [fname], [checksum]
+            
+            for f, c in zip(fname, checksum):
+                if not os.path.isfile(f):
+                    return False
+                
+                if file_checksum(f) != c:
+                    return False
+        
+        return True
+    
+    def pending_frames(self, poses, verify=True):
+        '''
+        Returns the indices of the frames that still have to be
+        rendered, given the pose hash of every frame. This includes
+        frames that failed, or whose worker died, in earlier runs.
+        '''
+        
+        latest, n_failed = self.load()
+        
+        return [k for k, pose in enumerate(poses)
+                if not self.is_done(latest.get(k), pose, verify=verify)]
+    
+    def n_failures(self, k, since=None):
+        return self.load(since=since)[1].get(k, 0)
+    
+    def frame_times(self, poses):
+        '''
+        Returns the most recent time taken to render each frame, for
+        the frames that have been finished before with the same pose.
+        '''
+        
+        t = {}
+        
+        if not os.path.isfile(self.fname):
+            return t
+        
+        with open(self.fname, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                
+                k = entry['frame']
+                
+                if ( (entry['status'] == 'done') and ('t' in entry) and
+                     (k < len(poses)) and (entry.get('pose') == poses[k]) ):
+                    t[k] = entry['t']
+        
+        return t
+
+
+def main():
+    '''
+    Print a summary of a ledger.
+    '''
+    
+    if len(sys.argv) != 2:
+        print 'Usage: %s ledger.jsonl' % sys.argv[0]
+        return 1
+    
+    latest, n_failed = FrameLedger(sys.argv[1]).load()
+    
+    status = {}
+    
+    for k, entry in latest.iteritems():
+        status.setdefault(entry['status'], []).append(k)
+    
+    for s, frames in sorted(status.iteritems()):
+        print '%8s: %d frames' % (s, len(frames))
+    
+    if n_failed:
+        print 'Failures:', ', '.join(['%d (x%d)' % (k, n) for k, n in sorted(n_failed.iteritems())])
+    
+    return 0
+
+if __name__ == '__main__':
+    main()
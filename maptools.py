@@ -25,6 +25,7 @@
 
 import numpy as np
 from scipy.ndimage.filters import gaussian_filter
+from scipy.ndimage import map_coordinates
 
 import matplotlib as mplib
 #mplib.use('Agg')
@@ -36,9 +37,14 @@ import healpy as hp
 import h5py
 
 import os, sys, glob, time
+import socket
+import json
 
 import multiprocessing
+import threading
+import collections
 import Queue
+import traceback
 
 import hputils
 
@@ -1125,7 +1131,7 @@ def take_measure_nd(x, method, axis=1):
     if method == 'median':
         return np.median(xp, axis=0)
     elif method == 'mean':
-        return np.mean(EBV, axis=0)
+        return np.mean(xp, axis=0)
     elif method == 'sample':
         n_samples = xp.shape[0]
         n_pix = xp.shape[1]
@@ -1142,6 +1148,185 @@ def take_measure_nd(x, method, axis=1):
         raise ValueError('method not implemented: "%s"' % (str(method)))
 
 
+def measure_name(method):
+    '''
+    The name of the field that holds the statistic <method> in the
+    result of take_measures: the method itself, or the percentile as
+    a string (e.g., '84.13').
+    '''
+    
+    if isinstance(method, basestring):
+        return method
+    
+    return '%g' % method
+
+
+def measure_percentiles(method):
+    '''
+    The percentiles needed to compute the statistic <method> (see
+    take_measures).
+    '''
+    
+    if method == 'mean':
+        return []
+    elif method == 'median':
+        return [50.]
+    elif method == 'sigma':
+        return [15.87, 84.13]
+    elif isinstance(method, (float, int)) and not isinstance(method, bool):
+        return [float(method)]
+    
+    raise ValueError('method not implemented: "%s"' % (str(method)))
+
+
+def take_measures(x, methods, axis=1, n_procs=1, block_size=None):
+    '''
+    Reduce <x> over the sample axis <axis> by each of the statistics in
+    <methods> ('mean', 'median', 'sigma', or a percentile, or a list of
+    them), in a single pass over the samples. Returns a structured array,
+    with one field per statistic (see measure_name), and the shape of
+    <x> without <axis>. The percentiles of entries with any non-finite
+    sample are NaN (as np.percentile gives for NaN samples).
+    
+    The samples are partitioned once, at all the percentiles needed,
+    in blocks of <block_size> entries along the first remaining axis
+    (by default, about 16 MB of <x>). With <n_procs> > 1, the blocks
+    are shared out between processes, which write into shared memory.
+    '''
+    
+    x = np.moveaxis(x, axis, 1)
+    
+    if np.isscalar(methods):
+        methods = [methods]
+    
+    # Check the methods before handing out any blocks, and compute
+    # each statistic once
+    names = [measure_name(m) for m in methods]
+    methods = [m for k,m in enumerate(methods) if measure_name(m) not in names[:k]]
+    
+    for m in methods:
+        measure_percentiles(m)
+    
+    n = x.shape[0]
+    shape = (n,) + x.shape[2:]
+    
+    dtype = np.result_type(x.dtype, 'f4')
+    dtype = [(measure_name(m), dtype) for m in methods]
+    
+    if block_size == None:
+        block_size = max(1, 2**24 / max(1, x[0].nbytes))
+    
+    if (n_procs <= 1) or (n <= block_size):
+        out = np.empty(shape, dtype=dtype)
+        
+        for s_idx in xrange(0, n, block_size):
+            measure_block(x[s_idx:s_idx+block_size], methods, out[s_idx:s_idx+block_size])
+        
+        return out
+    
+    buf = multiprocessing.RawArray('b', int(np.prod(shape)) * np.dtype(dtype).itemsize)
+    out = np.frombuffer(buf, dtype=dtype).reshape(shape)
+    
+    block_q = multiprocessing.Queue()
+    
+    for s_idx in xrange(0, n, block_size):
+        block_q.put(s_idx)
+    
+    procs = []
+    
+    for i in xrange(n_procs):
+        p = multiprocessing.Process(target=measure_worker,
+                                    args=(x, methods, out, block_size, block_q))
+        p.daemon = True
+        procs.append(p)
+        
+        block_q.put('STOP')
+    
+    for p in procs:
+        p.start()
+    
+    for p in procs:
+        p.join()
+    
+    if any([p.exitcode != 0 for p in procs]):
+        raise RuntimeError('Failed to reduce the map over the samples.')
+    
+    return out
+
+
+def measure_block(x, methods, out):
+    '''
+    Write the statistics <methods> of the block <x>, indexed by
+    (entry, sample, ...), into the structured array <out> (see
+    take_measures).
+    '''
+    
+    n_samples = x.shape[1]
+    
+    # Interpolate linearly between the order statistics, as np.percentile
+    rank = {}
+    
+    for p in set(sum([measure_percentiles(m) for m in methods], [])):
+        k = p / 100. * (n_samples - 1)
+        k_0 = int(np.floor(k))
+        rank[p] = (k_0, min(k_0 + 1, n_samples - 1), k - k_0)
+    
+    if len(rank):
+        kth = sorted(set(sum([list(r[:2]) for r in rank.values()], [])))
+        x_part = np.partition(x, kth, axis=1)
+        
+        # np.partition sorts NaNs last, which would turn the entries
+        # that have any into finite, biased values
+        bad = ~np.all(np.isfinite(x), axis=1)
+        
+        if not np.any(bad):
+            bad = None
+    
+    def percentile(p):
+        k_0, k_1, w = rank[p]
+        x_p = x_part[:,k_0] * (1. - w) + x_part[:,k_1] * w
+        
+        if bad is not None:
+            x_p[bad] = np.nan
+        
+        return x_p
+    
+    for m in methods:
+        if m == 'mean':
+            out[measure_name(m)] = np.mean(x, axis=1)
+        elif m == 'sigma':
+            out[measure_name(m)] = 0.5 * (percentile(84.13) - percentile(15.87))
+        else:
+            out[measure_name(m)] = percentile(measure_percentiles(m)[0])
+
+
+def measure_worker(x, methods, out, block_size, block_q):
+    '''
+    Reduce the blocks of <x> starting at the indices taken from
+    <block_q>, into <out> (see take_measures).
+    '''
+    
+    while True:
+        s_idx = block_q.get()
+        
+        if s_idx == 'STOP':
+            return
+        
+        measure_block(x[s_idx:s_idx+block_size], methods, out[s_idx:s_idx+block_size])
+
+
+def reduce_in_blocks(x, method, n_procs=1, block_size=None):
+    '''
+    Like take_measure_nd(<x>, <method>), for <x> indexed by (pixel,
+    sample, distance) and any of the statistics of take_measures, but
+    reduced in blocks of pixels, by <n_procs> processes.
+    '''
+    
+    out = take_measures(x, [method], n_procs=n_procs, block_size=block_size)
+    
+    return out[measure_name(method)]
+
+
 ####################################################################################
 #
 # LOS Mapper
@@ -1300,16 +1485,20 @@ class LOSMapper:
             
             EBV /= np.abs(delta_mu)
         
-        # Mask regions with high uncertainty
-        if mask_sigma != None:
-            sigma = take_measure(EBV, 'sigma')
-            mask_idx = (sigma > mask_sigma)
+        # Reduce EBV in each pixel to one value, together with its
+        # uncertainty, in one pass over the samples (without the best fit)
+        methods = [method] if (mask_sigma == None) else [method, 'sigma']
+        
+        if method in ('best', 'sample'):
+            measures = dict([(measure_name(m), take_measure(EBV, m)) for m in methods])
+        else:
+            measures = take_measures(EBV[:, 1:], methods)
         
-        # Reduce EBV in each pixel to one value
-        EBV = take_measure(EBV, method)
+        EBV = np.array(measures[measure_name(method)])
         
+        # Mask regions with high uncertainty
         if mask_sigma != None:
-            EBV[mask_idx] = np.nan
+            EBV[measures['sigma'] > mask_sigma] = np.nan
         
         if reduce_nside:
             # Reduce to one HEALPix nside resolution
@@ -1363,6 +1552,13 @@ class LOSMapper:
 ####################################################################################
 
 class Mapper3D:
+    # Density resampled onto a Cartesian grid (see use_grid)
+    grid = None
+    
+    # Number of reductions of the map kept in memory (see reduce_map)
+    reduction_cache_size = 4
+    _reductions = None
+    
     #def __init__(self, data):
     def __init__(self, nside, pix_idx, los_EBV, DM_min, DM_max,
                        remove_nan=True, keep_cumulative=False):
@@ -1370,12 +1566,7 @@ class Mapper3D:
         
         # Calculate the density of the map in every voxel,
         # indexed by (pixel, sample, distance)
-        self.n_dist_bins = los_EBV.shape[2]
-        self.DM_min, self.DM_max = DM_min, DM_max
-        self.dDM = (self.DM_max - self.DM_min) / float(self.n_dist_bins - 1)
-        
-        mu = np.linspace(self.DM_min, self.DM_max, self.n_dist_bins)
-        r = np.power(10., mu/5. + 1.)
+        r = self._init_dist_bins(los_EBV.shape[2], DM_min, DM_max)
         dr = np.hstack([r[0], np.diff(r)])
         
         E0 = los_EBV[:,:,0]
@@ -1397,11 +1588,29 @@ class Mapper3D:
                 idx = ~np.isfinite(self.cumulative)
                 self.cumulative[idx] = 0.
         
+        self._init_pixel_map(nside, pix_idx)
+    
+    def _init_dist_bins(self, n_dist_bins, DM_min, DM_max):
+        '''
+        Set up the distance binning of the map. Returns the
+        distance (in pc) of each distance bin.
+        '''
+        
+        self.n_dist_bins = n_dist_bins
+        self.DM_min, self.DM_max = DM_min, DM_max
+        self.dDM = (self.DM_max - self.DM_min) / float(self.n_dist_bins - 1)
+        
+        mu = np.linspace(self.DM_min, self.DM_max, self.n_dist_bins)
+        
+        return np.power(10., mu/5. + 1.)
+    
+    def _init_pixel_map(self, nside, pix_idx):
         # Calculate a mapping from a nested healpix index
         # (at the highest resolution present in the map) to
         # the index of the pixel in the map
         
         self.nside_max = np.max(nside)
+        self.pix_nside = np.asarray(nside)
         n_hires = hp.pixelfunc.nside2npix(self.nside_max)
         self.hires2mapidx = np.empty(n_hires, dtype='i8')
         self.hires2mapidx[:] = -1
@@ -1419,6 +1628,315 @@ class Mapper3D:
         
         #print '%d < hires2mapidx < %d' % (np.min(self.hires2mapidx), np.max(self.hires2mapidx))
     
+    def _reduced_map(self, reduction, cumulative=False):
+        '''
+        Reduce the map over the sample axis, returning an object
+        that can be indexed by (pixel index, distance bin).
+        '''
+        
+        map_val = self.reduce_map(reduction, cumulative=cumulative)
+        
+        if cumulative:
+            return map_val
+        
+        return self._with_grid(map_val, reduction)
+    
+    def reduce_map(self, reduction, cumulative=False, n_procs=1):
+        '''
+        Returns the density (or the cumulative reddening) reduced over
+        the sample axis by <reduction>, indexed by (pixel index,
+        distance bin). Reductions other than 'sample' always give the
+        same map, so they are computed once (in blocks of pixels, by
+        <n_procs> processes), and the last <reduction_cache_size> of
+        them are kept. The kept maps are read-only, so that they are
+        shared by the worker processes forked afterwards.
+        '''
+        
+        if reduction == 'sample':
+            x = self.cumulative if cumulative else self.density
+            return take_measure_nd(x, reduction)
+        
+        if self._reductions == None:
+            self._reductions = collections.OrderedDict()
+        
+        key = (reduction, cumulative)
+        map_val = self._reductions.pop(key, None)
+        
+        if map_val is None:
+            map_val = self._compute_reduction(reduction, cumulative, n_procs)
+            
+            while len(self._reductions) >= max(self.reduction_cache_size, 1):
+                self._reductions.popitem(last=False)
+        
+        if self.reduction_cache_size > 0:
+            self._reductions[key] = map_val
+        
+        return map_val
+    
+    def _compute_reduction(self, reduction, cumulative, n_procs):
+        x = self.cumulative if cumulative else self.density
+        
+        map_val = reduce_in_blocks(x, reduction, n_procs=n_procs)
+        map_val.flags.writeable = False
+        
+        return map_val
+    
+    def _with_grid(self, map_val, reduction):
+        '''
+        Pair the reduced map with the density grid, if there is one with
+        the same reduction, so that the grid is used where it reaches.
+        '''
+        
+        if (self.grid != None) and (self.grid.reduction == reduction):
+            return GriddedMap(self.grid, map_val)
+        
+        return map_val
+    
+    def use_grid(self, grid):
+        '''
+        Render from the DensityGrid or BrickVolume <grid> (see
+        resample_to_grid and build_bricks) where it covers the map,
+        whenever the reduction of the map is the same as that of the
+        grid. Set to None to stop.
+        '''
+        
+        self.grid = grid
+    
+    def resample_to_grid(self, r_max, spacing, reduction='sample',
+                               oversample=1, verbose=False):
+        '''
+        Returns the density, reduced over the samples by <reduction>,
+        on a DensityGrid of cubic voxels of side <spacing> (in pc),
+        reaching out to (at least) <r_max> pc from the Sun along each
+        axis. Each voxel is the mean of <oversample>^3 points.
+        '''
+        
+        n = int(np.ceil(2. * r_max / spacing))
+        r_max = 0.5 * n * spacing
+        
+        # Resample the map itself, not a grid already in use
+        grid, self.grid = self.grid, None
+        map_val = self._reduced_map(reduction)
+        self.grid = grid
+        
+        x = -r_max + spacing * (np.arange(n) + 0.5)
+        dx = spacing * ((np.arange(oversample) + 0.5) / oversample - 0.5)
+        
+        X, Y = np.meshgrid(x, x, indexing='ij')
+        pos = np.empty((3, n, n), dtype='f8')
+        density = np.zeros((n, n, n), dtype='f4')
+        
+        for k in xrange(n):
+            if verbose and (k % max(1, n/20) == 0):
+                sys.stdout.write('>')
+                sys.stdout.flush()
+            
+            for ox in dx:
+                for oy in dx:
+                    for oz in dx:
+                        pos[0] = X + ox
+                        pos[1] = Y + oy
+                        pos[2] = x[k] + oz
+                        density[:,:,k] += self._calc_slice(map_val, pos)
+        
+        if verbose:
+            sys.stdout.write('\n')
+        
+        density /= float(oversample**3)
+        
+        return DensityGrid(density, r_max, spacing, reduction)
+    
+    def build_bricks(self, r_max, spacing, reduction='sample',
+                           n_levels=5, brick_size=8, n_procs=1,
+                           verbose=False):
+        '''
+        Returns the density, reduced over the samples by <reduction>,
+        in a BrickVolume reaching out to (at least) <r_max> pc from the
+        Sun along each axis. Each brick holds <brick_size>^3 voxels
+        (<brick_size> must be a power of two). The finest voxels have
+        side <spacing> (in pc), and each of the <n_levels> levels of
+        bricks doubles it. Bricks are subdivided
+        until their voxels are no larger than the cells of the map they
+        cover, and bricks without dust are left out. The top-level
+        bricks are shared out between <n_procs> processes.
+        '''
+        
+        B = brick_size
+        
+        if B & (B-1):
+            raise ValueError('brick_size must be a power of two.')
+        
+        n_top = int(np.ceil(2. * r_max / (B * spacing * 2**(n_levels-1))))
+        r_max = 0.5 * n_top * B * spacing * 2**(n_levels-1)
+        geom = (r_max, float(spacing), B)
+        
+        # Resample the map itself, not a grid already in use
+        grid, self.grid = self.grid, None
+        map_val = self._reduced_map(reduction)
+        self.grid = grid
+        
+        # The bricks closest to the Sun are subdivided the most, so
+        # they are handed out first
+        tops = list(np.ndindex(n_top, n_top, n_top))
+        tops.sort(key=lambda ijk: np.sum((np.array(ijk) + 0.5 - 0.5*n_top)**2))
+        tops = [(n_levels-1, ijk) for ijk in tops]
+        
+        bricks = []
+        
+        if n_procs <= 1:
+            for k,(level,ijk) in enumerate(tops):
+                if verbose and (k % max(1, len(tops)/20) == 0):
+                    sys.stdout.write('>')
+                    sys.stdout.flush()
+                
+                bricks += self._brick_tree(map_val, geom, level, ijk)
+        else:
+            task_q = multiprocessing.JoinableQueue()
+            output_q = multiprocessing.Queue()
+            
+            for top in tops:
+                task_q.put(top)
+            
+            procs = []
+            
+            for i in xrange(n_procs):
+                p = multiprocessing.Process(target=brick_worker,
+                                            args=(self, map_val, geom,
+                                                  task_q, output_q))
+                p.daemon = True
+                procs.append(p)
+                
+                task_q.put('STOP')
+            
+            for p in procs:
+                p.start()
+            
+            n_proc_done = 0
+            n_tops_done = 0
+            n_failed = 0
+            
+            while n_proc_done < n_procs:
+                ret = output_q.get()
+                
+                if ret == 'DONE':
+                    n_proc_done += 1
+                    continue
+                elif ret == 'FAILED':
+                    n_failed += 1
+                    continue
+                
+                if verbose and (n_tops_done % max(1, len(tops)/20) == 0):
+                    sys.stdout.write('>')
+                    sys.stdout.flush()
+                
+                n_tops_done += 1
+                bricks += ret
+            
+            for p in procs:
+                p.join()
+            
+            if n_failed:
+                raise RuntimeError('%d of %d top-level bricks failed to build.'
+                                   % (n_failed, len(tops)))
+        
+        if verbose:
+            sys.stdout.write('\n')
+        
+        # Link each brick to its parent, from the top level down
+        pool, children = [], []
+        top = -np.ones((n_top, n_top, n_top), dtype='i4')
+        node = {}
+        
+        bricks.sort(key=lambda b: -b[0])
+        
+        for level,ijk,values in bricks:
+            if values is None:
+                node[(level, ijk)] = -2 - len(children)
+                children.append(-np.ones(8, dtype='i4'))
+            else:
+                node[(level, ijk)] = len(pool)
+                pool.append(values)
+            
+            i,j,k = ijk
+            
+            if level == n_levels-1:
+                top[i,j,k] = node[(level, ijk)]
+            else:
+                parent = node[(level+1, (i/2, j/2, k/2))]
+                children[-2-parent][((i%2)*2 + j%2)*2 + k%2] = node[(level, ijk)]
+        
+        pool = np.array(pool, dtype='f4').reshape(-1, B+1, B+1, B+1)
+        children = np.array(children, dtype='i4').reshape(-1, 8)
+        
+        return BrickVolume(pool, top, children, r_max, spacing, reduction,
+                           n_levels)
+    
+    def _brick_tree(self, map_val, geom, level, ijk):
+        '''
+        Returns the bricks, as (level, index, density at the corners of
+        the voxels), that fill brick <ijk> of level <level>. Subdivided
+        bricks are listed with None as their density, and empty bricks
+        are left out.
+        '''
+        
+        r_max, spacing, B = geom
+        h = spacing * 2**level
+        lo = np.array(ijk) * B * h - r_max
+        
+        if level > 0:
+            # The voxels should not be larger than the map cells, which
+            # are smallest at the point of the brick closest to the Sun
+            pos = np.indices((3, 3, 3)).reshape(3, -1) * (0.5*B*h)
+            pos += lo[:,None]
+            
+            r_min = np.sqrt(np.sum(np.clip(0., lo, lo + B*h)**2))
+            
+            if h > self._cell_size(pos, r_min):
+                ret = []
+                
+                for d in np.ndindex(2, 2, 2):
+                    child = tuple([2*i + di for i,di in zip(ijk, d)])
+                    ret += self._brick_tree(map_val, geom, level-1, child)
+                
+                if len(ret):
+                    ret.append((level, ijk, None))
+                
+                return ret
+        
+        pos = np.indices((B+1, B+1, B+1)) * h
+        pos += lo[:,None,None,None]
+        
+        # The brick around the Sun has a corner on it
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values = self._calc_slice(map_val, pos).astype('f4')
+        
+        if not np.any(values != 0.):
+            return []
+        
+        return [(level, ijk, values)]
+    
+    def _cell_size(self, pos, r):
+        '''
+        Returns the side (in pc) of a cube with the volume of the
+        smallest map cell (HEALPix pixel times distance bin) at distance
+        <r>, among the pixels that contain the positions <pos> (shape
+        (3, n)). Returns infinity if none of them is in the map.
+        '''
+        
+        with np.errstate(divide='ignore', invalid='ignore'):
+            map_idx = self.Cartesian2idx(*pos)
+        
+        map_idx = map_idx[map_idx >= 0]
+        
+        if map_idx.size == 0:
+            return np.inf
+        
+        nside = np.max(self.pix_nside[map_idx])
+        omega = hp.pixelfunc.nside2pixarea(nside)
+        dr = r * np.log(10.) / 5. * self.dDM
+        
+        return (omega * r**2 * dr)**(1./3.)
+    
     def Cartesian2idx(self, x, y, z):
         '''
         Convert from a heliocentric position (x, y, z) to
@@ -1559,6 +2077,120 @@ class Mapper3D:
         
         return pos, ray_dir * ray_step
     
+    def _pixel_grid(self, n_x, n_y, randomize_ang=False):
+        '''
+        Pixel offsets from the centre of an image of (2*n_y+1, 2*n_x+1)
+        pixels, optionally jittered by up to one pixel.
+        '''
+        
+        XY = np.indices([2*n_y+1, 2*n_x+1]).astype('f8')
+        XY[0] -= n_y
+        XY[1] -= n_x
+        
+        if randomize_ang:
+            XY += 2. * (np.random.random(XY.shape) - 0.5)
+        
+        return XY
+    
+    def _unit_sphere(self, proj, x, y, r_0, ray_step, dist_init,
+                           eye_offset=None):
+        '''
+        Rays in the directions projected to (x, y) by <proj> (see
+        hputils). If given, <eye_offset> is a function of the unit ray
+        directions that returns the offset of the start of each ray
+        from <r_0> (e.g., for omni-directional stereo).
+        '''
+        
+        ray_dir = proj.cartesian(x, y)
+        
+        pos = np.empty(ray_dir.shape, dtype='f8')
+        
+        for i in xrange(3):
+            pos[i,:,:] = r_0[i]
+        
+        if eye_offset != None:
+            pos += eye_offset(ray_dir)
+        
+        pos += ray_dir * dist_init
+        
+        return pos, ray_dir * ray_step
+    
+    def _unit_equirect(self, alpha, beta, n_x, n_y,
+                             fov, r_0, ray_step, dist_init,
+                             randomize_ang=False, eye_offset=None):
+        '''
+        Rays of an equirectangular camera, centred on (alpha, beta). The
+        image spans <fov> degrees in longitude (360 for the whole
+        sphere) and fov*n_y/n_x degrees in latitude.
+        '''
+        
+        XY = self._pixel_grid(n_x, n_y, randomize_ang=randomize_ang)
+        
+        x = np.radians(fov) / (2.*n_x+1.) * XY[1]
+        y = -np.radians(fov * float(n_y) / float(n_x)) / (2.*n_y+1.) * XY[0]
+        
+        proj = hputils.Equirectangular_projection(phi_0=90.-alpha, lam_0=beta, fov=fov)
+        
+        return self._unit_sphere(proj, x, y, r_0, ray_step, dist_init,
+                                 eye_offset=eye_offset)
+    
+    def _unit_cubemap(self, alpha, beta, n_x, n_y,
+                            fov, r_0, ray_step, dist_init,
+                            randomize_ang=False, eye_offset=None):
+        '''
+        Rays of a cube map of the whole sphere, with the front face
+        towards (alpha, beta), laid out in two rows of three faces
+        (see hputils.Cubemap_projection). <fov> is ignored.
+        '''
+        
+        XY = self._pixel_grid(n_x, n_y, randomize_ang=randomize_ang)
+        
+        x = 6. / (2.*n_x+1.) * XY[1]
+        y = -4. / (2.*n_y+1.) * XY[0]
+        
+        proj = hputils.Cubemap_projection(phi_0=90.-alpha, lam_0=beta)
+        
+        return self._unit_sphere(proj, x, y, r_0, ray_step, dist_init,
+                                 eye_offset=eye_offset)
+    
+    def _unit_ods(self, alpha, beta, n_x, n_y,
+                        fov, r_0, ray_step, dist_init,
+                        randomize_ang=False, ipd=10.):
+        '''
+        Rays of an omni-directional stereo (ODS) camera: two
+        equirectangular images, for the left eye (top half of the
+        image) and the right eye (bottom half), each spanning <fov>
+        degrees in longitude and 180 degrees in latitude.
+        
+        Every ray starts on a horizontal circle of diameter <ipd> (in pc)
+        around <r_0>, tangent to the circle, so that each column of the
+        panorama is seen with the correct parallax.
+        '''
+        
+        XY = self._pixel_grid(n_x, n_y, randomize_ang=randomize_ang)
+        
+        x = np.radians(fov) / (2.*n_x+1.) * XY[1]
+        y = -2. / (2.*n_y+1.) * XY[0]
+        
+        # Left eye in the top half, right eye in the bottom half
+        left = (y > 0.)
+        y = np.pi * (y + np.where(left, -0.5, 0.5))
+        
+        proj = hputils.Equirectangular_projection(phi_0=90.-alpha, lam_0=beta, fov=fov)
+        north = proj.frame[1]
+        sign = np.where(left, 0.5*ipd, -0.5*ipd)
+        
+        def eye_offset(ray_dir):
+            # The left eye is displaced along north x ray, to the left of the ray
+            d = np.cross(north, ray_dir, axis=0)
+            norm = np.sqrt(np.sum(d**2., axis=0))
+            norm[norm < 1.e-10] = 1.
+            
+            return d * (sign / norm)[None]
+        
+        return self._unit_sphere(proj, x, y, r_0, ray_step, dist_init,
+                                 eye_offset=eye_offset)
+    
     def _dist2bin(self, r):
         '''
         Convert from distance (in pc) to the lower distance bin index.
@@ -1592,9 +2224,14 @@ class Mapper3D:
                           mask=False,
                           interpolate=False,
                           add_DM=-1.):
+        if isinstance(map_val, GriddedMap):
+            return self._calc_slice_grid(map_val, pos, mask=mask,
+                                         interpolate=interpolate,
+                                         add_DM=add_DM)
+        
         map_idx, dist_bin, a_interp, r = self._pos2map(pos)
         
-        idx = (map_idx != -1) & (dist_bin >= 0) & (dist_bin < self.density.shape[2])
+        idx = (map_idx != -1) & (dist_bin >= 0) & (dist_bin < self.n_dist_bins)
         
         if np.sum(~idx) != 0:
             map_idx[~idx] = -1
@@ -1630,40 +2267,99 @@ class Mapper3D:
         
         return m
     
-    def proj_map_in_slices(self, camera, steps, reduction, *args, **kwargs): #alpha, beta, n_x, n_y, n_z, scale):
-        verbose = kwargs.pop('verbose', False)
-        mask = kwargs.pop('mask', False)
-        cumulative = kwargs.pop('cumulative', False)
-        add_DM = kwargs.pop('add_DM', -1.)
-        stack = kwargs.pop('stack', 'all')
-        randomize_dist = kwargs.pop('randomize_dist', False)
+    def _calc_slice_grid(self, map_val, pos, **kwargs):
+        '''
+        Like _calc_slice, but interpolated from the density grid inside
+        it, and looked up in the reduced map outside.
+        '''
         
-        if verbose:
-            t_start = time.time()
-            print '[.....................]',
-            print '\b'*23,
+        # The grid only holds the density
+        if kwargs['mask'] or kwargs['interpolate'] or (kwargs['add_DM'] > 0.):
+            return self._calc_slice(map_val.map_val, pos, **kwargs)
         
-        map_val = None
+        coords, inside = map_val.grid.coords(pos)
         
-        if cumulative:
-            map_val = take_measure_nd(self.cumulative, reduction)
-        else:
-            map_val = take_measure_nd(self.density, reduction)
+        if np.all(inside):
+            return map_val.grid.sample(coords)
+        elif not np.any(inside):
+            return self._calc_slice(map_val.map_val, pos, **kwargs)
         
+        m = np.empty(pos.shape[1:], dtype=map_val.dtype)
+        m[inside] = map_val.grid.sample(coords[:,inside])
+        m[~inside] = self._calc_slice(map_val.map_val, pos[:,~inside], **kwargs)
+        
+        return m
+    
+    def _camera_rays(self, camera, *args, **kwargs):
         if camera in ('orthographic', 'ortho'):
-            pos, u = self._unit_ortho(*args, **kwargs)
-            #pos, u = self._unit_ortho(alpha, beta, n_x, n_y, n_z)
+            return self._unit_ortho(*args, **kwargs)
         elif camera in ('gnomonic', 'pinhole', 'rectilinear'):
-            pos, u = self._unit_pinhole(*args, **kwargs)
+            return self._unit_pinhole(*args, **kwargs)
         elif camera in ('stereographic', 'stereo'):
-            pos, u = self._unit_stereo(*args, **kwargs)
+            return self._unit_stereo(*args, **kwargs)
+        elif camera in ('equirectangular', 'equirect'):
+            return self._unit_equirect(*args, **kwargs)
+        elif camera in ('cubemap', 'cube'):
+            return self._unit_cubemap(*args, **kwargs)
+        elif camera in ('ods',):
+            return self._unit_ods(*args, **kwargs)
         else:
             raise ValueError('Unrecognized camera: "%s"\n'
-                             '(choose from "orthographic", "gnomonic" or "stereographic")' % camera)
+                             '(choose from "orthographic", "gnomonic", "stereographic", '
+                             '"equirectangular", "cubemap" or "ods")' % camera)
+    
+    def _march_slices(self, map_val, pos, u, img,
+                            i_start, i_end, stack,
+                            mask=False, interpolate=False, add_DM=-1.,
+                            img_offset=0, verbose=False):
+        '''
+        Add up samples <i_start> through <i_end>-1 along the rays, into
+        the stacked images in <img>. Sample i is taken between steps
+        i-1 and i along the rays (the first two samples both lie in the
+        first step), and goes into image (i // stack) - <img_offset>.
+        '''
+        
+        n_per_tick = int((i_end-i_start-1) / 20)
+        n_per_tick = max(1, n_per_tick)
+        
+        for i in xrange(i_start, i_end):
+            if verbose:
+                if (i-i_start) % n_per_tick == 0:
+                    sys.stdout.write('>')
+                    sys.stdout.flush()
+            
+            kf = np.float(max(i-1, 0)) + np.random.random(u.shape)
+            
+            img[i / stack - img_offset] += self._calc_slice(map_val, pos+kf*u,
+                                                            mask=(mask and (i == 0)),
+                                                            interpolate=interpolate,
+                                                            add_DM=add_DM)
+    
+    def proj_map_in_slices(self, camera, steps, reduction, *args, **kwargs): #alpha, beta, n_x, n_y, n_z, scale):
+        verbose = kwargs.pop('verbose', False)
+        mask = kwargs.pop('mask', False)
+        cumulative = kwargs.pop('cumulative', False)
+        add_DM = kwargs.pop('add_DM', -1.)
+        stack = kwargs.pop('stack', 'all')
+        randomize_dist = kwargs.pop('randomize_dist', False)
+        map_val = kwargs.pop('map_val', None)
+        
+        if verbose:
+            t_start = time.time()
+            print '[.....................]',
+            print '\b'*23,
+        
+        # The reduced map can be passed in, to share it between renders
+        if map_val is None:
+            map_val = self._reduced_map(reduction, cumulative=cumulative)
+        
+        pos, u = self._camera_rays(camera, *args, **kwargs)
         
         n_images = 1
         
-        if stack != 'all':
+        if stack == 'all':
+            stack = steps
+        else:
             n_images = steps / stack + (1 if steps % stack else 0)
         
         #print 'n_images:', n_images
@@ -1673,59 +2369,210 @@ class Mapper3D:
         shape = (n_images, u.shape[1], u.shape[2])
         img = np.zeros(shape, dtype=map_val.dtype)
         
-        kf = np.random.random(u.shape)
-        img[0] = self._calc_slice(map_val, pos+kf*u,
-                                  mask=mask,
-                                  interpolate=cumulative,
-                                  add_DM=add_DM)
+        self._march_slices(map_val, pos, u, img, 0, steps, stack,
+                           mask=mask, interpolate=cumulative,
+                           add_DM=add_DM, verbose=verbose)
         
-        n_per_tick = int((steps-1) / 20)
-        n_per_tick = max(1, n_per_tick)
+        #img /= float(steps)
         
-        img_idx = 0
+        if verbose:
+            dt = time.time() - t_start
+            sys.stdout.write('] %.1f s \n' % dt)
+            sys.stdout.flush()
         
-        for k in xrange(steps-1):
-            if verbose:
-                if k % n_per_tick == 0:
-                    sys.stdout.write('>')
-                    sys.stdout.flush()
+        
+        return img
+    
+    def proj_stereo_pair(self, steps, reduction, args_left, args_right,
+                               parallax=1., **kwargs):
+        '''
+        Render the images seen by the left and right eyes of a pair of
+        stereographic cameras, sharing work between the eyes.
+        
+        <args_left> and <args_right> are the arguments (alpha, beta,
+        n_x, n_y, fov, r_0, ray_step, dist_init) of each camera. Both
+        eyes use the same reduced map (and so see the same samples). The
+        slices near the cameras are rendered separately for each eye,
+        but beyond the distance at which the view from each eye differs
+        from the view from the point midway between the eyes by less
+        than <parallax> pixels, the slices are rendered only once, from
+        the midpoint, and then resampled into the view of each eye. The
+        default of one pixel is the same as the jitter applied to the
+        rays by <randomize_ang>. Set <parallax> to zero to render each
+        eye separately.
+        
+        Takes the same keyword arguments as proj_map_in_slices (with
+        the exception of "mask", "cumulative" and "add_DM").
+        Returns the image stacks of the left and right eyes.
+        '''
+        
+        verbose = kwargs.pop('verbose', False)
+        stack = kwargs.pop('stack', 'all')
+        randomize_dist = kwargs.pop('randomize_dist', False)
+        randomize_ang = kwargs.pop('randomize_ang', False)
+        map_val = kwargs.pop('map_val', None)
+        
+        if verbose:
+            t_start = time.time()
+            print '[.....................]',
+            print '\b'*23,
+        
+        if map_val is None:
+            map_val = self._reduced_map(reduction)
+        
+        alpha_L, beta_L, n_x, n_y, fov, r_L, ray_step, dist_init = args_left
+        alpha_R, beta_R = args_right[:2]
+        r_R = args_right[5]
+        
+        n_images = 1
+        
+        if stack == 'all':
+            stack = steps
+        else:
+            n_images = steps / stack + (1 if steps % stack else 0)
+        
+        # Distance beyond which the parallax of each eye (relative to
+        # the midpoint) is below threshold, rounded up to the next full
+        # stacked image
+        R_max = 1. / np.tan(np.radians(180.-fov/2.) / 2.)
+        pix_angle = 2. * R_max / float(n_x)
+        baseline = np.sqrt(np.sum((np.array(r_L) - np.array(r_R))**2))
+        
+        if parallax > 0.:
+            d_far = 0.5 * baseline / (parallax * pix_angle)
+            i_far = int(np.ceil((d_far - dist_init) / ray_step)) + 1
+            i_far = max(i_far, 0)
+            n_near = min(i_far / stack + (1 if i_far % stack else 0), n_images)
+        else:
+            n_near = n_images
+        
+        i_far = min(n_near * stack, steps)
+        
+        img = []
+        
+        for args in (args_left, args_right):
+            pos, u = self._unit_stereo(*args, randomize_ang=randomize_ang)
             
-            if stack != 'all':
-                if (k+1) % stack == 0:
-                    img_idx += 1
+            img_eye = np.zeros((n_images, u.shape[1], u.shape[2]), dtype=map_val.dtype)
+            self._march_slices(map_val, pos, u, img_eye, 0, i_far, stack,
+                               verbose=verbose)
+            img.append(img_eye)
+        
+        if n_near < n_images:
+            # Distant slices, rendered from the midpoint of the eyes, along
+            # the mean direction of the eyes, with a field of view wide
+            # enough to cover both eyes
+            dir_L = self._view_dir(alpha_L, beta_L)
+            dir_R = self._view_dir(alpha_R, beta_R)
+            dir_mid = dir_L + dir_R
+            dir_mid /= np.sqrt(np.sum(dir_mid**2))
             
-            kf = np.float(k) + np.random.random(u.shape)
+            alpha_mid = np.degrees(np.arccos(dir_mid[2]))
+            beta_mid = np.degrees(np.arctan2(dir_mid[1], dir_mid[0]))
             
-            #pos += u
-            img[img_idx] += self._calc_slice(map_val, pos+kf*u,
-                                             interpolate=cumulative,
-                                             add_DM=add_DM)
+            toe_in = np.degrees(np.arccos(np.clip(np.dot(dir_L, dir_R), -1., 1.)))
+            fov_mid = fov + toe_in
+            R_max_mid = 1. / np.tan(np.radians(180.-fov_mid/2.) / 2.)
             
-            #print ''
-            #print 'x'
-            #print pos[0]
-            #print ''
-            #print 'y'
-            #print pos[1]
-            #print ''
-            #print 'z'
-            #print pos[2]
-            #print ''
-        
-        #img /= float(steps)
+            # Keep the same pixel scale as the eyes
+            n_x_mid = int(np.ceil(n_x * R_max_mid / R_max)) + 1
+            n_y_mid = int(np.ceil(n_y * R_max_mid / R_max)) + 1
+            fov_mid = 360. - 4.*np.degrees(np.arctan(1. / (R_max * n_x_mid / float(n_x))))
+            R_max_mid = R_max * n_x_mid / float(n_x)
+            
+            r_mid = 0.5 * (np.array(r_L) + np.array(r_R))
+            
+            pos, u = self._unit_stereo(alpha_mid, beta_mid, n_x_mid, n_y_mid,
+                                       fov_mid, r_mid, ray_step, dist_init,
+                                       randomize_ang=randomize_ang)
+            
+            img_far = np.zeros((n_images-n_near, u.shape[1], u.shape[2]), dtype=map_val.dtype)
+            self._march_slices(map_val, pos, u, img_far, i_far, steps, stack,
+                               img_offset=n_near, verbose=verbose)
+            
+            # Resample into the view of each eye
+            for img_eye, args in zip(img, (args_left, args_right)):
+                pos, u = self._unit_stereo(*args)
+                
+                # Rotate ray directions into the frame of the middle camera
+                u /= np.sqrt(np.sum(u**2, axis=0))[None]
+                rot = self._rot_matrix(alpha_mid, beta_mid)
+                xyz = np.einsum('dn,dij->nij', rot, u)
+                
+                # Inverse stereographic projection, to pixel coordinates
+                XY = xyz[:2] / (1. + xyz[2])[None]
+                XY *= float(n_x_mid) / R_max_mid
+                XY[0] += n_y_mid
+                XY[1] += n_x_mid
+                
+                for k in xrange(n_images-n_near):
+                    img_eye[n_near+k] = map_coordinates(img_far[k], XY,
+                                                        order=1, mode='nearest')
         
         if verbose:
             dt = time.time() - t_start
-            logfile=open('log.txt', 'a')
-            logfile.write('%0.2f '%dt)
             sys.stdout.write('] %.1f s \n' % dt)
             sys.stdout.flush()
-            logfile.close()
+        
+        return img[0], img[1]
+    
+    def _rot_matrix(self, alpha, beta):
+        '''
+        Rotation from camera to Cartesian coordinates, for a camera
+        pointing towards (alpha, beta), as used by _unit_stereo.
+        '''
+        
+        ca, sa = np.cos(np.radians(alpha)), np.sin(np.radians(alpha))
+        cb, sb = np.cos(np.radians(beta)), np.sin(np.radians(beta))
+        
+        return np.array([[ca*cb, -sb, sa*cb],
+                         [ca*sb,  cb, sa*sb],
+                         [  -sa,   0, ca]])
+    
+    def _view_dir(self, alpha, beta):
+        return self._rot_matrix(alpha, beta)[:,2]
+    
+    def _camera_pixels(self, camera, alpha, beta, n_x, n_y, fov, ray_dir):
+        '''
+        Pixel coordinates (row, column, in the images returned by
+        proj_map_in_slices) at which a camera sees the unit directions
+        <ray_dir> (shape (3, ...)). The inverse of _camera_rays.
+        '''
+        
+        if camera in ('stereographic', 'stereo', 'gnomonic', 'pinhole', 'rectilinear'):
+            # Rotate into the frame of the camera
+            rot = self._rot_matrix(alpha, beta)
+            xyz = np.einsum('dn,d...->n...', rot, ray_dir)
+            
+            if camera in ('stereographic', 'stereo'):
+                R_max = 1. / np.tan(np.radians(180.-fov/2.) / 2.)
+                scale = float(n_x) / R_max / (1. + xyz[2])
+            else:
+                dr = float(n_x) / np.tan(np.radians(0.5*fov))
+                scale = (1. + dr) / xyz[2]
+                scale[xyz[2] <= 0.] = np.nan
             
+            return xyz[0]*scale + n_y, xyz[1]*scale + n_x
         
-        #print 'img_idx:', img_idx
+        phi = np.arcsin(np.clip(ray_dir[2], -1., 1.))
+        lam = np.arctan2(ray_dir[1], ray_dir[0])
         
-        return img
+        if camera in ('equirectangular', 'equirect'):
+            proj = hputils.Equirectangular_projection(phi_0=90.-alpha, lam_0=beta, fov=fov)
+            x, y = proj.proj(phi, lam)
+            
+            x *= (2.*n_x+1.) / np.radians(fov)
+            y *= (2.*n_y+1.) / np.radians(fov * float(n_y) / float(n_x))
+        elif camera in ('cubemap', 'cube'):
+            proj = hputils.Cubemap_projection(phi_0=90.-alpha, lam_0=beta)
+            x, y = proj.proj(phi, lam)
+            
+            x *= (2.*n_x+1.) / 6.
+            y *= (2.*n_y+1.) / 4.
+        else:
+            raise ValueError('Cannot reproject into camera "%s"' % camera)
+        
+        return n_y - y, x + n_x
     
     def _grid_ortho(self, alpha, beta, n_x, n_y, n_z):
         '''
@@ -1775,7 +2622,1111 @@ class Mapper3D:
         img = np.sum(map_val[map_idx, dist_bin] * idx, axis=2)
         
         return img
+
+
+####################################################################################
+#
+# Cartesian density grid
+#
+#   The density of the map, resampled onto a regular grid around the Sun,
+#   so that it can be interpolated without HEALPix lookups.
+#
+####################################################################################
+
+class DensityGrid:
+    '''
+    The density of a map (reduced over the samples by <reduction>), on
+    a grid of cubic voxels of side <spacing> (in pc), centred on the
+    Sun and reaching out to <r_max> pc along each axis. The density is
+    indexed by (x, y, z), and interpolated trilinearly between the
+    centres of the voxels (<order> = 1), or taken from the nearest
+    voxel (<order> = 0, which is several times faster).
+    '''
+    
+    def __init__(self, density, r_max, spacing, reduction, order=1):
+        self.density = density
+        self.r_max = float(r_max)
+        self.spacing = float(spacing)
+        self.reduction = reduction
+        self.order = order
+    
+    def coords(self, pos):
+        '''
+        Returns the grid coordinates of the positions <pos> (shape
+        (3, ...)), and which of them lie inside the grid.
+        '''
+        
+        coords = (pos + self.r_max) / self.spacing - 0.5
+        n = self.density.shape[0]
+        inside = np.all((coords >= 0.) & (coords <= n-1.), axis=0)
+        
+        return coords, inside
+    
+    def sample(self, coords):
+        if self.order == 0:
+            n = self.density.shape[0]
+            idx = np.rint(coords).astype(np.intp)
+            np.clip(idx, 0, n-1, out=idx)
+            return self.density.ravel()[(idx[0]*n + idx[1])*n + idx[2]]
+        
+        return map_coordinates(self.density, coords, order=self.order, mode='nearest')
+    
+    def save(self, fname):
+        f = h5py.File(fname, 'w')
+        dset = f.create_dataset('density', data=self.density, chunks=True)
+        dset.attrs['r_max'] = self.r_max
+        dset.attrs['spacing'] = self.spacing
+        dset.attrs['reduction'] = str(self.reduction)
+        f.close()
+
+
+def load_density_grid(fname, order=1):
+    '''
+    Load a DensityGrid saved with DensityGrid.save().
+    '''
+    
+    f = h5py.File(fname, 'r')
+    dset = f['density']
+    
+    reduction = dset.attrs['reduction']
+    
+    try:
+        reduction = float(reduction)
+    except ValueError:
+        pass
+    
+    grid = DensityGrid(dset[:], dset.attrs['r_max'], dset.attrs['spacing'], reduction,
+                       order=order)
+    f.close()
+    
+    return grid
+
+
+class GriddedMap:
+    '''
+    A reduced map, indexed by (pixel index, distance bin), together
+    with the DensityGrid (or BrickVolume) that replaces it where the
+    grid reaches.
+    '''
+    
+    def __init__(self, grid, map_val):
+        self.grid = grid
+        self.map_val = map_val
+        self.dtype = map_val.dtype
+
+
+####################################################################################
+#
+# Sparse brick volume
+#
+#   The density of the map in an octree of small bricks of voxels, which
+#   follow the resolution of the map and leave out empty space.
+#
+####################################################################################
+
+class BrickVolume:
+    '''
+    The density of a map (reduced over the samples by <reduction>), in
+    an octree of bricks of voxels around the Sun, reaching out to
+    <r_max> pc along each axis. A brick of level l (of <n_levels>) holds
+    the density at the corners of its B^3 voxels of side
+    <spacing> * 2^l (in pc), so that it can be interpolated trilinearly
+    without looking at the neighbouring bricks. The bricks are stacked
+    in <pool>, with shape (bricks, B+1, B+1, B+1).
+    
+    The nodes of the tree are coded as the index of a brick in <pool>,
+    -1 for empty space, or -2-c for a brick subdivided into the eight
+    nodes <children>[c] (ordered by the octant x, y, z). <top> holds the
+    nodes of the top level, indexed by (x, y, z).
+    '''
+    
+    def __init__(self, pool, top, children, r_max, spacing, reduction,
+                       n_levels):
+        self.pool = pool
+        self.top = top
+        self.children = children
+        self.r_max = float(r_max)
+        self.spacing = float(spacing)
+        self.reduction = reduction
+        self.n_levels = n_levels
+        self.brick_size = pool.shape[1] - 1
+        self.brick_bits = int(np.log2(self.brick_size))
+    
+    def coords(self, pos):
+        '''
+        Returns the positions <pos> (shape (3, ...)), and which of them
+        lie inside the volume.
+        '''
+        
+        inside = np.all(np.abs(pos) < self.r_max, axis=0)
+        
+        return pos, inside
+    
+    def sample(self, pos):
+        B = self.brick_size
+        b = self.brick_bits
+        shape = pos.shape[1:]
+        pos = pos.reshape(3, -1) + self.r_max
+        
+        # Index of the finest voxel containing each position
+        n = self.top.shape[0]
+        v = np.floor(pos / self.spacing).astype('i4')
+        np.clip(v, 0, (n << (b + self.n_levels - 1)) - 1, out=v)
+        
+        level = self.n_levels - 1
+        ijk = v >> (b + level)
+        node = self.top.ravel()[(ijk[0]*n + ijk[1])*n + ijk[2]]
+        
+        m = np.zeros(pos.shape[1], dtype='f4')
+        active = np.arange(pos.shape[1])
+        
+        # Descend the tree, until every position has been found in a
+        # brick, or in empty space
+        while True:
+            leaf = (node >= 0)
+            
+            if np.any(leaf):
+                a = active[leaf]
+                idx = v.take(a, axis=1) >> level
+                u = pos.take(a, axis=1) / (self.spacing * 2**level) - idx
+                
+                m[a] = self._interpolate(node[leaf], idx & (B-1), u)
+            
+            inner = (node < -1)
+            
+            if (level == 0) or not np.any(inner):
+                break
+            
+            level -= 1
+            active = active[inner]
+            
+            octant = (v.take(active, axis=1) >> (b + level)) & 1
+            octant = (octant[0]*2 + octant[1])*2 + octant[2]
+            node = self.children[-2-node[inner], octant]
+        
+        return m.reshape(shape)
+    
+    def _interpolate(self, brick, idx, u):
+        '''
+        Trilinearly interpolate the bricks <brick> between the corners
+        <idx> and <idx>+1, at the fractions <u> of a voxel.
+        '''
+        
+        n = self.brick_size + 1
+        flat = self.pool.ravel()
+        base = ((brick*n + idx[0])*n + idx[1])*n + idx[2]
+        u = u.astype('f4')
+        
+        # Interpolate along z (neighbouring corners in memory), then y,
+        # then x
+        m = []
+        
+        for offset in (0, n, n*n, n*n+n):
+            m_0 = flat[base + offset]
+            m.append(m_0 + u[2] * (flat[base + offset + 1] - m_0))
+        
+        m_0 = m[0] + u[1] * (m[1] - m[0])
+        m_1 = m[2] + u[1] * (m[3] - m[2])
+        
+        return m_0 + u[0] * (m_1 - m_0)
+    
+    def save(self, fname):
+        f = h5py.File(fname, 'w')
+        dset = f.create_dataset('bricks', data=self.pool, chunks=True)
+        dset.attrs['r_max'] = self.r_max
+        dset.attrs['spacing'] = self.spacing
+        dset.attrs['reduction'] = str(self.reduction)
+        dset.attrs['n_levels'] = self.n_levels
+        f.create_dataset('top', data=self.top)
+        f.create_dataset('children', data=self.children)
+        f.close()
+
+
+def load_brick_volume(fname):
+    '''
+    Load a BrickVolume saved with BrickVolume.save().
+    '''
+    
+    f = h5py.File(fname, 'r')
+    dset = f['bricks']
+    
+    reduction = dset.attrs['reduction']
+    
+    try:
+        reduction = float(reduction)
+    except ValueError:
+        pass
+    
+    volume = BrickVolume(dset[:], f['top'][:], f['children'][:],
+                         dset.attrs['r_max'], dset.attrs['spacing'],
+                         reduction, int(dset.attrs['n_levels']))
+    f.close()
+    
+    return volume
+
+
+def brick_worker(mapper3d, map_val, geom, task_q, output_q):
+    '''
+    Build the bricks below the top-level bricks taken from <task_q>,
+    and put them on <output_q> (see Mapper3D.build_bricks), or 'FAILED'
+    if a brick could not be built.
+    '''
+    
+    while True:
+        task = task_q.get()
+        
+        if task == 'STOP':
+            output_q.put('DONE')
+            task_q.task_done()
+            return
+        
+        level, ijk = task
+        
+        try:
+            output_q.put(mapper3d._brick_tree(map_val, geom, level, ijk))
+        except Exception:
+            traceback.print_exc()
+            output_q.put('FAILED')
+        
+        task_q.task_done()
+
+
+####################################################################################
+#
+# Temporal reprojection
+#
+#   Reuses the image stacks of the previous frame along a camera route,
+#   reprojected into the view of the next frame.
+#
+####################################################################################
+
+class TemporalCache:
+    '''
+    Keeps the image stack (one image per stacked slab of ray steps) of
+    the last frame rendered with render(), and reprojects it into the
+    camera of the next frame.
+    
+    The centre of each slab of the new camera is projected into the
+    old camera, and the old stack is interpolated there (in pixel and
+    distance). This is exact for a camera that only turns. A camera
+    that moves sees each slab at a slightly different angle; the slab
+    is reused where the ends of the old and new slabs are less than
+    <tolerance> pixels apart, which holds beyond a distance that grows
+    with the step of the camera. The slabs nearer than that, and the
+    pixels whose slabs fall outside the old view (or that have been
+    reprojected <max_age> times in a row), are ray-marched again.
+    
+    The age is kept for every slab of every pixel, as the near slabs of
+    a moving camera come from other pixels of the old view than the far
+    ones.
+    
+    With the 'sample' reduction, the slabs that are marched again must
+    come from the same sample of the map as the ones that are
+    reprojected, so one sample is drawn whenever the cache starts over
+    (for a new camera, or after reset), and kept until then.
+    '''
+    
+    # Cameras that can be reprojected (see Mapper3D._camera_pixels)
+    cameras = ('stereographic', 'stereo', 'gnomonic', 'pinhole', 'rectilinear',
+               'equirectangular', 'equirect', 'cubemap', 'cube')
+    
+    def __init__(self, tolerance=0.5, max_age=8):
+        self.tolerance = tolerance
+        self.max_age = max_age
+        self.reset()
+    
+    def reset(self):
+        self.img = None
+        self.key = None
+        self.view = None
+        self.age = None
+        self.sample = None
+        self.f_marched = 1.
+    
+    def supports(self, camera):
+        return camera in self.cameras
+    
+    def _slab_coords(self, mapper3d, camera, args, ray_dir, pix_angle, i_0, i_1):
+        '''
+        Returns the coordinates (slab, row, column) in the previous stack
+        of the centre of the slab of ray steps <i_0> to <i_1> of the
+        camera <args>, and whether the slab can be reused there.
+        '''
+        
+        alpha, beta, n_x, n_y, fov, r_0, ray_step, dist_init = args
+        alpha_0, beta_0, r_old, dist_init_0, stack = self.view
+        
+        s = dist_init + 0.5 * (i_0 + i_1) * ray_step
+        p = np.array(r_0)[:,None,None] + s * ray_dir
+        
+        # As seen from the old camera
+        d = p - r_old[:,None,None]
+        s_0 = np.sqrt(np.sum(d**2, axis=0))
+        d /= s_0[None]
+        
+        i, j = mapper3d._camera_pixels(camera, alpha_0, beta_0, n_x, n_y, fov, d)
+        k = (s_0 - dist_init_0) / (stack * ray_step) - 0.5
+        
+        # Offset of the ends of the old and new slabs, in pixels
+        sin_theta = np.sqrt(np.clip(1. - np.sum(d*ray_dir, axis=0)**2, 0., 1.))
+        err = 0.5 * (i_1 - i_0) * ray_step * sin_theta / (s * pix_angle)
+        
+        n_old, h, w = self.img.shape
+        
+        reuse = (  (err < self.tolerance)
+                 & (i > -0.5) & (i < h-0.5)
+                 & (j > -0.5) & (j < w-0.5)
+                 & (k > -0.5) & (k < n_old-0.5) )
+        
+        coords = np.array([k, i, j])
+        coords[~np.isfinite(coords)] = 0.
+        
+        return coords, reuse
+    
+    def _new_age(self, shape):
+        # Stagger the ages, so that the pixels are not all marched again
+        # in the same frame (the slabs of a pixel start at the same age)
+        age = np.random.randint(0, self.max_age, size=shape[1:])
+        return np.repeat(age[None], shape[0], axis=0)
+    
+    def render(self, mapper3d, camera, steps, reduction, args, **kwargs):
+        '''
+        Render the image stack seen by the camera <args> (alpha, beta,
+        n_x, n_y, fov, r_0, ray_step, dist_init), reusing what it can
+        of the previous frame. Takes the same keyword arguments as
+        Mapper3D.proj_map_in_slices, and <n_averaged>, the number of
+        renders (with random jitter) that are averaged. Returns the
+        averaged image stack.
+        '''
+        
+        n_averaged = kwargs.pop('n_averaged', 1)
+        verbose = kwargs.pop('verbose', False)
+        stack = kwargs.pop('stack', 'all')
+        randomize_ang = kwargs.pop('randomize_ang', False)
+        map_val = kwargs.pop('map_val', None)
+        
+        if stack == 'all':
+            stack = steps
+        
+        n_images = steps / stack + (1 if steps % stack else 0)
+        i_edge = np.minimum(np.arange(n_images+1) * stack, steps)
+        
+        alpha, beta, n_x, n_y, fov, r_0, ray_step, dist_init = args
+        key = (camera, reduction, n_x, n_y, fov, ray_step)
+        shape = (2*n_y+1, 2*n_x+1)
+        
+        reproject = (self.key == key) and self.supports(camera)
+        reuse = np.zeros((n_images,) + shape, dtype=np.bool)
+        
+        if reproject:
+            ray_dir = mapper3d._camera_rays(camera, *args)[1] / ray_step
+            
+            # Angle subtended by a pixel, in the middle of the image
+            pix_angle = np.arccos(np.clip(np.sum(ray_dir[:,n_y,n_x]*ray_dir[:,n_y,n_x+1]), -1., 1.))
+            
+            age = np.zeros((n_images,) + shape, dtype=self.age.dtype)
+            
+            for k in xrange(n_images):
+                coords, reuse[k] = self._slab_coords(mapper3d, camera, args,
+                                                     ray_dir, pix_angle,
+                                                     i_edge[k], i_edge[k+1])
+                age[k] = map_coordinates(self.age, coords, order=0, mode='nearest')
+            
+            reuse &= (age < self.max_age)
+        
+        # Slab up to which all pixels are marched again, chosen to
+        # march as few steps as possible. Beyond it, the pixels with any
+        # slab that cannot be reused are marched again.
+        redo = np.logical_or.accumulate(~reuse[::-1], axis=0)[::-1]
+        n_redo = np.hstack([np.sum(np.sum(redo, axis=1), axis=1), 0])
+        cost = i_edge * redo[0].size + (steps - i_edge) * n_redo
+        n_near = np.argmin(cost) if reproject else n_images
+        i_far = i_edge[n_near]
+        
+        if n_near < n_images:
+            redo = redo[n_near]
+        else:
+            redo = np.ones(shape, dtype=np.bool)
+        
+        self.f_marched = float(cost[n_near]) / float(steps * redo.size)
+        
+        if verbose:
+            print 'Marching %.1f%% of the ray steps (%d of %d slabs for all pixels).' % (
+                100.*self.f_marched, n_near, n_images)
+        
+        if (map_val is None) and (reduction == 'sample'):
+            if (not reproject) or (self.sample is None):
+                self.sample = mapper3d._reduced_map(reduction)
+            
+            map_val = self.sample
+        elif map_val is None:
+            map_val = mapper3d._reduced_map(reduction)
+        
+        img = np.zeros((n_images,) + shape, dtype='f8')
+        
+        for n in xrange(n_averaged):
+            pos, u = mapper3d._camera_rays(camera, *args, randomize_ang=randomize_ang)
+            
+            mapper3d._march_slices(map_val, pos, u, img, 0, i_far, stack)
+            
+            if np.any(redo) and (i_far < steps):
+                img_redo = np.zeros((n_images-n_near, np.sum(redo), 1), dtype='f8')
+                mapper3d._march_slices(map_val, pos[:,redo][:,:,None], u[:,redo][:,:,None],
+                                       img_redo, i_far, steps, stack, img_offset=n_near)
+                img[n_near:,redo] += img_redo[:,:,0]
+        
+        img /= float(n_averaged)
+        
+        # Fill in the rest from the previous stack
+        keep = ~redo
+        
+        if reproject and np.any(keep):
+            for k in xrange(n_near, n_images):
+                coords = self._slab_coords(mapper3d, camera, args,
+                                           ray_dir[:,keep][:,:,None], pix_angle,
+                                           i_edge[k], i_edge[k+1])[0]
+                img[k,keep] = map_coordinates(self.img, coords[:,:,0], order=1, mode='nearest')
+        
+        if reproject:
+            # The slabs in front of <n_near> are marched again everywhere
+            new_age = self._new_age(age.shape) * (n_near < n_images)
+            marched = np.zeros(age.shape, dtype=np.bool)
+            marched[:n_near] = True
+            marched[n_near:,redo] = True
+            self.age = np.where(marched, new_age, age+1)
+        else:
+            self.age = self._new_age((n_images,) + shape)
+        
+        self.img = img
+        self.key = key
+        self.view = (alpha, beta, np.array(r_0, dtype='f8'), dist_init, stack)
+        
+        return img
+
+
+####################################################################################
+#
+# Out-of-core 3D Mapper
+#
+#   Keeps the density cube in a memory-mapped file on disk, and loads
+#   (pixel block, distance bin) chunks of it on demand.
+#
+####################################################################################
+
+def source_key(fname):
+    '''
+    Identifies the file <fname>, as it is now: its absolute path, size
+    and modification time.
+    '''
+    
+    stat = os.stat(fname)
+    
+    return {'fname': os.path.abspath(fname),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime}
+
+
+def npy_key_fname(fname):
+    '''
+    Name of the file that holds the key of the array in <fname> (see
+    load_npy_memmap).
+    '''
+    
+    return fname + '.key.json'
+
+
+def load_npy_memmap(fname, shape, key):
+    '''
+    Returns the array in the .npy file <fname>, memory-mapped read-only,
+    if the file exists, holds an array of the given shape, and was saved
+    (by save_npy_key) with the same <key> (e.g., written earlier, or by
+    another host of a frame farm). The key is a JSON-serializable
+    description of what the array was computed from. Otherwise, or if
+    <key> is None, returns None.
+    '''
+    
+    if (key is None) or not os.path.isfile(fname):
+        return None
+    
+    try:
+        with open(npy_key_fname(fname), 'r') as f:
+            saved_key = json.load(f)
+    except (IOError, ValueError):
+        return None
+    
+    if saved_key != json.loads(json.dumps(key)):
+        return None
+    
+    try:
+        arr = np.load(fname, mmap_mode='r')
+    except (IOError, ValueError):
+        return None
+    
+    if arr.shape != tuple(shape):
+        return None
+    
+    return arr
+
+
+def save_npy_key(fname, key):
+    '''
+    Save the key of the array in <fname> (see load_npy_memmap).
+    '''
+    
+    key_fname = npy_key_fname(fname)
+    tmp_key_fname = tmp_fname(key_fname)
+    
+    with open(tmp_key_fname, 'w') as f:
+        json.dump(key, f)
+    
+    os.rename(tmp_key_fname, key_fname)
+
+
+def remove_npy_key(fname):
+    '''
+    Remove the key of the array in <fname>, before the array is
+    replaced, so that it is not reused in the meantime.
+    '''
+    
+    try:
+        os.remove(npy_key_fname(fname))
+    except OSError:
+        pass
+
+
+def tmp_fname(fname):
+    '''
+    Name of the file that a new file is written to, before it is
+    renamed to <fname>. Processes that read <fname> (e.g., on other
+    hosts) then never see a partly written file. The name is unique
+    to the host and process, as the hosts of a frame farm may share
+    a directory.
+    '''
+    
+    return '%s.%s.%d.tmp' % (fname, socket.gethostname(), os.getpid())
+
+
+class LOSBlockReader:
+    '''
+    Line-of-sight reddening of a Bayestar output file, read from disk
+    one block of pixels at a time. Indexing with a slice of pixels,
+    
+        los_EBV[s_idx:e_idx]
+    
+    returns the samples of those pixels, with shape (pixels, samples,
+    distance bins), as in the los_EBV of a LOSData. Pixels without a
+    line-of-sight fit are NaN.
+    
+    <key> identifies the samples read (the file, and <max_samples>), for
+    the arrays computed from them (see load_npy_memmap).
+    '''
+    
+    def __init__(self, fname, max_samples=None):
+        self.key = {'map': source_key(fname), 'max_samples': max_samples}
+        
+        self.f = h5py.File(fname, 'r')
+        
+        if 'locations' in self.f: # Unified filetype
+            dset = self.f['locations']
+            self.nside = dset['nside'][:]
+            self.pix_idx = dset['healpix_index'][:]
+            self.los_mask = dset['piecewise_mask'][:].astype(np.bool)
+            
+            self.dset = self.f['piecewise']
+            self.DM_min = float(self.dset.attrs['DM_min'])
+            self.DM_max = float(self.dset.attrs['DM_max'])
+            
+            # The first sample and distance bin hold the diagnostics
+            offset = 1
+        elif 'pixel_info' in self.f: # Compact filetype
+            dset = self.f['pixel_info']
+            self.nside = dset['nside'][:]
+            self.pix_idx = dset['healpix_index'][:].astype('i8')
+            self.los_mask = np.ones(self.nside.size, dtype=np.bool)
+            
+            DM_bin_edges = dset.attrs['DM_bin_edges'][:]
+            self.DM_min, self.DM_max = np.min(DM_bin_edges), np.max(DM_bin_edges)
+            
+            self.dset = self.f['samples']
+            offset = 0
+        else:
+            # Native Bayestar output has a group per pixel, so load it whole
+            self.f.close()
+            
+            data = load_multiple_outputs([fname], max_samples=max_samples)
+            data.expand_missing()
+            
+            self.nside = data.nside[0]
+            self.pix_idx = data.pix_idx[0]
+            self.los_mask = np.ones(self.nside.size, dtype=np.bool)
+            self.DM_min, self.DM_max = data.DM_EBV_lim[:2]
+            
+            self.f = None
+            self.dset = data.los_EBV[0]
+            offset = 0
+        
+        # Only the pixels with a line-of-sight fit are stored
+        self._row = np.cumsum(self.los_mask) - 1
+        
+        n_samples = self.dset.shape[1] - offset
+        
+        if max_samples != None:
+            n_samples = min(n_samples, max_samples)
+        
+        self._samples = slice(offset, offset + n_samples)
+        self._dists = slice(offset, None)
+        
+        self.shape = (self.nside.size, n_samples, self.dset.shape[2] - offset)
+    
+    def __getitem__(self, idx):
+        if not isinstance(idx, slice):
+            raise TypeError('Pixels can only be read in contiguous blocks.')
+        
+        s_idx, e_idx, step = idx.indices(self.shape[0])
+        
+        if step != 1:
+            raise TypeError('Pixels can only be read in contiguous blocks.')
+        
+        e_idx = max(e_idx, s_idx)
+        
+        EBV = np.empty((e_idx-s_idx,) + self.shape[1:], dtype='f4')
+        EBV[:] = np.nan
+        
+        mask = self.los_mask[s_idx:e_idx]
+        
+        if np.any(mask):
+            row = self._row[s_idx:e_idx][mask]
+            EBV[mask] = self.dset[row[0]:row[-1]+1, self._samples, self._dists]
+        
+        return EBV
+    
+    def close(self):
+        if self.f != None:
+            self.f.close()
+            self.f = None
+
+
+class DensitySlabStore:
+    '''
+    Memory-mapped density cube, stored with shape
+    
+        (n_dist_bins, n_pixels, n_samples),
+    
+    so that every distance bin is a contiguous slab on disk. Each
+    slab is further split into blocks of <block_size> pixels. Chunks,
+    indexed by (distance bin, pixel block), are read on demand and kept
+    in a least-recently-used cache of at most <cache_size> chunks.
+    '''
+    
+    def __init__(self, fname, shape=None, key=None, block_size=4096, cache_size=256):
+        '''
+        If <shape> = (n_pixels, n_samples, n_dist_bins) is given, and
+        <fname> does not already hold a cube of that shape, saved with
+        the same <key> (see load_npy_memmap), a new (zeroed) cube is
+        created, and <writable> is set. It is written to a temporary
+        file, which is renamed to <fname> by finish(). Otherwise, the
+        existing cube is opened read-only.
+        '''
+        
+        self.fname = fname
+        self.key = key
+        self.writable = False
+        
+        if shape == None:
+            self.slabs = np.load(fname, mmap_mode='r')
+        else:
+            n_pix, n_samples, n_dist = shape
+            self.slabs = load_npy_memmap(fname, (n_dist, n_pix, n_samples), key)
+            
+            if self.slabs is None:
+                self.writable = True
+                self.slabs = np.lib.format.open_memmap(tmp_fname(fname), mode='w+',
+                                                       dtype='f4', shape=(n_dist, n_pix, n_samples))
+        
+        self.n_dist_bins, self.n_pix, self.n_samples = self.slabs.shape
+        self.shape = (self.n_pix, self.n_samples, self.n_dist_bins)
+        self.dtype = self.slabs.dtype
+        
+        self.block_size = int(block_size)
+        self.n_blocks = self.n_pix / self.block_size + (1 if self.n_pix % self.block_size else 0)
+        self.cache_size = cache_size
+        
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._prefetch_thread = None
+    
+    def __getstate__(self):
+        # The cache, lock and prefetch thread are local to each process
+        state = self.__dict__.copy()
+        state['slabs'] = None
+        state['_cache'] = None
+        state['_lock'] = None
+        state['_prefetch_thread'] = None
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.slabs = np.load(self.fname, mmap_mode='r')
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+    
+    def write_block(self, s_idx, block):
+        '''
+        Write the density of a block of pixels, starting at pixel
+        <s_idx>, in all distance bins. <block> has shape (pixels,
+        n_samples, n_dist_bins).
+        '''
+        
+        self.slabs[:, s_idx:s_idx+block.shape[0]] = np.transpose(block, (2, 0, 1))
+    
+    def finish(self):
+        '''
+        Move a newly written cube into place, with its key, and reopen
+        it read-only.
+        '''
+        
+        if not self.writable:
+            return
+        
+        self.slabs.flush()
+        self.slabs = None
+        
+        remove_npy_key(self.fname)
+        os.rename(tmp_fname(self.fname), self.fname)
+        
+        if self.key is not None:
+            save_npy_key(self.fname, self.key)
+        
+        self.slabs = np.load(self.fname, mmap_mode='r')
+        self.writable = False
+    
+    def block_range(self, block):
+        s_idx = block * self.block_size
+        return s_idx, min(s_idx + self.block_size, self.n_pix)
+    
+    def get_chunk(self, dist_bin, block):
+        '''
+        Returns the density in the given distance bin and pixel block,
+        with shape (pixels in block, n_samples).
+        '''
+        
+        key = (dist_bin, block)
+        
+        with self._lock:
+            chunk = self._cache.pop(key, None)
+            
+            if chunk is not None:
+                self._cache[key] = chunk
+                return chunk
+        
+        s_idx, e_idx = self.block_range(block)
+        chunk = np.array(self.slabs[dist_bin, s_idx:e_idx])
+        
+        with self._lock:
+            self._cache[key] = chunk
+            
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        
+        return chunk
+    
+    def _prefetch_worker(self, keys):
+        for dist_bin, block in keys:
+            with self._lock:
+                if (dist_bin, block) in self._cache:
+                    continue
+            
+            self.get_chunk(dist_bin, block)
+    
+    def prefetch(self, dist_bin, blocks):
+        '''
+        Load the given pixel blocks of a distance bin into the cache in
+        a background thread. Does nothing if the previous prefetch has
+        not finished yet.
+        '''
+        
+        if (dist_bin < 0) or (dist_bin >= self.n_dist_bins):
+            return
+        
+        if (self._prefetch_thread != None) and self._prefetch_thread.is_alive():
+            return
+        
+        keys = [(dist_bin, b) for b in blocks]
+        
+        self._prefetch_thread = threading.Thread(target=self._prefetch_worker,
+                                                 args=(keys,))
+        self._prefetch_thread.daemon = True
+        self._prefetch_thread.start()
+
+
+class ReducedSlabView:
+    '''
+    Lazily reduced view of a DensitySlabStore, which can be indexed like
+    the (pixel, distance) array returned by <take_measure_nd>:
+    
+        view[map_idx, dist_bin]
+    
+    Chunks are reduced over the sample axis the first time they are
+    touched, and the next distance slab of every pixel block touched is
+    prefetched in the background, as rays march outward.
+    '''
+    
+    def __init__(self, store, reduction):
+        self.store = store
+        self.reduction = reduction
+        self.shape = (store.n_pix, store.n_dist_bins)
+        self.dtype = store.dtype
+        
+        # Draw the sample used in each pixel once, so that the
+        # whole view corresponds to a single realization of the map
+        self._sample_idx = None
+        
+        if reduction == 'sample':
+            self._sample_idx = np.random.randint(0, high=store.n_samples,
+                                                 size=store.n_pix)
+        
+        self._reduced = collections.OrderedDict()
+    
+    def _reduced_chunk(self, dist_bin, block):
+        key = (dist_bin, block)
+        chunk = self._reduced.pop(key, None)
+        
+        if chunk is None:
+            chunk = self.store.get_chunk(dist_bin, block)
+            
+            if self._sample_idx is not None:
+                s_idx, e_idx = self.store.block_range(block)
+                chunk = chunk[np.arange(e_idx-s_idx), self._sample_idx[s_idx:e_idx]]
+            else:
+                chunk = take_measure_nd(chunk, self.reduction)
+            
+            while len(self._reduced) >= self.store.cache_size:
+                self._reduced.popitem(last=False)
+        
+        self._reduced[key] = chunk
+        
+        return chunk
+    
+    def __getitem__(self, idx):
+        map_idx, dist_bin = idx
+        
+        shape = np.broadcast(map_idx, dist_bin).shape
+        map_idx = np.broadcast_to(map_idx, shape).ravel()
+        dist_bin = np.broadcast_to(dist_bin, shape).ravel()
+        
+        out = np.zeros(map_idx.size, dtype=self.dtype)
+        
+        # Entries flagged with negative indices are masked by the caller
+        valid = np.nonzero((map_idx >= 0) & (dist_bin >= 0))[0]
+        
+        if valid.size == 0:
+            return out.reshape(shape)
+        
+        block = map_idx[valid] / self.store.block_size
+        key = dist_bin[valid].astype('i8') * self.store.n_blocks + block
+        
+        order = np.argsort(key, kind='mergesort')
+        key_sorted = key[order]
+        split_idx = np.nonzero(np.diff(key_sorted))[0] + 1
+        
+        for k_group in np.split(order, split_idx):
+            d, b = divmod(int(key[k_group[0]]), self.store.n_blocks)
+            s_idx, e_idx = self.store.block_range(b)
+            
+            i = valid[k_group]
+            out[i] = self._reduced_chunk(d, b)[map_idx[i] - s_idx]
         
+        # Rays march outward, so the next slab is likely to be needed next
+        self.store.prefetch(int(key_sorted[-1] / self.store.n_blocks) + 1,
+                            np.unique(block))
+        
+        return out.reshape(shape)
+
+
+class OutOfCoreMapper3D(Mapper3D):
+    '''
+    A Mapper3D that keeps the density cube in a memory-mapped file,
+    rather than in memory. Use this when the density of the map,
+    with shape (n_pixels, n_samples, n_dist_bins), does not fit in RAM.
+    '''
+    
+    def __init__(self, nside, pix_idx, los_EBV, DM_min, DM_max, fname,
+                       remove_nan=True, block_size=4096, cache_size=256,
+                       key=None):
+        '''
+        The density is written to <fname>, one block of pixels at a
+        time, so that <los_EBV> may itself be a memory-mapped or HDF5
+        array, or a LOSBlockReader, and is never held in memory whole.
+        If <los_EBV> is None, or if <fname> already holds a density cube
+        of the same shape, computed from the samples identified by <key>
+        (e.g., the key of a LOSBlockReader) with the same settings, the
+        existing cube is loaded instead. Without a <key>, the cube is
+        always written anew. <block_size> is the number of pixels per
+        chunk, and <cache_size> is the number of chunks kept in memory.
+        '''
+        
+        if los_EBV is None:
+            self.store = DensitySlabStore(fname, block_size=block_size,
+                                                 cache_size=cache_size)
+            self._init_dist_bins(self.store.n_dist_bins, DM_min, DM_max)
+        else:
+            n_pix, n_samples, n_dist = los_EBV.shape
+            r = self._init_dist_bins(n_dist, DM_min, DM_max)
+            dr = np.hstack([r[0], np.diff(r)])
+            
+            if key is not None:
+                key = {'samples': key, 'remove_nan': remove_nan}
+            
+            self.store = DensitySlabStore(fname, shape=(n_pix, n_samples, n_dist),
+                                                 key=key, block_size=block_size,
+                                                 cache_size=cache_size)
+            
+            if self.store.writable:
+                for s_idx in xrange(0, n_pix, self.store.block_size):
+                    e_idx = min(s_idx + self.store.block_size, n_pix)
+                    
+                    E = np.array(los_EBV[s_idx:e_idx], dtype='f4')
+                    block = np.diff(E, axis=2, prepend=0.) / dr
+                    
+                    if remove_nan:
+                        block[~np.isfinite(block)] = 0.
+                    
+                    self.store.write_block(s_idx, block)
+                
+                self.store.finish()
+        
+        self.density = self.store
+        self.cumulative = None
+        
+        self._init_pixel_map(nside, pix_idx)
+    
+    def reduce_map(self, reduction, cumulative=False, n_procs=1):
+        if cumulative:
+            raise ValueError('The cumulative map is not available out of core.')
+        
+        if reduction == 'sample':
+            # A new realization of the map, read through the chunk
+            # cache of the store
+            return ReducedSlabView(self.store, reduction)
+        
+        # One view per reduction is kept, with the chunks it has reduced
+        return Mapper3D.reduce_map(self, reduction, n_procs=n_procs)
+    
+    def _compute_reduction(self, reduction, cumulative, n_procs):
+        # The chunks of the map are reduced when they are first read
+        return ReducedSlabView(self.store, reduction)
+
+
+####################################################################################
+#
+# Sample-major 3D Mapper
+#
+#   Keeps the density in a memory-mapped file on disk, one map per
+#   posterior sample, so that drawing a sample of the map reads one
+#   contiguous slab.
+#
+####################################################################################
+
+class SampleMajorMapper3D(Mapper3D):
+    '''
+    A Mapper3D that keeps the density in a memory-mapped file, with
+    shape (n_samples, n_pixels, n_dist_bins), rather than in memory.
+    Each slab is a map drawn from the posterior, in which every pixel
+    takes one of its samples. With <shuffle>, the samples are assigned
+    to the slabs in a random order in each pixel, so that every slab
+    draws an independent sample in each pixel (as take_measure_nd does
+    for 'sample'), and every sample of a pixel is in one of the slabs.
+    
+    The 'sample' reduction then returns one of the slabs, without
+    reading the map. There are only n_samples different slabs, so
+    successive frames cycle through the same few maps, rather than
+    each drawing a new one. Other reductions are computed from the
+    slabs, and kept (see Mapper3D.reduce_map).
+    '''
+    
+    def __init__(self, nside, pix_idx, los_EBV, DM_min, DM_max, fname,
+                       remove_nan=True, shuffle=True, block_size=4096,
+                       seed=0, key=None):
+        '''
+        The density is written to <fname>, one block of <block_size>
+        pixels at a time, so that <los_EBV> may be a memory-mapped or
+        HDF5 array, or a LOSBlockReader. It is written to a temporary
+        file first, and then renamed. The samples are shuffled with the
+        random <seed>, so that every host of a frame farm writes the
+        same slabs. If <los_EBV> is None, or if <fname> already holds
+        slabs of the same shape, computed from the samples identified
+        by <key> (e.g., the key of a LOSBlockReader) with the same
+        settings, the existing slabs are loaded instead. Without a
+        <key>, the slabs are always written anew.
+        '''
+        
+        if los_EBV is None:
+            self.samples = np.load(fname, mmap_mode='r')
+            self._init_dist_bins(self.samples.shape[2], DM_min, DM_max)
+        else:
+            n_pix, n_samples, n_dist = los_EBV.shape
+            r = self._init_dist_bins(n_dist, DM_min, DM_max)
+            dr = np.hstack([r[0], np.diff(r)])
+            
+            if key is not None:
+                key = {'samples': key, 'remove_nan': remove_nan,
+                       'shuffle': shuffle, 'seed': seed}
+            
+            self.samples = load_npy_memmap(fname, (n_samples, n_pix, n_dist), key)
+        
+        if self.samples is None:
+            samples_fname = tmp_fname(fname)
+            samples = np.lib.format.open_memmap(samples_fname, mode='w+', dtype='f4',
+                                                shape=(n_samples, n_pix, n_dist))
+            
+            rs = np.random.RandomState(seed)
+            
+            for s_idx in xrange(0, n_pix, block_size):
+                e_idx = min(s_idx + block_size, n_pix)
+                
+                E = np.array(los_EBV[s_idx:e_idx], dtype='f4')
+                block = np.diff(E, axis=2, prepend=0.) / dr
+                
+                if remove_nan:
+                    block[~np.isfinite(block)] = 0.
+                
+                if shuffle:
+                    order = np.argsort(rs.random_sample(block.shape[:2]), axis=1)
+                    block = block[np.arange(e_idx-s_idx)[:,None], order]
+                
+                samples[:, s_idx:e_idx] = np.swapaxes(block, 0, 1)
+            
+            samples.flush()
+            del samples
+            
+            remove_npy_key(fname)
+            os.rename(samples_fname, fname)
+            
+            if key is not None:
+                save_npy_key(fname, key)
+            
+            self.samples = np.load(fname, mmap_mode='r')
+        
+        self.n_samples = self.samples.shape[0]
+        
+        # Indexed by (pixel, sample, distance), like the density of a
+        # Mapper3D
+        self.density = np.swapaxes(self.samples, 0, 1)
+        self.cumulative = None
+        
+        self._init_pixel_map(nside, pix_idx)
+    
+    def reduce_map(self, reduction, cumulative=False, n_procs=1):
+        if cumulative:
+            raise ValueError('The cumulative map is not kept by SampleMajorMapper3D.')
+        
+        if reduction == 'sample':
+            # A plain array, as values indexed from a read-only memmap
+            # are read-only themselves
+            return np.asarray(self.samples[np.random.randint(self.n_samples)])
+        
+        return Mapper3D.reduce_map(self, reduction, n_procs=n_procs)
+
 
 
 
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#  
+#  panorama.py
+#  
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#  
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#  
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#  
+#  
+
+'''
+Assemble the tiles rendered by camera_route.equirectangular_route into
+one panorama.
+
+The tiles are placed pixel for pixel into a preallocated canvas, with
+Galactic latitude increasing upwards and longitude increasing to the
+left. Tiles can be added straight from the renderer (render3d.py, with
+"panorama": true in render_kwargs), or read back from the frames on
+disk:
+
+    python panorama.py out/equirectangular --eye left
+'''
+
+import numpy as np
+
+import glob
+import argparse
+
+from PIL import Image
+
+from videosink import QueueListener
+
+
+def tile_grid(n_frames):
+    '''
+    Returns the number of rows and columns of tiles in the panorama of
+    <n_frames> tiles (see camera_route.equirectangular_route).
+    '''
+    
+    n_rows = int(round(np.sqrt(n_frames / 2.)))
+    n_cols = 2 * n_rows
+    
+    if n_rows * n_cols != n_frames:
+        raise ValueError('%d tiles do not fill an equirectangular panorama '
+                         '(the number of tiles must be twice a square number).'
+                         % n_frames)
+    
+    return n_rows, n_cols
+
+
+def tile_slot(k, n_rows, n_cols):
+    '''
+    Returns the (row, column) of tile <k> in the panorama. The route
+    scans the latitudes from south to north, before moving on to the
+    next longitude.
+    '''
+    
+    return n_rows - 1 - k % n_rows, n_cols - 1 - k // n_rows
+
+
+def load_tile(fname):
+    '''
+    Returns the RGB pixels of a frame, either a PNG or a raw .npy array
+    (which is memory-mapped, rather than read).
+    '''
+    
+    if fname.endswith('.npy'):
+        img = np.load(fname, mmap_mode='r')
+    else:
+        img = np.asarray(Image.open(fname).convert('RGB'))
+    
+    return img[:,:,:3]
+
+
+class Panorama(QueueListener):
+    '''
+    An equirectangular panorama of <n_frames> tiles, for <n_eyes>
+    cameras, written to <fnames> (one per eye) by save().
+    
+    The canvas is allocated when the first tile is added, as the size
+    of the tiles is only known then. If an output filename ends with
+    ".npy", the canvas is a memory-mapped array in that file, so that
+    large panoramas are never held in memory.
+    
+    Tiles are added with put(k, eye, rgb), in any order, so that a
+    Panorama can take the place of a videosink.FFmpegSink.
+    '''
+    
+    def __init__(self, fnames, n_frames, n_eyes=1):
+        if isinstance(fnames, basestring):
+            fnames = [fnames]
+        
+        if len(fnames) != n_eyes:
+            raise ValueError('Need one output filename per eye.')
+        
+        self.fnames = fnames
+        self.n_eyes = n_eyes
+        self.n_rows, self.n_cols = tile_grid(n_frames)
+        
+        self.canvas = None
+        self.tile_shape = None
+        self.filled = np.zeros((n_eyes, n_frames), dtype=np.bool)
+    
+    def _allocate(self, tile_shape):
+        h, w = tile_shape
+        shape = (self.n_rows*h, self.n_cols*w, 3)
+        
+        self.canvas = []
+        
+        for fname in self.fnames:
+            if fname.endswith('.npy'):
+                img = np.lib.format.open_memmap(fname, mode='w+',
+                                                dtype='u1', shape=shape)
+            else:
+                img = np.empty(shape, dtype='u1')
+            
+            img[:] = 0
+            self.canvas.append(img)
+        
+        self.tile_shape = tile_shape
+    
+    def put(self, k, eye, rgb):
+        '''
+        Place tile <k> of camera <eye> into the panorama.
+        '''
+        
+        if self.canvas == None:
+            self._allocate(rgb.shape[:2])
+        elif rgb.shape[:2] != self.tile_shape:
+            raise ValueError('Tile shape %s differs from panorama tile shape %s'
+                             % (str(rgb.shape[:2]), str(self.tile_shape)))
+        
+        h, w = self.tile_shape
+        row, col = tile_slot(k, self.n_rows, self.n_cols)
+        
+        self.canvas[eye][row*h:(row+1)*h, col*w:(col+1)*w] = rgb[:,:,:3]
+        self.filled[eye, k] = True
+    
+    def save(self):
+        '''
+        Write the panorama of each eye to its file.
+        '''
+        
+        if self.canvas == None:
+            print 'No tiles in panorama.'
+            return
+        
+        for eye, (img, fname) in enumerate(zip(self.canvas, self.fnames)):
+            n_missing = np.sum(~self.filled[eye])
+            
+            if n_missing:
+                print 'Warning: %d tiles missing from %s.' % (n_missing, fname)
+            
+            if isinstance(img, np.memmap):
+                img.flush()
+            else:
+                Image.fromarray(img, mode='RGB').save(fname)
+            
+            print 'Wrote panorama %s.' % fname
+    
+    def close(self, frame_q=None):
+        '''
+        Stop listening to <frame_q> (if listening), and save the
+        panorama. If adding a tile failed, the error is raised instead.
+        '''
+        
+        self.stop_listening(frame_q)
+        self.save()
+
+
+def find_tiles(fname_base):
+    '''
+    Returns the frame numbers and filenames of the frames
+    <fname_base>.NNNNN.png (or .npy), ordered by frame number.
+    '''
+    
+    tiles = {}
+    
+    for fname in glob.glob(fname_base + '.*'):
+        parts = fname[len(fname_base)+1:].split('.')
+        
+        if (len(parts) == 2) and parts[0].isdigit() and (parts[1] in ('png', 'npy')):
+            tiles[int(parts[0])] = fname
+    
+    return sorted(tiles.items())
+
+
+def build_panorama(fname_base, fname_out, n_frames=None):
+    '''
+    Assemble the tiles <fname_base>.NNNNN.png (or .npy) on disk into
+    the panorama <fname_out>. By default, the number of tiles is the
+    number of frames found.
+    '''
+    
+    tiles = find_tiles(fname_base)
+    
+    if n_frames == None:
+        n_frames = len(tiles)
+    
+    if n_frames == 0:
+        raise IOError('No tiles %s.NNNNN.png found.' % fname_base)
+    
+    panorama = Panorama(fname_out, n_frames)
+    
+    for k, fname in tiles:
+        if k < n_frames:
+            panorama.put(k, 0, load_tile(fname))
+    
+    panorama.save()
+    
+    return panorama
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Assemble the tiles of an equirectangular render into a panorama.',
+        add_help=True)
+    parser.add_argument('fname_base', type=str,
+                        help='Frames without the eye, frame number and extension '
+                             '(e.g., out/equirectangular).')
+    parser.add_argument('--eye', type=str, nargs='+', default=['mono'],
+                        choices=('mono', 'left', 'right'),
+                        help='Tiles of which cameras to assemble (default: mono).')
+    parser.add_argument('--n-frames', type=int, default=None,
+                        help='Number of tiles (default: the number of frames found).')
+    parser.add_argument('--format', type=str, default='png', choices=('png', 'npy'),
+                        help='Write the panorama as a PNG, or as a raw array.')
+    args = parser.parse_args()
+    
+    for eye in args.eye:
+        if eye == 'mono':
+            base = args.fname_base
+        else:
+            base = args.fname_base + '-' + eye
+        
+        build_panorama(base, base + '-panorama.' + args.format,
+                       n_frames=args.n_frames)
+    
+    return 0
+
+if __name__ == '__main__':
+    main()
@@ -25,14 +25,48 @@
 import numpy as np
 import scipy, scipy.misc
 
-from alpha import blend_images
+from alpha import blend_images, sprite_overlap
 
 from PIL import Image, ImageDraw
 
+def point_sprite(center, radius=5, color=(0,0,0), outline=(0,0,0,0)):
+    '''
+    Render a filled ellipse into an RGBA image (with straight alpha,
+    indexed (x, y)) just large enough to hold it. Returns the image, and
+    the (x, y) position of its first pixel in the canvas.
+    '''
+    
+    if isinstance(radius, int) or isinstance(radius, float):
+        radius = (radius, radius)
+    
+    xy = np.array([center[0] - radius[0], center[1] - radius[1],
+                   center[0] + radius[0], center[1] + radius[1]])
+    xy = np.round(xy).astype('i8')
+    
+    # Draw the ellipse with its bounding box at the origin
+    size = (int(xy[2]-xy[0]) + 2, int(xy[3]-xy[1]) + 2)
+    
+    image = Image.new('RGBA', size, (1,1,1,0))
+    d = ImageDraw.Draw(image)
+    d.ellipse((xy - np.hstack([xy[:2], xy[:2]])).tolist(),
+              fill=color, outline=outline)
+    
+    # Convert to numpy array
+    image = np.array(image).astype('f8') / 255.
+    image = np.swapaxes(image, 0, 1)
+    
+    return image, (int(xy[0]), int(xy[1]))
+
+
 def rasterize_point(canvas, center, radius=5,
                                     color=(0,0,0),
                                     outline=(0,0,0,0),
                                     oversample=1):
+    '''
+    Render a filled ellipse onto an empty RGBA canvas of size <canvas> =
+    (width, height). Returns an image indexed (x, y). See point_sprite for
+    a version that only returns the pixels covered by the ellipse.
+    '''
     
     if isinstance(radius, int) or isinstance(radius, float):
         radius = (radius, radius)
@@ -40,25 +74,25 @@ def rasterize_point(canvas, center, radius=5,
     # Determine oversampled image size
     canvas_large = [oversample*c for c in canvas]
     
-    xy = np.array([center[0] - radius[0], center[1] - radius[1],
-                   center[0] + radius[0], center[1] + radius[1]])
-    xy = np.round(oversample * xy).astype('u4').tolist()
+    sprite, offset = point_sprite([oversample*c for c in center],
+                                  radius=[oversample*r for r in radius],
+                                  color=color, outline=outline)
     
-    # Set up canvas and image renderer
-    image = Image.new('RGBA', canvas_large, (1,1,1,0))
-    d = ImageDraw.Draw(image)
+    image = np.zeros((canvas_large[0], canvas_large[1], 4), dtype='f8')
+    image[:,:,:3] = 1./255.
     
-    # Draw circle
-    d.ellipse(xy, fill=color, outline=outline)
+    overlap = sprite_overlap(image.shape[:2], sprite.shape[:2], offset)
+    
+    if overlap != None:
+        image[overlap[0]] = sprite[overlap[1]]
     
     # Downsample image
     if oversample != 1:
+        image = np.swapaxes(np.round(255. * image).astype('u1'), 0, 1)
+        image = Image.fromarray(image, mode='RGBA')
         image = image.resize(canvas, Image.ANTIALIAS)
-    
-    # Convert to numpy array
-    image = np.array(image).astype('f8') / 255.
-    
-    image = np.swapaxes(image, 0, 1)
+        image = np.array(image).astype('f8') / 255.
+        image = np.swapaxes(image, 0, 1)
     
     return image
 
@@ -42,7 +42,7 @@ import os, sys, time
 import os.path
 
 import multiprocessing
-import Queue
+import traceback
 
 from PIL import Image
 
@@ -50,10 +50,12 @@ import hputils, maptools
 from gen_plots import downsample_by_two
 
 from alphastacker import AlphaStacker
-from config import pan1
-
-# Locate pan1
-# pan1 = '/nfs_pan1/www/ggreen/'
+import frame_writer
+from ledger import FrameLedger, pose_hash, file_checksum
+from videosink import FFmpegSink
+from panorama import Panorama
+import config
+import timing
 
 
 def pm_ang_formatter(theta, pos):
@@ -67,7 +69,7 @@ def pm_ang_formatter(theta, pos):
 def proj_points(x, y, z, r_0,
                 alpha, beta,
                 proj_name, fov,
-                dth=0, dph=0):
+                dth=0, dph=0, ipd=10.):
     # Center coordinates on camera
     x = x - r_0[0]
     y = y - r_0[1]
@@ -104,26 +106,38 @@ def proj_points(x, y, z, r_0,
     lam_0 = beta
     proj, proj2 = None, None
     
+    if proj_name.lower() == 'ods':
+        return proj_points_ods(x, y, z, phi_0, lam_0, fov, ipd)
+    
     if proj_name.lower() in ['rect', 'rectilinear', 'gnomonic']:
         proj = hputils.Gnomonic_projection(phi_0=phi_0, lam_0=lam_0)
         proj2 = hputils.Gnomonic_projection(phi_0=0., lam_0=0.)
     elif proj_name.lower() in ['stereo', 'stereographic']:
         proj = hputils.Stereographic_projection(phi_0=phi_0, lam_0=lam_0)
         proj2 = hputils.Stereographic_projection(phi_0=0., lam_0=0.)
+    elif proj_name.lower() in ['equirect', 'equirectangular']:
+        proj = hputils.Equirectangular_projection(phi_0=phi_0, lam_0=lam_0)
+        proj2 = hputils.Equirectangular_projection(phi_0=0., lam_0=0.)
+    elif proj_name.lower() in ['cube', 'cubemap']:
+        proj = hputils.Cubemap_projection(phi_0=phi_0, lam_0=lam_0)
     else:
         raise ValueError('Projection not implemented: "%s"' % proj_name)
     
     X, Y, oob = proj.proj(lat, lon, ret_bounds=True)
     
     # Scale projected coordinates
-    df = np.radians(fov) / 2.
-    phi = np.array([0., 0.])
-    lam = np.array([-df, df])
-    X_0, Y_0 = proj2.proj(phi, lam)
-    
-    #print 'pos:', X, Y
-    
-    scale = fov / (X_0[1] - X_0[0])
+    if proj2 == None:
+        # Cube map: each face spans 90 degrees (see frame_extent)
+        scale = 45.
+    else:
+        df = np.radians(fov) / 2.
+        phi = np.array([0., 0.])
+        lam = np.array([-df, df])
+        X_0, Y_0 = proj2.proj(phi, lam)
+        
+        #print 'pos:', X, Y
+        
+        scale = fov / (X_0[1] - X_0[0])
     
     #print 'scale:', scale
     
@@ -133,6 +147,59 @@ def proj_points(x, y, z, r_0,
     return X, Y, ~oob
 
 
+def proj_points_ods(x, y, z, phi_0, lam_0, fov, ipd):
+    '''
+    Project points (relative to the camera) into an omni-directional
+    stereo frame (see maptools.Mapper3D._unit_ods). Each point is seen
+    by both eyes, along the rays tangent to the circle of diameter
+    <ipd>, so the coordinates of the left eye (in the top half of the
+    frame) are followed by those of the right eye (bottom half).
+    '''
+    
+    east, north, centre = hputils.tangent_frame(np.radians(phi_0), np.radians(lam_0))
+    
+    p = np.array([x, y, z])
+    p_e = np.tensordot(east, p, axes=1)
+    p_n = np.tensordot(north, p, axes=1)
+    p_c = np.tensordot(centre, p, axes=1)
+    
+    # Points inside the circle of the eyes are not seen
+    r = 0.5 * ipd
+    rho_h = np.sqrt(p_e**2. + p_c**2.)
+    visible = (rho_h > r)
+    rho_h = np.where(visible, rho_h, r)
+    
+    phi = np.arctan2(p_e, p_c)
+    dphi = np.arcsin(r / rho_h)
+    lat = np.degrees(np.arctan2(p_n, np.sqrt(rho_h**2. - r**2.)))
+    
+    X, Y, in_bounds = [], [], []
+    
+    for sign, y_0 in [(-1., 90.), (1., -90.)]:
+        lon = np.degrees(np.angle(np.exp(1j * (phi + sign*dphi))))
+        X.append(-lon)
+        Y.append(lat + y_0)
+        in_bounds.append(visible & (np.abs(lon) <= 0.5*fov))
+    
+    return np.hstack(X), np.hstack(Y), np.hstack(in_bounds)
+
+
+def frame_extent(proj_name, fov, n_x, n_y):
+    '''
+    Returns the width and height of the frame, in the (roughly degree)
+    units of the coordinates returned by proj_points. A cube map
+    always spans three faces of 90 degrees by two, and an ODS frame
+    two equirectangular images of 180 degrees, one above the other.
+    '''
+    
+    if proj_name.lower() in ['cube', 'cubemap']:
+        return 270., 180.
+    elif proj_name.lower() == 'ods':
+        return float(fov), 360.
+    
+    return float(fov), float(n_y) / float(n_x) * float(fov)
+
+
 def lbd2xyz(l, b, d):
     l = np.radians(l)
     b = np.radians(b)
@@ -149,33 +216,536 @@ def gen_movie_frames(map_fname, plot_props,
                      label_props, labels, axis_on,
                      **kwargs):
     n_procs = kwargs.pop('n_procs', 1)
+    max_samples = kwargs.pop('max_samples', 5)
+    density_fname = kwargs.pop('density_fname', None)
+    sample_fname = kwargs.pop('sample_fname', None)
+    density_grid = density_grid_opts(kwargs.pop('density_grid', None), plot_props,
+                                     n_procs=n_procs)
+    ledger_fname = kwargs.pop('ledger_fname', None)
+    max_retries = kwargs.pop('max_retries', 2)
+    cost_probe = kwargs.pop('cost_probe', False)
+    video = kwargs.pop('video', False)
+    video_fps = kwargs.pop('video_fps', 4)
+    video_opts = kwargs.pop('video_opts', {})
+    video_run_len = kwargs.pop('video_run_len', 8)
+    panorama = kwargs.pop('panorama', False)
+    first_frame = kwargs.pop('first_frame', 0)
+    
+    # Reuse the previous frame of each worker (see maptools.TemporalCache)
+    temporal_cache = kwargs.get('temporal_cache', False)
     
     # Set up queue for workers to pull frame numbers from
     frame_q = multiprocessing.Queue()
     
-    n_frames = len(camera_pos['alpha'])
+    n_frames = get_n_frames(camera_pos)
     
-    for k in xrange(n_frames):
-        frame_q.put(k)
+    # Look up which frames are already finished in the job ledger
+    ledger, poses = get_frame_ledger(plot_props, camera_pos, camera_props,
+                                     ledger_fname=ledger_fname)
     
-    # Set up lock to allow first image to be written without interference btw/ processes
-    lock = multiprocessing.Lock()
+    if video and panorama:
+        raise ValueError('Frames can be streamed either to a video, or to a panorama.')
     
-    # Spawn worker processes to plot images
-    procs = []
+    if video or panorama:
+        # Frames streamed to a video or a panorama are not kept, so all
+        # are rendered
+        frames = range(n_frames)
+    else:
+        # When restarting, the frames before <first_frame> are skipped
+        frames = [k for k in ledger.pending_frames(poses) if k >= first_frame]
+    
+    print '%d of %d frames left to render.' % (len(frames), n_frames)
+    
+    if len(frames) == 0:
+        print 'Done.'
+        return
+    
+    n_procs = min([n_procs, len(frames)])
+    
+    kwargs['ledger'] = ledger
+    kwargs['poses'] = poses
+    kwargs['max_retries'] = max_retries
+    kwargs['t_run'] = time.time()
+    
+    mapper3d = load_mapper3d(map_fname, max_samples=max_samples,
+                                        density_fname=density_fname,
+                                        density_grid=density_grid,
+                                        reduction=plot_props.get('reduction', 'sample'),
+                                        n_procs=n_procs,
+                                        sample_fname=sample_fname)
+    
+    n_eyes = 2 if (type(camera_pos) is list) else 1
+    
+    if temporal_cache:
+        # Each worker renders runs of consecutive frames, so that it
+        # can reproject the previous frame into the next. A video is
+        # encoded in order, so the frames of later runs wait in memory
+        # until the earlier runs are finished: keep the runs short.
+        chunks = frame_runs(frames, 2*n_procs,
+                            max_len=(video_run_len if video else None))
+    else:
+        chunks = [[k] for k in frames]
+    
+    if video:
+        # Frames are encoded in order, so hand them out in order, to
+        # keep the number of frames waiting to be encoded small
+        for c in chunks:
+            frame_q.put(c)
+        
+        sink = FFmpegSink(get_fname_base(plot_props) + '.mp4', frames,
+                          fps=video_fps, n_eyes=n_eyes, **video_opts)
+        
+        # Start ffmpeg before forking the workers, so that a missing
+        # encoder fails straight away
+        sink.start(get_frame_shape(plot_props))
+    elif panorama:
+        # The tiles of an equirectangular route are placed straight
+        # into the panorama of each eye
+        for c in chunks:
+            frame_q.put(c)
+        
+        if n_eyes == 2:
+            fname_base = [get_fname_base({'fname': f}) for f in plot_props['fname']]
+        else:
+            fname_base = [get_fname_base(plot_props)]
+        
+        sink = Panorama([f + '-panorama.png' for f in fname_base],
+                        n_frames, n_eyes=n_eyes)
+    
+    if video or panorama:
+        sink_q = multiprocessing.Queue()
+        sink.listen(sink_q)
+        
+        kwargs['frame_sink'] = sink_q
+    else:
+        # Hand out the most expensive frames first, so that no worker
+        # is left with a long frame at the end of the render
+        cost = estimate_frame_costs(frames, camera_pos, camera_props,
+                                    plot_props, labels,
+                                    ledger=ledger, poses=poses,
+                                    mapper3d=(mapper3d if cost_probe else None))
+        
+        for c in sorted(chunks, key=lambda c: -sum([cost[k] for k in c])):
+            frame_q.put(c)
+    
+    # Tell each worker when there are no frames left
+    for i in xrange(n_procs):
+        frame_q.put(None)
+    
+    run_frame_workers(mapper3d, frame_q, n_procs,
+                      map_fname, plot_props,
+                      camera_pos, camera_props,
+                      label_props, labels, axis_on,
+                      **kwargs)
+    
+    if video or panorama:
+        sink.close(sink_q)
+    
+    print 'Done.'
+
+
+def frame_runs(frames, n_runs, max_len=None):
+    '''
+    Split <frames> into about <n_runs> lists of consecutive frames
+    (fewer, if there are fewer frames, and more, if the runs would
+    otherwise be longer than <max_len> frames).
+    '''
+    
+    frames = sorted(frames)
+    run_len = max([int(np.ceil(len(frames) / float(n_runs))), 1])
+    
+    if max_len != None:
+        run_len = min(run_len, max(int(max_len), 1))
+    
+    runs = []
+    
+    for k in frames:
+        if (len(runs) == 0) or (k != runs[-1][-1] + 1) or (len(runs[-1]) >= run_len):
+            runs.append([k])
+        else:
+            runs[-1].append(k)
+    
+    return runs
+
+
+def get_n_frames(camera_pos):
+    if type(camera_pos) is list:
+        # Stereo pair
+        camera_pos = camera_pos[0]
+    
+    return len(camera_pos['alpha'])
+
+
+def get_frame_shape(plot_props):
+    '''
+    Size (height, width) of the frames of one camera, in pixels.
+    '''
+    
+    figsize = plot_props['figsize']
+    dpi = plot_props.get('dpi', 400)
+    
+    return int(round(figsize[1]*dpi)), int(round(figsize[0]*dpi))
+
+
+def get_fname_base(plot_props):
+    '''
+    Output filename without the frame number and extension. For a
+    stereo pair (with a left and a right filename), this is the part
+    the two filenames have in common, followed by "stereo".
+    '''
+    
+    fname = plot_props['fname']
+    
+    if type(fname) is list:
+        base = [f[:-4] if f.endswith('.png') else f for f in fname]
+        return os.path.commonprefix(base) + 'stereo'
+    
+    if fname.endswith('.png'):
+        fname = fname[:-4]
+    
+    return fname
+
+
+def get_frame_ledger(plot_props, camera_pos, camera_props, ledger_fname=None):
+    '''
+    Returns the job ledger of a render (by default stored next to the
+    output frames), and the pose hash of every frame.
+    '''
+    
+    if ledger_fname == None:
+        ledger_fname = get_fname_base(plot_props) + '.ledger.jsonl'
+    
+    ledger = FrameLedger(ledger_fname)
+    
+    if type(camera_pos) is list:
+        cams = camera_pos
+    else:
+        cams = [camera_pos]
+    
+    poses = [':'.join([pose_hash(c['xyz'][k], c['alpha'][k], c['beta'][k],
+                                 camera_props)
+                       for c in cams])
+             for k in xrange(get_n_frames(camera_pos))]
+    
+    return ledger, poses
+
+
+def get_z_range(r_cam, camera_props):
+    '''
+    Returns the starting distance and the number of steps along each
+    ray. If z_0 is a location (x,y,z), the rays start at the distance
+    to that location.
+    '''
+    
+    n_z = camera_props['n_z']
+    dr = camera_props['dr']
+    z_0 = camera_props['z_0']
+    
+    if hasattr(z_0, '__len__'):
+        displacement = np.array(r_cam) - np.array(z_0)
+        z_0 = np.sqrt(np.sum(displacement**2))
+        n_z = int(round(n_z - z_0/dr))
+    
+    return z_0, n_z
+
+
+def camera_kwargs(camera_props):
+    '''
+    Additional keyword arguments of the camera rays, for the cameras
+    that need them (the eye separation of an ODS camera).
+    '''
+    
+    if camera_props['proj_name'].lower() == 'ods':
+        return {'ipd': camera_props.get('ipd', 10.)}
+    
+    return {}
+
+
+def count_labels_in_view(labels, r_cam, alpha, beta, camera_props):
+    '''
+    Number of labels that fall inside the field of view of the camera.
+    '''
+    
+    proj_name = camera_props['proj_name']
+    fov = camera_props['fov']
+    n_x = camera_props['n_x']
+    n_y = camera_props['n_y']
+    
+    fov_x, fov_y = frame_extent(proj_name, fov, n_x, n_y)
+    
+    n_labels = 0
+    
+    for key, ((l, b, d), (ha, va, dph, dth)) in labels.iteritems():
+        r_pts = np.array([lbd2xyz(l, b, d)])
+        
+        x_proj, y_proj, in_bounds = proj_points(r_pts[:,0], r_pts[:,1], r_pts[:,2],
+                                                r_cam, alpha, beta, proj_name, fov,
+                                                dph=dph, dth=dth,
+                                                ipd=camera_props.get('ipd', 10.))
+        
+        # An ODS camera sees each label twice, once with each eye
+        for x, y, visible in zip(x_proj, y_proj, in_bounds):
+            if ( (not visible) or
+                 (abs(x) > fov_x/2.-2.) or
+                 (abs(y) > fov_y/2.-2.) ):
+                continue
+            
+            n_labels += 1
+    
+    return n_labels
+
+
+# Cost of compositing one label, in units of ray steps per pixel
+label_cost = 20.
+
+def estimate_frame_costs(frames, camera_pos, camera_props,
+                         plot_props, labels,
+                         ledger=None, poses=None,
+                         mapper3d=None, probe_scale=8):
+    '''
+    Estimate how long each frame will take to render, in arbitrary
+    units. Returns a dictionary of costs, keyed by frame number.
+    
+    The estimate is the number of ray steps (after trimming by z_0),
+    plus a fixed cost per label in view. If <mapper3d> is given, each
+    frame is also rendered at <probe_scale> times lower resolution,
+    to measure how fast the rays can be marched from that viewpoint.
+    Frames that have been rendered before (with the same pose) use the
+    times recorded in the job ledger, and the estimates for the other
+    frames are scaled to match.
+    '''
+    
+    n_x = camera_props['n_x']
+    n_y = camera_props['n_y']
+    dr = camera_props['dr']
+    n_pix = (2.*n_x+1.) * (2.*n_y+1.)
+    n_averaged = plot_props.get('n_averaged', 1)
+    
+    if type(camera_pos) is list:
+        # Stereo pair: both eyes cost about the same
+        camera_pos = camera_pos[0]
+    
+    cost = {}
+    
+    for k in frames:
+        r_cam = camera_pos['xyz'][k]
+        alpha = camera_pos['alpha'][k]
+        beta = camera_pos['beta'][k]
+        
+        z_0, n_z = get_z_range(r_cam, camera_props)
+        n_labels = count_labels_in_view(labels, r_cam, alpha, beta, camera_props)
+        
+        c = n_pix * (n_averaged * max([n_z, 1]) + label_cost * n_labels)
+        
+        if mapper3d != None:
+            # Time a low-resolution render, and scale it up
+            n_z_probe = max([n_z / probe_scale, 1])
+            
+            t_start = time.time()
+            mapper3d.proj_map_in_slices(camera_props['proj_name'], n_z_probe,
+                                        plot_props.get('reduction', 'sample'),
+                                        alpha, beta,
+                                        max([n_x / probe_scale, 1]),
+                                        max([n_y / probe_scale, 1]),
+                                        camera_props['fov'], r_cam,
+                                        dr * float(n_z) / float(n_z_probe), z_0,
+                                        stack=n_z_probe,
+                                        **camera_kwargs(camera_props))
+            t_probe = time.time() - t_start
+            
+            n_pix_probe = (2.*max([n_x / probe_scale, 1])+1.) * (2.*max([n_y / probe_scale, 1])+1.)
+            c *= t_probe / (n_pix_probe * n_z_probe)
+        
+        cost[k] = c
+    
+    if ledger == None:
+        return cost
+    
+    # Replace estimates by measured times, where available
+    t_prev = ledger.frame_times(poses)
+    measured = [k for k in frames if k in t_prev]
+    
+    if len(measured) != 0:
+        ratio = np.median([t_prev[k] / cost[k] for k in measured if cost[k] > 0.])
+        
+        for k in frames:
+            if k in t_prev:
+                cost[k] = t_prev[k]
+            elif np.isfinite(ratio):
+                cost[k] *= ratio
+    
+    return cost
+
+
+def load_mapper3d(map_fname, max_samples=5, density_fname=None,
+                             density_grid=None, reduction='sample',
+                             n_procs=1, sample_fname=None):
+    '''
+    Load the 3D map, and set up the mapper that is shared by all
+    the worker processes. The density is kept in memory, or on disk in
+    <density_fname> (by distance bin) or in <sample_fname> (by
+    posterior sample, which is fastest for the 'sample' reduction).
+    If <density_grid> is given (as the keyword arguments of
+    get_density_grid), the map is rendered from a Cartesian grid (or
+    bricks) around the Sun, wherever it reaches.
+    The map is reduced over its samples by <reduction> (using <n_procs>
+    processes) before the workers are forked, so that they share it.
+    '''
     
-    # get mapper here
     # Load 3D map
     fname = [map_fname]
-    mapper = maptools.LOSMapper(fname, max_samples=5) # load data and map to pixel
+    
+    if (density_fname != None) or (sample_fname != None):
+        # Keep the density on disk, reading the map from its file one
+        # block of pixels at a time. A file that is already there (e.g.,
+        # written by another host of a frame farm) is reused, if it was
+        # computed from the same map file, with the same settings.
+        with timing.span('mapper_build'):
+            los_EBV = maptools.LOSBlockReader(map_fname, max_samples=max_samples)
+            
+            if density_fname != None:
+                # In memory-mapped slabs, by distance bin
+                mapper3d = maptools.OutOfCoreMapper3D(los_EBV.nside, los_EBV.pix_idx,
+                                                      los_EBV, los_EBV.DM_min,
+                                                      los_EBV.DM_max, density_fname,
+                                                      key=los_EBV.key)
+            else:
+                # One map per posterior sample
+                mapper3d = maptools.SampleMajorMapper3D(los_EBV.nside, los_EBV.pix_idx,
+                                                        los_EBV, los_EBV.DM_min,
+                                                        los_EBV.DM_max, sample_fname,
+                                                        key=los_EBV.key)
+            
+            los_EBV.close()
+        
+        return prepare_mapper3d(mapper3d, density_grid, reduction, n_procs)
+    
+    with timing.span('load'):
+        mapper = maptools.LOSMapper(fname, max_samples=max_samples) # load data and map to pixel
+    
     nside = mapper.data.nside[0]
     pix_idx = mapper.data.pix_idx[0]
     los_EBV = mapper.data.los_EBV[0]
     DM_min, DM_max = mapper.data.DM_EBV_lim[:2]
     
-    mapper3d = maptools.Mapper3D(nside, pix_idx, los_EBV,
-                                 DM_min, DM_max)  # map from pixel to cart
+    with timing.span('mapper_build'):
+        mapper3d = maptools.Mapper3D(nside, pix_idx, los_EBV,
+                                     DM_min, DM_max)  # map from pixel to cart
     
+    # Free the line-of-sight data before forking the workers
+    del mapper, los_EBV
+    
+    return prepare_mapper3d(mapper3d, density_grid, reduction, n_procs)
+
+
+def prepare_mapper3d(mapper3d, density_grid, reduction, n_procs):
+    '''
+    Reduce the map, and set up its density grid, before the workers
+    are forked (see load_mapper3d).
+    '''
+    
+    if reduction != 'sample':
+        with timing.span('reduce'):
+            mapper3d.reduce_map(reduction, n_procs=n_procs)
+    
+    if density_grid != None:
+        with timing.span('grid_build'):
+            mapper3d.use_grid(get_density_grid(mapper3d, **density_grid))
+    
+    return mapper3d
+
+
+def get_density_grid(mapper3d, fname=None, r_max=300., spacing=2.,
+                               reduction='sample', oversample=1, order=1,
+                               bricks=False, n_levels=5, brick_size=8,
+                               n_procs=1):
+    '''
+    Returns the density of the map on a Cartesian grid (see
+    maptools.Mapper3D.resample_to_grid), or in sparse bricks if <bricks>
+    is True (see maptools.Mapper3D.build_bricks, which uses <n_procs>
+    processes). The grid is loaded from <fname>, if it was saved there
+    with the same settings. Otherwise, the map is resampled, and the
+    grid is saved to <fname>.
+    '''
+    
+    if (fname != None) and os.path.isfile(fname):
+        try:
+            if bricks:
+                grid = maptools.load_brick_volume(fname)
+                same_bricks = ( (grid.n_levels == n_levels)
+                                and (grid.brick_size == brick_size) )
+            else:
+                grid = maptools.load_density_grid(fname, order=order)
+                same_bricks = True
+        except KeyError:
+            # A grid of the other kind
+            grid, same_bricks = None, False
+        
+        if ( same_bricks and (grid.spacing == spacing) and (grid.r_max >= r_max)
+             and (grid.reduction == reduction) ):
+            print 'Loaded density grid %s.' % fname
+            return grid
+        
+        print 'Density grid %s has different settings. Resampling the map.' % fname
+    
+    if bricks:
+        print 'Resampling the map into bricks out to %.0f pc, every %.1f pc or more ...' % (r_max, spacing)
+        
+        grid = mapper3d.build_bricks(r_max, spacing, reduction=reduction,
+                                     n_levels=n_levels, brick_size=brick_size,
+                                     n_procs=n_procs, verbose=True)
+    else:
+        print 'Resampling the map onto a grid out to %.0f pc, every %.1f pc ...' % (r_max, spacing)
+        
+        grid = mapper3d.resample_to_grid(r_max, spacing, reduction=reduction,
+                                         oversample=oversample, verbose=True)
+        grid.order = order
+    
+    if fname != None:
+        # Several hosts of a frame farm may write the grid at once
+        tmp_fname = maptools.tmp_fname(fname)
+        grid.save(tmp_fname)
+        os.rename(tmp_fname, fname)
+    
+    return grid
+
+
+def density_grid_opts(density_grid, plot_props, n_procs=1):
+    '''
+    Keyword arguments of get_density_grid, from the "density_grid"
+    option of a job (True, or a dictionary), or None for no grid. By
+    default, the grid has the reduction of the rendered map, and bricks
+    are built by <n_procs> processes.
+    '''
+    
+    if not density_grid:
+        return None
+    
+    opts = {} if (density_grid is True) else dict(density_grid)
+    opts.setdefault('reduction', plot_props.get('reduction', 'sample'))
+    
+    if opts.get('bricks', False):
+        opts.setdefault('n_procs', n_procs)
+    
+    return opts
+
+
+def run_frame_workers(mapper3d, frame_q, n_procs,
+                      map_fname, plot_props,
+                      camera_pos, camera_props,
+                      label_props, labels, axis_on,
+                      **kwargs):
+    '''
+    Fork <n_procs> worker processes, which share <mapper3d> and pull
+    frame numbers from <frame_q>, until they get None (see
+    gen_frame_worker).
+    '''
+    
+    # Set up lock to allow first image to be written without interference btw/ processes
+    lock = multiprocessing.Lock()
+    
+    # Spawn worker processes to plot images
+    procs = []
     
     for i in xrange(n_procs):
         
@@ -198,8 +768,6 @@ def gen_movie_frames(map_fname, plot_props,
     # Exit the completed processes    
     for p in procs:
         p.join()
-    
-    print 'Done.'
 
 # TODO: remove loading data from the Queue, make it a buffer 
 # share loaded data in memory
@@ -208,12 +776,38 @@ def gen_frame_worker(mapper3d, frame_q, lock,
                      camera_pos, camera_props,
                      label_props, labels, axis_on,
                      **kwargs):
+    # Job ledger, shared by all workers
+    ledger = kwargs.pop('ledger')
+    poses = kwargs.pop('poses')
+    max_retries = kwargs.pop('max_retries', 2)
+    t_run = kwargs.pop('t_run', None)
+    
+    # Queue to send frames to a video encoder, instead of writing them
+    frame_sink = kwargs.get('frame_sink', None)
+    
     # Copy to avoid overwriting original
     plot_props = plot_props.copy()
-    fname_base = plot_props['fname']
     
-    if fname_base.endswith('.png'):
-        fname_base = fname_base[:-4]
+    # A stereo pair renders both eyes of each frame together
+    stereo = (type(camera_pos) is list)
+    
+    # Reprojection of the previous frame rendered by this worker. The
+    # option is either True, or the keyword arguments of TemporalCache.
+    temporal_cache = kwargs.pop('temporal_cache', False)
+    
+    if temporal_cache and not stereo:
+        if temporal_cache is True:
+            temporal_cache = {}
+        
+        kwargs['temporal_cache'] = maptools.TemporalCache(**temporal_cache)
+    
+    if stereo:
+        fname_base = [get_fname_base({'fname': f}) for f in plot_props['fname']]
+    else:
+        fname_base = get_fname_base(plot_props)
+    
+    # Frames can also be written as raw arrays (see gen_frame)
+    ext = plot_props.get('frame_format', 'png')
     
     # Reseed random number generator
     t = time.time()
@@ -229,49 +823,178 @@ def gen_frame_worker(mapper3d, frame_q, lock,
     first_img = True
     np.seterr(all='ignore')
     
+    # Frames are handed out in lists (of consecutive frames, or of one),
+    # followed by a None for each worker. Waiting for them, rather than
+    # stopping at the first empty get, does not miss frames that are
+    # still on their way into the queue.
+    pending = []
+    
     while True:
-        try:
-            k = frame_q.get_nowait()
-            t_start = time.time()
-            print 'Projecting frame %d ...' % k
+        if len(pending) == 0:
+            pending = frame_q.get()
             
-            # Copy/modify keyword arguments
-            # (to avoid pop() from removing keywords)
-            cam_props_cpy = camera_props.copy()
-            plot_props_cpy = plot_props.copy()
-            label_props_cpy = label_props.copy()
-            kwargs_cpy = kwargs.copy()
+            if pending == None:
+                print 'Worker finished.'
+                return
             
-            plot_props_cpy['fname'] = fname_base + '.%05d.png' % k
+            if not isinstance(pending, list):
+                pending = [pending]
+        
+        k = pending.pop(0)
+        
+        t_start = time.time()
+        print 'Projecting frame %d ...' % k
+        
+        # Copy/modify keyword arguments
+        # (to avoid pop() from removing keywords)
+        cam_props_cpy = camera_props.copy()
+        plot_props_cpy = plot_props.copy()
+        label_props_cpy = label_props.copy()
+        kwargs_cpy = kwargs.copy()
+        
+        if stereo:
+            frame_fname = [f + '.%05d.%s' % (k, ext) for f in fname_base]
+            camera_pos_frame = [{
+                    'xyz': c['xyz'][k],
+                    'alpha': c['alpha'][k],
+                    'beta': c['beta'][k]
+                } for c in camera_pos]
+            f_render = gen_stereo_frame
+        else:
+            frame_fname = fname_base + '.%05d.%s' % (k, ext)
             camera_pos_frame = {
                 'xyz': camera_pos['xyz'][k],
                 'alpha': camera_pos['alpha'][k],
                 'beta': camera_pos['beta'][k]
             }
+            f_render = gen_frame
+        
+        plot_props_cpy['fname'] = frame_fname
+        
+        kwargs_cpy['frame_key'] = (k, 0)
+        
+        if first_img:
+            first_img = False
+            kwargs['lock'] = lock
+        else:
+            kwargs['lock'] = None
+        
+        ledger.record(k, 'started', pose=poses[k])
+        
+        # Tag the timing spans of this frame
+        timing.set_context(frame=k)
+        
+        # Generate frame
+        try:
+            with timing.span('frame'):
+                f_render(mapper3d, camera_pos_frame, cam_props_cpy,
+                                   plot_props_cpy, label_props_cpy,
+                                   labels, axis_on,**kwargs_cpy)
+        except Exception as err:
+            # Record the failure, and retry the frame straight away if
+            # it has not failed too often already. It is kept by this
+            # worker, so that a run of frames stays in order.
+            traceback.print_exc()
             
-            if first_img:
-                first_img = False
-                kwargs['lock'] = lock
-            else:
-                kwargs['lock'] = None
-            
-            # Generate frame
-            logfile=open('log.txt', 'a')
-            logfile.write('\n')
-            logfile.write('Frame%d, time except gen_frame %.1f s\n' % (k, time.time()-t_start))
-            gen_frame(mapper3d, camera_pos_frame, cam_props_cpy,
-                                plot_props_cpy, label_props_cpy,
-                                labels, axis_on,**kwargs_cpy)
+            n_failed = ledger.n_failures(k, since=t_run) + 1
+            ledger.record(k, 'failed', pose=poses[k], error=repr(err))
             
-            t_end = time.time()
-            print 't = %.1f s' % (t_end - t_start)
-            # logfile.write('\n')
-            logfile.write('Frame%d = %.1f s \n' %(k, t_end-t_start))
-            logfile.close()
+            if n_failed <= max_retries:
+                print 'Frame %d failed. Retrying.' % k
+                pending.insert(0, k)
             
-        except Queue.Empty:
-            print 'Worker finished.'
-            return
+            continue
+        
+        t_end = time.time()
+        print 't = %.1f s' % (t_end - t_start)
+        
+        if frame_sink != None:
+            # No files to check
+            ledger.record(k, 'done', pose=poses[k], t=t_end-t_start)
+            continue
+        
+        if stereo:
+            checksum = [file_checksum(f) for f in frame_fname]
+        else:
+            checksum = file_checksum(frame_fname)
+        
+        ledger.record(k, 'done', pose=poses[k],
+                                 fname=frame_fname,
+                                 checksum=checksum,
+                                 t=t_end-t_start)
+
+def gen_stereo_frame(mapper3d, camera_pos, camera_props,
+                               plot_props, label_props,
+                               labels, axis_on, **kwargs):
+    '''
+    Render the left and right eyes of a stereo pair together. The
+    <camera_pos> and plot_props['fname'] are lists with an entry for
+    each eye. The ray marching is shared between the eyes (see
+    Mapper3D.proj_stereo_pair), after which each eye is finished
+    (labelled and plotted) by gen_frame.
+    '''
+    
+    proj_name = camera_props['proj_name']
+    fov = camera_props['fov']
+    n_x = camera_props['n_x']
+    n_y = camera_props['n_y']
+    dr = camera_props['dr']
+    
+    if not stereo_pass_supported(camera_props):
+        raise ValueError('Stereo pairs can only be rendered with the '
+                         'stereographic projection, not "%s"' % proj_name)
+    
+    n_averaged = plot_props.get('n_averaged', 1)
+    reduction = plot_props.get('reduction', 'sample')
+    n_stack = plot_props.get('n_stack', 20)
+    randomize_dist = plot_props.get('randomize_dist', False)
+    randomize_ang = plot_props.get('randomize_ang', False)
+    parallax = plot_props.pop('stereo_parallax', 1.)
+    verbose = kwargs.get('verbose', False)
+    
+    # Both eyes march the same distances, measured from the midpoint
+    r_mid = 0.5 * (np.array(camera_pos[0]['xyz']) + np.array(camera_pos[1]['xyz']))
+    z_0, n_z = get_z_range(r_mid, camera_props)
+    
+    n_images = n_z / n_stack + (1 if n_z % n_stack else 0)
+    img = [np.empty((n_averaged, n_images, 2*n_y+1, 2*n_x+1), dtype='f8')
+           for eye in xrange(2)]
+    
+    args = [(c['alpha'], c['beta'], n_x, n_y, fov, c['xyz'], dr, z_0)
+            for c in camera_pos]
+    
+    np.seterr(all='ignore')
+    
+    for k in xrange(n_averaged):
+        if verbose:
+            print 'Rendering stereo pair %d of %d ...' % (k+1, n_averaged)
+        
+        with timing.span('ray_march', eye='both'):
+            img[0][k], img[1][k] = mapper3d.proj_stereo_pair(n_z, reduction,
+                                                             args[0], args[1],
+                                                             parallax=parallax,
+                                                             stack=n_stack,
+                                                             randomize_dist=randomize_dist,
+                                                             randomize_ang=randomize_ang,
+                                                             verbose=verbose)
+    
+    k_frame = kwargs.pop('frame_key', (0, 0))[0]
+    
+    for eye in xrange(2):
+        timing.set_context(eye=eye)
+        
+        plot_props_eye = plot_props.copy()
+        plot_props_eye['fname'] = plot_props['fname'][eye]
+        
+        gen_frame(mapper3d, camera_pos[eye], camera_props.copy(),
+                  plot_props_eye, label_props.copy(),
+                  labels, axis_on,
+                  img=img[eye], z_range=(z_0, n_z),
+                  frame_key=(k_frame, eye),
+                  **kwargs.copy())
+    
+    timing.set_context(eye=None)
+
 
 def gen_frame(mapper3d, camera_pos, camera_props,
                         plot_props, label_props,
@@ -302,17 +1025,21 @@ def gen_frame(mapper3d, camera_pos, camera_props,
     fov = camera_props['fov']
     n_x = camera_props['n_x']
     n_y = camera_props['n_y']
-    n_z = camera_props['n_z']
     dr = camera_props['dr']
-    z_0 = camera_props['z_0']
+    
+    # Size of the frame, in the units of proj_points
+    fov_x, fov_y = frame_extent(proj_name, fov, n_x, n_y)
     
     # If z_0 is a location (x,y,z), then use the
     # distance to that location as the starting distance
-    if hasattr(z_0, '__len__'):
-        displacement = np.array(r_cam) - np.array(z_0)
-        z_0 = np.sqrt(np.sum(displacement**2))
-        n_z = int(round(n_z - z_0/dr))
-        
+    z_range = kwargs.pop('z_range', None)
+    
+    if z_range == None:
+        z_0, n_z = get_z_range(r_cam, camera_props)
+    else:
+        z_0, n_z = z_range
+    
+    if hasattr(camera_props['z_0'], '__len__'):
         print 'z_0 = %.3f, n_z = %d' % (z_0, n_z)
     
     # Read additional image/plotting settings
@@ -331,9 +1058,16 @@ def gen_frame(mapper3d, camera_pos, camera_props,
     randomize_ang = plot_props.pop('randomize_ang', False)
     foreground = plot_props.pop('foreground', (0, 0, 0))
     background = plot_props.pop('background', (255, 255, 255))
+    writer = plot_props.pop('writer', None)
+    frame_format = plot_props.pop('frame_format', 'png')
+    overlays = plot_props.pop('overlays', False)
+    
+    # Frames without axes are written directly, without matplotlib
+    if writer == None:
+        writer = 'matplotlib' if axis_on else 'direct'
     
     R *= np.log(10.) / 5.
-    sigma *= (2.*n_x+1.) / fov
+    sigma *= (2.*n_x+1.) / fov_x
     
     # Read general label properties
     c_txt = label_props.pop('text_color', (0, 166, 255))
@@ -346,105 +1080,142 @@ def gen_frame(mapper3d, camera_pos, camera_props,
     # Misc settings
     verbose = kwargs.pop('verbose', False)
     
+    # Image stack that has already been rendered (e.g., as part of a stereo pair)
+    img = kwargs.pop('img', None)
+    
+    # Previous frame, to reproject into this one (see maptools.TemporalCache)
+    temporal_cache = kwargs.pop('temporal_cache', None)
+    
+    # Queue to send the frame to a video encoder, instead of writing it,
+    # and the (frame number, eye) to send it with
+    frame_sink = kwargs.pop('frame_sink', None)
+    frame_key = kwargs.pop('frame_key', (0, 0))
+    
     #
     # Generate image stack
     #
     
     n_images = n_z / n_stack + (1 if n_z % n_stack else 0)
     d_images = z_0 + np.linspace(0., (n_z-1.)*dr, n_images)
-    img = np.empty((n_averaged, n_images, 2*n_y+1, 2*n_x+1), dtype='f8')
     
     np.seterr(all='ignore')
     
-    for k in xrange(n_averaged):
+    if (img is None) and (temporal_cache != None) and temporal_cache.supports(proj_name):
+        with timing.span('ray_march'):
+            img = temporal_cache.render(mapper3d, proj_name, n_z, reduction,
+                                        (alpha, beta, n_x, n_y, fov, r_cam, dr, z_0),
+                                        stack=n_stack,
+                                        n_averaged=n_averaged,
+                                        randomize_ang=randomize_ang,
+                                        verbose=verbose)[None]
+        n_render = 0
+    elif img is None:
+        img = np.empty((n_averaged, n_images, 2*n_y+1, 2*n_x+1), dtype='f8')
+        n_render = n_averaged
+    else:
+        n_render = 0
+    
+    for k in xrange(n_render):
         if verbose:
             print 'Rendering image %d of %d ...' % (k+1, n_averaged)
         
-        img[k] = mapper3d.proj_map_in_slices(proj_name, n_z, reduction,
-                                             alpha, beta, n_x, n_y, fov,
-                                             r_cam, dr, z_0, stack=n_stack,
-                                             randomize_dist=randomize_dist,
-                                             randomize_ang=randomize_ang,
-                                             verbose=verbose)
-    
-    img = np.mean(img, axis=0)
-    img *= dr  # Convert from mean dE(B-V)/ds to E(B-V)
-    
-    # Smooth image
-    if sigma > 1.e-10:
-        #print 'Smoothing with sigma = %.3f' % sigma
-        img = scipy.ndimage.filters.gaussian_filter(img, [0,sigma,sigma])
-    
-    # Convert image to opacity
-    # As R -> 0, img -> optical depth
-    img = 1. - np.exp(-R*img)
-    img *= scale_opacity
-    
-    idx = img > 1.
-    img[idx] = 1.
-    
-    # Gamma bending
-    if gamma != 1.:
-        img = np.power(img, 1./gamma)
-    
-    # Flip images properly
-    img = np.swapaxes(img, 1, 2)[:,::-1,:]
+        with timing.span('ray_march'):
+            img[k] = mapper3d.proj_map_in_slices(proj_name, n_z, reduction,
+                                                 alpha, beta, n_x, n_y, fov,
+                                                 r_cam, dr, z_0, stack=n_stack,
+                                                 randomize_dist=randomize_dist,
+                                                 randomize_ang=randomize_ang,
+                                                 verbose=verbose,
+                                                 **camera_kwargs(camera_props))
+    
+    with timing.span('smoothing'):
+        img = np.mean(img, axis=0)
+        img *= dr  # Convert from mean dE(B-V)/ds to E(B-V)
+        
+        # Smooth image
+        if sigma > 1.e-10:
+            #print 'Smoothing with sigma = %.3f' % sigma
+            img = scipy.ndimage.filters.gaussian_filter(img, [0,sigma,sigma])
+        
+        # Convert image to opacity
+        # As R -> 0, img -> optical depth
+        img = 1. - np.exp(-R*img)
+        img *= scale_opacity
+        
+        idx = img > 1.
+        img[idx] = 1.
+        
+        # Gamma bending
+        if gamma != 1.:
+            img = np.power(img, 1./gamma)
+        
+        # Flip images properly
+        img = np.swapaxes(img, 1, 2)[:,::-1,:]
     
     # Initialize class to stack images and text
     stacker = AlphaStacker(img, d_images)
     
-    logfile = open('log.txt', 'a')
-    start = time.time()
-    
     #
     # Set up labels
     #
     
-    for key, ((l, b, d), (ha, va, dph, dth)) in labels.iteritems():
-        r_pts = np.array([lbd2xyz(l, b, d)])
-        
-        tmp = proj_points(r_pts[:,0], r_pts[:,1], r_pts[:,2],
-                          r_cam, alpha, beta, proj_name, fov,
-                          dph=dph, dth=dth)
-        in_bounds = tmp[2]
-        x_proj = tmp[0]
-        y_proj = tmp[1]
-        
-        if ( (not in_bounds[0]) or
-             (abs(x_proj[0]) > fov/2.-2.) or
-             (abs(y_proj[0]) > float(n_y)/float(n_x)*fov/2.-2.) ):
-            continue
-        
-        x = x_proj[0]
-        y = y_proj[0]
-        
-        x += fov/2.
-        y += float(n_y)/float(n_x) * fov/2.
-        
-        x *= (2.*n_x+1.) / float(fov)
-        y *= (2.*n_y+1.) / (float(n_y) / float(n_x) * float(fov))
-        y = (2*n_y+1) - y
-        
-        d = np.sqrt(np.sum( (r_pts[0]-r_cam)**2 ))
-        
-        if (not np.isfinite(d)) or (d < 10.):
-            continue
-        
-        fontsize = fontsize_base / np.sqrt(d / 100.)
-        stroke_width = fontsize / 26.
-        #print stroke_width
-        
-        stacker.insert_text(key, (x, y), d,
-                            ha=ha, va=va,
-                            font=font,
-                            fontsize=fontsize,
-                            fontcolor=c_txt,
-                            stroke_width=stroke_width,
-                            stroke_color=c_stroke)
-                            
+    with timing.span('label_layout'):
+        for key, ((l, b, d), (ha, va, dph, dth)) in labels.iteritems():
+            r_pts = np.array([lbd2xyz(l, b, d)])
+            
+            tmp = proj_points(r_pts[:,0], r_pts[:,1], r_pts[:,2],
+                              r_cam, alpha, beta, proj_name, fov,
+                              dph=dph, dth=dth,
+                              ipd=camera_props.get('ipd', 10.))
+            
+            d = np.sqrt(np.sum( (r_pts[0]-r_cam)**2 ))
+            
+            if (not np.isfinite(d)) or (d < 10.):
+                continue
+            
+            fontsize = fontsize_base / np.sqrt(d / 100.)
+            stroke_width = fontsize / 26.
+            #print stroke_width
+            
+            # An ODS camera sees each label twice, once with each eye
+            for x, y, visible in zip(*tmp):
+                if ( (not visible) or
+                     (abs(x) > fov_x/2.-2.) or
+                     (abs(y) > fov_y/2.-2.) ):
+                    continue
+                
+                x += fov_x/2.
+                y += fov_y/2.
+                
+                x *= (2.*n_x+1.) / fov_x
+                y *= (2.*n_y+1.) / fov_y
+                y = (2*n_y+1) - y
+                
+                stacker.insert_text(key, (x, y), d,
+                                    ha=ha, va=va,
+                                    font=font,
+                                    fontsize=fontsize,
+                                    fontcolor=c_txt,
+                                    stroke_width=stroke_width,
+                                    stroke_color=c_stroke)
+    
+    if writer == 'direct':
+        write_frame_direct(stacker, plt_fname,
+                           r_cam, alpha, beta, proj_name, fov,
+                           n_x, n_y, figsize, dpi,
+                           oversample=oversample,
+                           foreground=foreground,
+                           background=background,
+                           overlays=overlays,
+                           frame_format=frame_format,
+                           frame_sink=frame_sink,
+                           frame_key=frame_key)
+        del img
+        return
+    
     # Plot image
-    w = fov/2.
-    h = float(n_y)/float(n_x) * w
+    w = fov_x/2.
+    h = fov_y/2.
     extent = [-w, w, h, -h]
     
     fig = plt.figure(figsize=figsize, dpi=dpi)
@@ -455,14 +1226,11 @@ def gen_frame(mapper3d, camera_pos, camera_props,
     else:
         ax = fig.add_subplot(1,1,1)
     
-    scene_time = time.time()
     # Render scene
-    img_rendered = stacker.render(oversample=oversample,
-                                  fg=foreground,
-                                  bg=background)
-                                  
-    logfile.write('render scene time %.2f' % (time.time()-scene_time))
-    
+    with timing.span('compositing'):
+        img_rendered = stacker.render(oversample=oversample,
+                                      fg=foreground,
+                                      bg=background)
     
     # Save PIL image
     #pimg = Image.fromarray((255.*img_rendered[:,:,:3]).astype('u1'), mode='RGB')
@@ -488,29 +1256,7 @@ def gen_frame(mapper3d, camera_pos, camera_props,
 
     if axis_on: 
         # Project position of Sun and coord-system axes
-        r_ovplt = {}
-    
-        r_ovplt['Sun'] = np.array([[0., 0., 0.]])
-    
-        range_tmp = np.linspace(-0.2, 1., 1000)
-        zeros_tmp = np.zeros(range_tmp.size)
-        const_tmp = -25. * np.ones(range_tmp.size)
-    
-        r_ovplt['xaxis'] = np.vstack([25.*range_tmp, zeros_tmp, const_tmp]).T
-        r_ovplt['yaxis'] = np.vstack([zeros_tmp, 25.*range_tmp, const_tmp]).T
-        r_ovplt['zaxis'] = np.vstack([zeros_tmp, zeros_tmp, 25.*(range_tmp-1.)]).T
-    
-        x_proj = {}
-        y_proj = {}
-    
-        for key, r_pts in r_ovplt.iteritems():
-            tmp = proj_points(r_pts[:,0], r_pts[:,1], r_pts[:,2],
-                              r_cam, alpha, beta, proj_name, fov)
-            in_bounds = tmp[2]
-            x_proj[key] = tmp[0][in_bounds]
-            y_proj[key] = tmp[1][in_bounds]
-        
-            #print '%s: %d in bounds' % (key, np.sum(in_bounds))
+        x_proj, y_proj = proj_overlays(r_cam, alpha, beta, proj_name, fov)
     
         # Dot for the Sun
         ax.scatter(x_proj['Sun'], y_proj['Sun'],
@@ -554,10 +1300,23 @@ def gen_frame(mapper3d, camera_pos, camera_props,
     
     lock = kwargs.pop('lock', None)
     
+    if frame_sink != None:
+        # Send the pixels of the figure to the video encoder
+        with timing.span('encode'):
+            fig.canvas.draw()
+            w_px, h_px = fig.canvas.get_width_height()
+            rgb = np.frombuffer(fig.canvas.tostring_rgb(), dtype='u1')
+            frame_sink.put(frame_key + (rgb.reshape(h_px, w_px, 3),))
+        
+        plt.close(fig)
+        del img
+        return
+    
     if lock != None:
         lock.acquire()
     
-    fig.savefig(plt_fname, dpi=dpi)#, bbox_inches='tight')
+    with timing.span('encode'):
+        fig.savefig(plt_fname, dpi=dpi)#, bbox_inches='tight')
     
     if lock != None:
         lock.release()
@@ -567,12 +1326,138 @@ def gen_frame(mapper3d, camera_pos, camera_props,
     
 
 
-def main():
-    #grand_tour_path(n_frames=100)
-    #circle_local()
-    from config import map_fname, plot_props, camera_props, label_props, camera_pos, n_procs, axis_on, stop_f
+def proj_overlays(r_cam, alpha, beta, proj_name, fov):
+    '''
+    Project the position of the Sun and the axes of the Galactic
+    coordinate system. Returns dictionaries of the projected x and y
+    coordinates (in degrees) of the points in bounds.
+    '''
+    
+    r_ovplt = {}
+    
+    r_ovplt['Sun'] = np.array([[0., 0., 0.]])
+    
+    range_tmp = np.linspace(-0.2, 1., 1000)
+    zeros_tmp = np.zeros(range_tmp.size)
+    const_tmp = -25. * np.ones(range_tmp.size)
+    
+    r_ovplt['xaxis'] = np.vstack([25.*range_tmp, zeros_tmp, const_tmp]).T
+    r_ovplt['yaxis'] = np.vstack([zeros_tmp, 25.*range_tmp, const_tmp]).T
+    r_ovplt['zaxis'] = np.vstack([zeros_tmp, zeros_tmp, 25.*(range_tmp-1.)]).T
+    
+    x_proj = {}
+    y_proj = {}
+    
+    for key, r_pts in r_ovplt.iteritems():
+        tmp = proj_points(r_pts[:,0], r_pts[:,1], r_pts[:,2],
+                          r_cam, alpha, beta, proj_name, fov)
+        in_bounds = tmp[2]
+        x_proj[key] = tmp[0][in_bounds]
+        y_proj[key] = tmp[1][in_bounds]
+    
+    return x_proj, y_proj
+
+
+def write_frame_direct(stacker, fname,
+                       r_cam, alpha, beta, proj_name, fov,
+                       n_x, n_y, figsize, dpi,
+                       oversample=2,
+                       foreground=(0, 0, 0),
+                       background=(255, 255, 255),
+                       overlays=False,
+                       frame_format='png',
+                       frame_sink=None, frame_key=(0, 0)):
+    '''
+    Render the stacked image and write it straight to a PNG (or a raw
+    .npy array) of the same size as the matplotlib figure, without
+    axes or a title. If <overlays> is True, the Sun and the axes of
+    the Galactic coordinate system are drawn on top. If <frame_sink>
+    is given, the frame is put on it, together with <frame_key>,
+    instead of being written.
+    '''
+    
+    with timing.span('compositing'):
+        img_rendered = stacker.render(oversample=oversample,
+                                      fg=foreground,
+                                      bg=background)
+    
+    with timing.span('encode'):
+        rgb = frame_writer.to_rgb8(img_rendered)
+        
+        width, height = figsize[0]*dpi, figsize[1]*dpi
+        rgb = frame_writer.resize_frame(rgb, (width, height))
+        
+        # The overlays are lines, which are not split between the eyes of an ODS frame
+        if overlays and (proj_name.lower() != 'ods'):
+            x_proj, y_proj = proj_overlays(r_cam, alpha, beta, proj_name, fov)
+            
+            # Convert from degrees to pixels
+            fov_x, fov_y = frame_extent(proj_name, fov, n_x, n_y)
+            w = fov_x/2.
+            h = fov_y/2.
+            
+            for key in x_proj:
+                x_proj[key] = (x_proj[key] + w) * rgb.shape[1] / (2.*w)
+                y_proj[key] = (h - y_proj[key]) * rgb.shape[0] / (2.*h)
+            
+            pt = dpi / 72.
+            
+            for key in ['xaxis', 'yaxis', 'zaxis']:
+                frame_writer.draw_line(rgb, x_proj[key], y_proj[key],
+                                       2.*pt, (0, 0, 255), alpha=0.25)
+                frame_writer.draw_line(rgb, x_proj[key], y_proj[key],
+                                       1.25*pt, (30, 158, 227), alpha=0.9)
+            
+            # Dot for the Sun (marker areas of 24 and 8 points^2)
+            frame_writer.draw_dots(rgb, x_proj['Sun'], y_proj['Sun'],
+                                   0.5*np.sqrt(24.)*pt, (17, 105, 153), alpha=0.75)
+            frame_writer.draw_dots(rgb, x_proj['Sun'], y_proj['Sun'],
+                                   0.5*np.sqrt(8.)*pt, (73, 158, 204), alpha=1.)
+        
+        if frame_sink != None:
+            frame_sink.put(frame_key + (rgb,))
+        else:
+            frame_writer.write_frame(rgb, fname, fmt=frame_format)
+
+
+def render_job(job):
+    '''
+    Render all the frames of a job (see config.py).
+    '''
+    
+    map_fname = job['map_fname']
+    camera_props = job['camera_props']
+    label_props = job['label_props']
+    n_procs = job['n_procs']
+    axis_on = job['axis_on']
+    render_kwargs = job.get('render_kwargs', {}).copy()
+    
+    # Restart from frame <stop_f>
+    render_kwargs['first_frame'] = job['stop_f'] or 0
+    
+    labels = get_labels()
+    
+    for plot_props_eye, camera_pos_eye in get_job_passes(job):
+        n_procs_eye = min([n_procs, get_n_frames(camera_pos_eye)])
+        
+        # Tag the timing spans with the frames being rendered
+        timing.set_context(render=get_fname_base(plot_props_eye))
+        
+        gen_movie_frames(map_fname, plot_props_eye,
+                         camera_pos_eye, camera_props,
+                         label_props, labels,
+                         n_procs=n_procs_eye, verbose=True, axis_on=axis_on,
+                         **render_kwargs)
+    
+    timing.set_context(render=None)
+
+
+def get_labels():
+    '''
+    Points to project to camera coordinates, and how to place their
+    labels.
+    '''
     
-    # Points to project to camera coordinates
     labels = {
         'Sol': ((0., 0., 0.), ('left', 'top', 1., -0.75)),
         u'0°': ((0, -32.01, 47.17), ('center', 'center', 0., 0.)),
@@ -593,51 +1478,96 @@ def main():
         u'ρ Oph': ((-5., 17., 200.), ('center', 'center', 25., 0.)),
         'Galactic Center': ((0., 0., 8000.), ('center', 'center', 0., 0.)),
     }
-    print('||||||||||||carera_pos', type(camera_pos))
+    
+    return labels
+
+
+def stereo_pass_supported(camera_props):
+    '''
+    Whether both cameras of a side-by-side render can be rendered
+    together, by gen_stereo_frame: only with the stereographic
+    projection.
+    '''
+    
+    return camera_props['proj_name'].lower() in ('stereo', 'stereographic')
+
+
+def get_job_passes(job):
+    '''
+    Returns a list of (plot_props, camera_pos) for each camera of a
+    job: one for a single camera, or a left and a right camera for a
+    side-by-side render.
+    
+    If job['stereo_pass'] is True, and the projection supports it (see
+    stereo_pass_supported), the left and right cameras of a side-by-side
+    render are instead rendered together in one pass, in which the
+    filename and camera position are lists (left, right).
+    '''
+    
+    plot_props = job['plot_props']
+    camera_pos = job['camera_pos']
+    
+    f = plot_props['fname']
+    
     if type(camera_pos) is dict:
-        # Generate frame
-        n_procs = min([n_procs, len(camera_pos['alpha'])])
-        
-        if stop_f: 
-            f = plot_props['fname']
-            plot_props['fname'] = f.split('.png')[0]+'-stop.png'
-        gen_movie_frames(map_fname, plot_props,
-                         camera_pos, camera_props,
-                         label_props, labels,
-                         n_procs=n_procs, verbose=True, axis_on=axis_on)
-                           
+        eyes = [('', camera_pos)]
     elif type(camera_pos) is list:
-        # render left camera
-        f = plot_props['fname']
-        plot_props['fname'] = f.split('.png')[0]+'-left.png'
-        if stop_f:
-            plot_props['fname'] = f.split('.png')[0]+'-left-stop.png'
-        n_procs = min([n_procs, len(camera_pos[0]['alpha'])])
-        gen_movie_frames(map_fname, plot_props,
-                         camera_pos[0], camera_props,
-                         label_props, labels,
-                         n_procs=n_procs, verbose=True, axis_on=axis_on)
-
-        # render right camera                 
-        plot_props['fname'] = f.split('.png')[0]+'-right.png'
-        if stop_f:
-            plot_props['fname'] = f.split('.png')[0]+'-right-stop.png'
-        n_procs = min([n_procs, len(camera_pos[1]['alpha'])])                         
-        gen_movie_frames(map_fname, plot_props,
-                         camera_pos[1], camera_props,
-                         label_props, labels,
-                         n_procs=n_procs, verbose=True, axis_on=axis_on)
-    
-    # rename stop files with correct frame number
-    if stop_f:
-        plot_dir = plot_props['fname'].split(plot_props['fname'].split('/')[-1])[0]
-        for fn in os.listdir(plot_dir):
-            if 'stop' in fn:
-                pre_name  = fn.split('-stop')[0]
-                print(fn.split('.')[1])
-                img_num = int(fn.split('.')[1])
-                img_num = img_num + stop_f  # this part should goes to render3d.py
-                os.rename(plot_dir+fn, plot_dir+pre_name + '.%05d.png' % img_num)
+        # left and right cameras
+        eyes = [('-left', camera_pos[0]), ('-right', camera_pos[1])]
+    
+    passes = []
+    
+    for suffix, camera_pos_eye in eyes:
+        plot_props_eye = plot_props.copy()
+        plot_props_eye['fname'] = f.split('.png')[0] + suffix + '.png'
+        passes.append((plot_props_eye, camera_pos_eye))
+    
+    if ( (len(passes) == 2) and job.get('stereo_pass', False)
+         and stereo_pass_supported(job['camera_props']) ):
+        plot_props_pair = plot_props.copy()
+        plot_props_pair['fname'] = [p[0]['fname'] for p in passes]
+        passes = [(plot_props_pair, camera_pos)]
+    
+    return passes
+
+
+def main():
+    import argparse
+    
+    parser = argparse.ArgumentParser(
+        description='Render frames of a fly-through of the 3D dust map.',
+        add_help=True)
+    parser.add_argument('jobs', type=str, nargs='*',
+                        help='Job files (JSON or YAML), rendered one after another. '
+                             'If none are given, the settings are asked for on the terminal.')
+    parser.add_argument('--n-procs', type=int, default=None,
+                        help='Number of worker processes (overrides the job files).')
+    parser.add_argument('--trace', type=str, default=None,
+                        help='File to write the timing of each stage of the render to '
+                             '(default: trace-<date>-<time>.jsonl, next to the frames of the '
+                             'first job). Summarize it with timing.py.')
+    args = parser.parse_args()
+    
+    if len(args.jobs) == 0:
+        jobs = [config.prompt_job()]
+    else:
+        jobs = [config.load_job(fname) for fname in args.jobs]
+    
+    trace_fname = args.trace
+    
+    if trace_fname == None:
+        # Next to the output, rather than in the working directory
+        out_dir = os.path.dirname(jobs[0]['plot_props']['fname'])
+        trace_fname = os.path.join(out_dir, time.strftime('trace-%Y%m%d-%H%M%S.jsonl'))
+    
+    timing.start_trace(trace_fname)
+    
+    for job in jobs:
+        if args.n_procs != None:
+            job['n_procs'] = args.n_procs
+        
+        render_job(job)
+    
     return 0
 
 
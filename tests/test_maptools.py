@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#  
+#  test_maptools.py
+#  
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#  
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#  
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#  
+#  
+
+'''
+Tests of the reductions of the map over its samples. Run from the top
+directory of the repository:
+    
+    python -m unittest discover tests
+'''
+
+import numpy as np
+
+import os, sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import maptools
+
+
+def random_density(n_pix=50, n_samples=9, n_dist=7, seed=1):
+    '''
+    Random density, indexed by (pixel, sample, distance), with some
+    pixels masked (all samples NaN), and some with a single NaN or
+    infinite sample.
+    '''
+    
+    rs = np.random.RandomState(seed)
+    
+    x = rs.random_sample((n_pix, n_samples, n_dist)).astype('f4')
+    x[3] = np.nan
+    x[7, 2, 4] = np.nan
+    x[11, 0, 1] = np.inf
+    
+    return x
+
+
+class TestTakeMeasures(unittest.TestCase):
+    methods = ['mean', 'median', 'sigma', 84., 15.87]
+    
+    def setUp(self):
+        self.x = random_density()
+        self._err = np.seterr(all='ignore')
+    
+    def tearDown(self):
+        np.seterr(**self._err)
+    
+    def assert_same(self, a, b):
+        self.assertTrue(np.array_equal(np.isnan(a), np.isnan(b)))
+        self.assertTrue(np.allclose(a, b, rtol=1.e-5, atol=1.e-6, equal_nan=True))
+    
+    def test_finite_samples(self):
+        x = self.x[20:]
+        out = maptools.take_measures(x, self.methods)
+        
+        for m in self.methods:
+            self.assert_same(out[maptools.measure_name(m)],
+                             maptools.take_measure_nd(x, m))
+    
+    def test_nan_samples(self):
+        out = maptools.take_measures(self.x, self.methods, block_size=8)
+        
+        # np.percentile and np.mean give NaN wherever there are NaN samples
+        finite = np.ones(self.x.shape[0], dtype=np.bool)
+        finite[11] = False
+        
+        for m in self.methods:
+            self.assert_same(out[maptools.measure_name(m)][finite],
+                             maptools.take_measure_nd(self.x, m)[finite])
+        
+        self.assertTrue(np.all(np.isnan(out['median'][3])))
+        self.assertTrue(np.isnan(out['sigma'][7, 4]))
+        self.assertFalse(np.any(np.isnan(out['sigma'][7, :4])))
+    
+    def test_infinite_samples(self):
+        out = maptools.take_measures(self.x, self.methods)
+        
+        # The percentiles of entries with any non-finite sample are NaN
+        for m in ('median', 'sigma', '84', '15.87'):
+            self.assertTrue(np.isnan(out[m][11, 1]))
+        
+        self.assertEqual(out['mean'][11, 1], np.inf)
+    
+    def test_single_method(self):
+        for m in ('median', 'sigma', 84.):
+            out = maptools.take_measures(self.x, m)
+            
+            self.assertEqual(out.dtype.names, (maptools.measure_name(m),))
+            self.assert_same(out[maptools.measure_name(m)],
+                             maptools.take_measures(self.x, [m])[maptools.measure_name(m)])
+    
+    def test_unknown_method(self):
+        self.assertRaises(ValueError, maptools.take_measures, self.x, 'best')
+        self.assertRaises(ValueError, maptools.take_measures, self.x, ['median', 'foo'])
+    
+    def test_processes(self):
+        out = maptools.reduce_in_blocks(self.x, 'sigma', n_procs=2, block_size=8)
+        
+        self.assert_same(out, maptools.take_measures(self.x, 'sigma')['sigma'])
+    
+    def test_take_measure(self):
+        # take_measure reduces over all samples but the first
+        E = self.x[:, :, 4]
+        
+        for m in ('median', 'sigma'):
+            self.assert_same(maptools.take_measures(E[:, 1:], m)[m],
+                             maptools.take_measure(E, m))
+
+
+class TestMeasurePercentiles(unittest.TestCase):
+    def test_percentiles(self):
+        self.assertEqual(maptools.measure_percentiles('mean'), [])
+        self.assertEqual(maptools.measure_percentiles('median'), [50.])
+        self.assertEqual(maptools.measure_percentiles('sigma'), [15.87, 84.13])
+        self.assertEqual(maptools.measure_percentiles(84), [84.])
+    
+    def test_unknown(self):
+        self.assertRaises(ValueError, maptools.measure_percentiles, 'sample')
+        self.assertRaises(ValueError, maptools.measure_percentiles, True)
+    
+    def test_names(self):
+        self.assertEqual(maptools.measure_name('median'), 'median')
+        self.assertEqual(maptools.measure_name(84.), '84')
+        self.assertEqual(maptools.measure_name(15.87), '15.87')
+
+
+if __name__ == '__main__':
+    unittest.main()
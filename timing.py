@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#  
+#  timing.py
+#  
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#  
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#  
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#  
+#  
+
+'''
+Timing of the stages of a render.
+
+Code to be timed is wrapped in a named span:
+
+    with timing.span('ray_march'):
+        ...
+
+Once a trace has been started with start_trace(), every span is
+appended to it as one JSON line, tagged with the worker pid, the host
+and the current context (e.g., the frame number, set by set_context).
+Worker processes forked after start_trace() write to the same trace.
+Without a trace, spans do nothing.
+
+A trace can be summarised as percentiles of the time spent in each
+stage with
+
+    python timing.py trace.jsonl
+'''
+
+import numpy as np
+
+import os, sys, time
+import json
+import socket
+import fcntl
+
+
+_trace_fname = None
+_context = {}
+
+
+def start_trace(fname, append=False):
+    '''
+    Start a new trace, written to <fname>. If <append> is True, spans
+    are added to an existing trace (e.g., one shared by several hosts).
+    '''
+    
+    global _trace_fname
+    
+    _trace_fname = fname
+    
+    if not append:
+        f = open(fname, 'w')
+        f.close()
+    
+    write_event({'event': 'start', 'time': time.time()})
+
+
+def stop_trace():
+    global _trace_fname
+    _trace_fname = None
+
+
+def set_context(**kwargs):
+    '''
+    Set tags (e.g., frame=k) that are added to all following spans
+    in this process. Tags set to None are removed.
+    '''
+    
+    for key, value in kwargs.iteritems():
+        if value == None:
+            _context.pop(key, None)
+        else:
+            _context[key] = value
+
+
+def write_event(entry):
+    if _trace_fname == None:
+        return
+    
+    line = json.dumps(entry) + '\n'
+    
+    with open(_trace_fname, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.write(line)
+        f.flush()
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class span:
+    '''
+    Context manager that records the time taken by a named stage.
+    Additional keyword arguments are added to the record.
+    '''
+    
+    def __init__(self, name, **info):
+        self.name = name
+        self.info = info
+    
+    def __enter__(self):
+        self.t_start = time.time()
+        return self
+    
+    def __exit__(self, exc_type, exc_value, tb):
+        self.dt = time.time() - self.t_start
+        
+        if _trace_fname == None:
+            return False
+        
+        entry = {
+            'span': self.name,
+            't_start': self.t_start,
+            'dt': self.dt,
+            'pid': os.getpid(),
+            'host': socket.gethostname()
+        }
+        entry.update(_context)
+        entry.update(self.info)
+        
+        if exc_type != None:
+            entry['error'] = exc_type.__name__
+        
+        write_event(entry)
+        
+        return False
+
+
+def load_trace(fname):
+    '''
+    Returns the spans in a trace.
+    '''
+    
+    spans = []
+    
+    with open(fname, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            
+            if 'span' in entry:
+                spans.append(entry)
+    
+    return spans
+
+
+def summarize(spans, percentiles=(50., 90., 99.)):
+    '''
+    Returns a list of (stage, number of spans, total time, percentiles
+    of the span times, maximum time), ordered by total time.
+    '''
+    
+    dt = {}
+    
+    for entry in spans:
+        dt.setdefault(entry['span'], []).append(entry['dt'])
+    
+    summary = []
+    
+    for name, t in dt.iteritems():
+        t = np.array(t)
+        summary.append((name, t.size, np.sum(t),
+                        np.percentile(t, percentiles), np.max(t)))
+    
+    summary.sort(key=lambda s: -s[2])
+    
+    return summary
+
+
+def main():
+    if len(sys.argv) != 2:
+        print 'Usage: %s trace.jsonl' % sys.argv[0]
+        return 1
+    
+    spans = load_trace(sys.argv[1])
+    
+    if len(spans) == 0:
+        print 'No spans in trace.'
+        return 0
+    
+    percentiles = (50., 90., 99.)
+    
+    header = '%-16s %7s %10s' % ('stage', 'n', 'total (s)')
+    header += ''.join(['%9s' % ('p%d (s)' % p) for p in percentiles])
+    header += '%9s' % 'max (s)'
+    print header
+    
+    for name, n, total, p, t_max in summarize(spans, percentiles=percentiles):
+        txt = '%-16s %7d %10.2f' % (name, n, total)
+        txt += ''.join(['%9.3f' % x for x in p])
+        txt += '%9.3f' % t_max
+        print txt
+    
+    n_frames = len([s for s in spans if (s['span'] == 'frame') and ('error' not in s)])
+    print ''
+    print '%d frames rendered by %d processes.' % (n_frames, len(set([s['pid'] for s in spans])))
+    
+    return 0
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#  
+#  videosink.py
+#  
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#  
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#  
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#  
+#  
+
+'''
+Stream rendered frames straight into an ffmpeg encoder, instead of
+writing them to disk as PNGs first.
+'''
+
+import numpy as np
+
+import sys
+import subprocess
+import threading
+import traceback
+
+import timing
+
+
+class ReorderBuffer:
+    '''
+    Collects frames that arrive in any order (e.g., from several
+    worker processes), and releases them in the order given by
+    <frames>. Each frame can consist of several images (one for each
+    of <n_eyes> cameras), which are released together.
+    '''
+    
+    def __init__(self, frames, n_eyes=1):
+        self.order = list(frames)
+        self.n_eyes = n_eyes
+        
+        self.images = {}
+        self.next_idx = 0
+    
+    def add(self, k, eye, img):
+        '''
+        Add image <eye> of frame <k>. Returns a list of the frames
+        that are now ready to be released, in order, each as a list
+        of images (one per eye).
+        '''
+        
+        self.images.setdefault(k, {})[eye] = img
+        
+        return self._release()
+    
+    def _release(self, skip_missing=False):
+        ready = []
+        
+        while self.next_idx < len(self.order):
+            k = self.order[self.next_idx]
+            imgs = self.images.get(k, {})
+            
+            if len(imgs) < self.n_eyes:
+                if not skip_missing:
+                    break
+                
+                if len(imgs) != 0:
+                    print 'Frame %d is incomplete. Skipping.' % k
+                else:
+                    print 'Frame %d is missing. Skipping.' % k
+                
+                self.images.pop(k, None)
+                self.next_idx += 1
+                continue
+            
+            self.images.pop(k)
+            ready.append([imgs[eye] for eye in xrange(self.n_eyes)])
+            self.next_idx += 1
+        
+        return ready
+    
+    def drain(self):
+        '''
+        Release all the remaining frames, skipping any that are
+        missing (e.g., because they failed to render).
+        '''
+        
+        return self._release(skip_missing=True)
+    
+    def __len__(self):
+        return len(self.images)
+
+
+class QueueListener:
+    '''
+    Takes (k, eye, rgb) from a queue in a background thread, and adds
+    them with put(). If put() fails, the error is kept, and the queue
+    is still emptied, so that the processes putting frames on it do not
+    block. The error is raised again by stop_listening().
+    '''
+    
+    _thread = None
+    _error = None
+    
+    def listen(self, frame_q):
+        '''
+        Start a thread that takes (k, eye, rgb) from <frame_q> and adds
+        them, until it receives None.
+        '''
+        
+        def f():
+            while True:
+                item = frame_q.get()
+                
+                if item == None:
+                    return
+                
+                if self._error != None:
+                    continue
+                
+                try:
+                    self.put(*item)
+                except Exception:
+                    traceback.print_exc()
+                    self._error = sys.exc_info()
+        
+        self._error = None
+        self._thread = threading.Thread(target=f)
+        self._thread.daemon = True
+        self._thread.start()
+    
+    def stop_listening(self, frame_q):
+        '''
+        Stop listening to <frame_q> (if listening), and raise the error
+        of the thread, if there was one.
+        '''
+        
+        if self._thread != None:
+            frame_q.put(None)
+            self._thread.join()
+            self._thread = None
+        
+        error, self._error = self._error, None
+        
+        if error != None:
+            raise error[0], error[1], error[2]
+
+
+class FFmpegSink(QueueListener):
+    '''
+    Feeds raw 8-bit RGB frames to an ffmpeg process over a pipe.
+    
+    Frames can be added in any order with put(), and are encoded in
+    the order given by <frames>. For stereo renders (<n_eyes> = 2), the
+    left and right images of each frame are placed side by side. If
+    <half_sbs> is True, the sample aspect ratio is halved, so that
+    players show the side-by-side frame with the aspect ratio of a
+    single eye (the same as side-by-side.sh).
+    
+    The ffmpeg process is started by start(), with the expected size of
+    the frames, or otherwise when the first frame is ready. If the first
+    frame has a different size, ffmpeg is started again.
+    '''
+    
+    def __init__(self, fname, frames, fps=4, n_eyes=1, half_sbs=True,
+                       ffmpeg='ffmpeg',
+                       codec_args=('-c:v', 'libx264', '-crf', '23',
+                                   '-preset', 'veryfast', '-pix_fmt', 'yuv420p')):
+        self.fname = fname
+        self.fps = fps
+        self.n_eyes = n_eyes
+        self.half_sbs = half_sbs
+        self.ffmpeg = ffmpeg
+        self.codec_args = list(codec_args)
+        
+        self.buffer = ReorderBuffer(frames, n_eyes=n_eyes)
+        self.proc = None
+        self.shape = None
+        self.n_written = 0
+    
+    def start(self, shape):
+        '''
+        Start ffmpeg for frames of <shape> = (height, width) pixels (of
+        one eye). Call this before forking the renderers, so that a
+        missing ffmpeg fails straight away.
+        '''
+        
+        height, width = shape[:2]
+        
+        self._start((height, width*self.n_eyes, 3))
+    
+    def _start(self, shape):
+        height, width = shape[:2]
+        
+        cmd = [self.ffmpeg, '-y', '-loglevel', 'error',
+               '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+               '-s', '%dx%d' % (width, height),
+               '-r', str(self.fps),
+               '-i', '-']
+        
+        if (self.n_eyes == 2) and self.half_sbs:
+            cmd += ['-vf', 'setsar=sar/2']
+        
+        cmd += self.codec_args + [self.fname]
+        
+        self.shape = shape
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+    
+    def _write(self, imgs):
+        if len(imgs) == 1:
+            rgb = imgs[0]
+        else:
+            rgb = np.hstack(imgs)
+        
+        rgb = np.ascontiguousarray(rgb[:,:,:3], dtype='u1')
+        
+        if self.proc == None:
+            self._start(rgb.shape)
+        elif (rgb.shape != self.shape) and (self.n_written == 0):
+            # Nothing has been encoded at the expected size yet
+            self._abort()
+            self._start(rgb.shape)
+        elif rgb.shape != self.shape:
+            raise ValueError('Frame shape %s differs from video shape %s'
+                             % (str(rgb.shape), str(self.shape)))
+        
+        with timing.span('video_encode'):
+            self.proc.stdin.write(rgb.tostring())
+        
+        self.n_written += 1
+    
+    def put(self, k, eye, rgb):
+        '''
+        Add image <eye> of frame <k>, and encode any frames that are
+        now complete and in order.
+        '''
+        
+        for imgs in self.buffer.add(k, eye, rgb):
+            self._write(imgs)
+    
+    def _abort(self):
+        if self.proc != None:
+            self.proc.kill()
+            self.proc.wait()
+            self.proc = None
+    
+    def close(self, frame_q=None):
+        '''
+        Stop listening to <frame_q> (if listening), encode the remaining
+        frames, and wait for ffmpeg to finish. If encoding a frame
+        failed, ffmpeg is stopped, and the error is raised.
+        '''
+        
+        try:
+            self.stop_listening(frame_q)
+            
+            for imgs in self.buffer.drain():
+                self._write(imgs)
+        except:
+            error = sys.exc_info()
+            self._abort()
+            raise error[0], error[1], error[2]
+        
+        if self.proc != None:
+            self.proc.stdin.close()
+            ret = self.proc.wait()
+            
+            if ret != 0:
+                print 'ffmpeg exited with code %d.' % ret
+        
+        print 'Wrote %d frames to %s.' % (self.n_written, self.fname)